@@ -1,2 +1,2 @@
 #!/usr/bin/env bash
-python3 ./main.py
\ No newline at end of file
+exec python3 ./main.py
\ No newline at end of file
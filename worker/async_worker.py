@@ -0,0 +1,353 @@
+import asyncio
+import os
+import signal
+import time
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from logging import Logger, getLogger
+from pika import ConnectionParameters, BasicProperties
+from pika.adapters.asyncio_connection import AsyncioConnection
+from typing import Union, List, Tuple, Dict, Set, Callable
+from constants import DEFAULT_MAX_IN_FLIGHT, DEFAULT_IO_POOL_SIZE, DEFAULT_CPU_POOL_SIZE, ACK_STAGE, \
+    ERROR_MALFORMED_MESSAGE, ERROR_POISON_JOB
+from job_status_enum import JobStatusEnum
+from job_message import JobRequest, parseJobMessage
+from rendition import Rendition
+from retry import TransientError
+from scheduling import splitPrefetchCount
+from worker import Worker
+
+# worker instance of each process of the CPU pool, created on first use
+poolWorker: Union[Worker, None] = None
+
+
+def renderThumbnail(config: dict, filePath: str,
+                    renditions: Union[List[Rendition], None] = None) -> Tuple[Dict[str, str], dict]:
+    """
+    Make thumbnails inside a process of the CPU pool
+    :param config: config data of the application
+    :param filePath: input image file path
+    :param renditions: renditions requested for the job, configured renditions if None
+    :return: paths of the resized images by redis field (empty if processing failed) and metrics recorded meanwhile
+    """
+    global poolWorker
+    if poolWorker is None:
+        poolWorker = Worker(config, getLogger('worker'))
+    thumbnailPaths: Dict[str, str] = poolWorker.makeThumbnail(filePath, renditions)
+    return thumbnailPaths, poolWorker.metrics.flush()
+
+
+class AsyncWorker(Worker):
+    """
+    Worker engine in which an asyncio event loop handles AMQP consumption and Redis I/O for many in-flight jobs
+    Redis calls run on a thread pool and the CPU-bound resize work runs on a bounded process pool
+    """
+
+    def __init__(self, config: dict, logger: Logger):
+        super().__init__(config, logger)
+        workerConfig: dict = config.get("worker", {})
+        self.maxInFlight: int = workerConfig.get("maxInFlight", DEFAULT_MAX_IN_FLIGHT)
+        self.ioPoolSize: int = workerConfig.get("ioPoolSize", DEFAULT_IO_POOL_SIZE)
+        self.cpuPoolSize: int = workerConfig.get("cpuPoolSize", DEFAULT_CPU_POOL_SIZE)
+        self.loop: Union[asyncio.AbstractEventLoop, None] = None
+        self.ioExecutor: Union[ThreadPoolExecutor, None] = None
+        self.cpuExecutor: Union[ProcessPoolExecutor, None] = None
+        self.asyncQueueConn: Union[AsyncioConnection, None] = None
+        self.consumedQueues: List[Tuple[str, int, Callable]] = []
+        self.consumerTags: List[str] = []
+        self.inFlightJobs: Set[asyncio.Task] = set()
+        # consecutive failed connection attempts, reset once consumers are set up
+        self.connectAttempts: int = 0
+        self.failed: bool = False
+
+    async def renderJob(self, job: JobRequest, currentJobStatus: JobStatusEnum, filePath: str, attempts: int,
+                        failedJobs: List[Tuple[JobRequest, int, str, str]]) \
+            -> Tuple[str, JobStatusEnum, Dict[str, str]]:
+        """
+        Make thumbnails of a claimed job on the CPU pool
+        :param job: claimed job
+        :param currentJobStatus: status of the job before it was claimed
+        :param filePath: input image file path
+        :param attempts: number of attempts of the job, including this one
+        :param failedJobs: failed jobs to publish, see getFailedJob
+        :return: finished job containing job id, next job status and thumbnail paths
+        """
+        if self.retryPolicy.isPoison(attempts):
+            self.logger.error("job %s: %s", job.jobId, ERROR_POISON_JOB)
+            return self.getFailedJob(job, currentJobStatus, filePath, attempts, ERROR_POISON_JOB, 0.0, failedJobs)
+        start: float = time.perf_counter()
+        try:
+            thumbnailPaths, poolMetrics = await self.loop.run_in_executor(
+                self.cpuExecutor, renderThumbnail, self.config, filePath, job.renditions
+            )
+        except TransientError as exc:
+            return self.getFailedJob(
+                job, currentJobStatus, filePath, attempts, str(exc), time.perf_counter() - start, failedJobs
+            )
+        self.metrics.merge(poolMetrics)
+        return self.getFinishedJob(job.jobId, filePath, thumbnailPaths, time.perf_counter() - start)
+
+    async def handleJob(self, channel, deliveryTag: int, jobs: List[JobRequest]):
+        """
+        Execute the jobs of a message without blocking the event loop, then acknowledge the message
+        :param channel: channel from which the message comes
+        :param deliveryTag: delivery tag of the message
+        :param jobs: jobs requested by the message
+        """
+        try:
+            claimedJobs: List[Tuple[str, JobStatusEnum, str, int]] = await self.loop.run_in_executor(
+                self.ioExecutor, self.claimJobs,
+                [job.jobId for job in jobs], {job.jobId for job in jobs if job.redelivered}
+            )
+            jobRenditions: Dict[str, Union[List[Rendition], None]] = {job.jobId: job.renditions for job in jobs}
+            failedJobs: List[Tuple[JobRequest, int, str, str]] = []
+            finishedJobs: List[Tuple[str, JobStatusEnum, Dict[str, str]]] = list(await asyncio.gather(*(
+                self.renderJob(
+                    JobRequest(jobId, jobRenditions[jobId]), currentJobStatus, filePath, attempts, failedJobs
+                ) for jobId, currentJobStatus, filePath, attempts in claimedJobs
+            )))
+            await self.loop.run_in_executor(self.ioExecutor, self.finishJobs, finishedJobs)
+        except asyncio.CancelledError:
+            raise
+        except BaseException as exc:
+            # including the exit of a job whose status cannot be updated
+            self.failMessage(channel, deliveryTag, jobs, exc)
+            return
+        if not channel.is_open:
+            # the connection was lost meanwhile: RabbitMQ redelivers the message
+            return
+        self.publishFailedJobs(channel, failedJobs)
+        # messages complete out of order, so each message is acknowledged on its own
+        with self.metrics.time(ACK_STAGE):
+            channel.basic_ack(delivery_tag=deliveryTag)
+
+    def failMessage(self, channel, deliveryTag: int, jobs: List[JobRequest], exc: BaseException):
+        """
+        Give a message whose jobs failed unexpectedly back to its queue, its jobs are claimed again as redelivered
+        After a fatal error, such as a broken CPU pool or a lost Redis server, consuming stops: the process exits once
+        the other messages in flight are done, so that the supervisor spawns a new one
+        :param channel: channel from which the message comes
+        :param deliveryTag: delivery tag of the message
+        :param jobs: jobs requested by the message
+        :param exc: error of the jobs
+        """
+        self.logger.critical("jobs %s failed unexpectedly: %r", [job.jobId for job in jobs], exc)
+        if channel.is_open:
+            channel.basic_nack(delivery_tag=deliveryTag, requeue=True)
+        if isinstance(exc, (BrokenProcessPool, SystemExit)):
+            self.failed = True
+            if not self.stopping:
+                self.stop()
+
+    def onMessage(self, channel, method_frame, header_frame: BasicProperties, body: bytes):
+        """
+        Callback when receiving a message: schedule its jobs on the event loop
+        :param channel: channel from which the message comes
+        :param method_frame: method frame of the message
+        :param header_frame: header frame of the message
+        :param body: body of the message: a job id or a JSON array of jobs
+        """
+        try:
+            jobs: List[JobRequest] = parseJobMessage(body, self.encoding, method_frame.redelivered)
+        except ValueError as exc:
+            self.logger.error("%s %s", ERROR_MALFORMED_MESSAGE, exc)
+            channel.basic_reject(delivery_tag=method_frame.delivery_tag, requeue=False)
+            return
+        self.logger.debug("receiving jobs: %s", jobs)
+        task: asyncio.Task = self.loop.create_task(self.handleJob(channel, method_frame.delivery_tag, jobs))
+        self.inFlightJobs.add(task)
+        task.add_done_callback(self.inFlightJobs.discard)
+
+    async def routeJobs(self, channel, deliveryTag: int, jobs: List[JobRequest]):
+        """
+        Dispatch the jobs of a message of queueName to the queue of their size class, then acknowledge the message
+        :param channel: channel from which the message comes
+        :param deliveryTag: delivery tag of the message
+        :param jobs: jobs requested by the message
+        """
+        classifiedJobs: Dict[str, List[JobRequest]] = await self.loop.run_in_executor(
+            self.ioExecutor, self.classifyJobs, jobs
+        )
+        self.publishJobs(channel, classifiedJobs)
+        channel.basic_ack(delivery_tag=deliveryTag)
+
+    def onRouteMessage(self, channel, method_frame, header_frame: BasicProperties, body: bytes):
+        """
+        Callback when receiving a message of queueName while it is not a consumed queue: schedule its routing
+        :param channel: channel from which the message comes
+        :param method_frame: method frame of the message
+        :param header_frame: header frame of the message
+        :param body: body of the message: a job id or a JSON array of jobs
+        """
+        try:
+            jobs: List[JobRequest] = parseJobMessage(body, self.encoding)
+        except ValueError as exc:
+            self.logger.error("%s %s", ERROR_MALFORMED_MESSAGE, exc)
+            channel.basic_reject(delivery_tag=method_frame.delivery_tag, requeue=False)
+            return
+        task: asyncio.Task = self.loop.create_task(self.routeJobs(channel, method_frame.delivery_tag, jobs))
+        self.inFlightJobs.add(task)
+        task.add_done_callback(self.inFlightJobs.discard)
+
+    def getConsumedQueues(self) -> List[Tuple[str, int, Callable]]:
+        """
+        Get queues to consume with their share of the in-flight jobs, so that one queue cannot take every slot
+        :return: name, prefetch count and message callback of each queue
+        """
+        prefetchCounts: Dict[str, int] = splitPrefetchCount(self.queueClasses, self.maxInFlight)
+        consumedQueues: List[Tuple[str, int, Callable]] = [
+            (queueClass.name, prefetchCounts[queueClass.name], self.onMessage) for queueClass in self.queueClasses
+        ]
+        if self.routing:
+            consumedQueues.append((self.config["queue"]["queueName"], self.maxInFlight, self.onRouteMessage))
+        return consumedQueues
+
+    def onConnectionOpen(self, connection: AsyncioConnection):
+        """
+        Callback when the RabbitMQ connection is opened: open a channel
+        :param connection: opened connection
+        """
+        self.logger.info("RabbitMQ connection opened")
+        connection.channel(on_open_callback=self.onChannelOpen)
+
+    def onConnectionError(self, connection: AsyncioConnection, exc: Exception):
+        """
+        Callback when the RabbitMQ connection cannot be opened: try again later
+        :param connection: connection that failed
+        :param exc: connection error
+        """
+        self.reconnect(exc)
+
+    def onConnectionClosed(self, connection: AsyncioConnection, reason: Exception):
+        """
+        Callback when the RabbitMQ connection is closed: stop the event loop when draining, connect again otherwise
+        :param connection: closed connection
+        :param reason: reason of the closing
+        """
+        if self.stopping:
+            self.logger.info("RabbitMQ connection closed: %s", reason)
+            self.loop.stop()
+            return
+        self.reconnect(reason)
+
+    def reconnect(self, reason: Exception):
+        """
+        Connect again to RabbitMQ after a jittered delay growing with consecutive failures, stop the event loop once
+        every attempt failed
+        In-flight jobs of the lost connection finish, but their messages are redelivered instead of acknowledged
+        :param reason: reason of the lost or refused connection
+        """
+        self.connectAttempts += 1
+        if self.stopping or self.connectAttempts >= self.backoff.maxAttempts:
+            self.logger.critical("RabbitMQ connection lost: %s", reason)
+            self.loop.stop()
+            return
+        delay: float = self.backoff.getDelay(self.connectAttempts)
+        self.logger.warning("RabbitMQ connection lost: %s, reconnecting in %.2f s", reason, delay)
+        self.countReconnect("amqp")
+        self.channel = None
+        self.consumerTags = []
+        self.loop.call_later(delay, self.connect)
+
+    def connect(self):
+        """
+        Open the RabbitMQ connection, consumers are set up by its callbacks
+        """
+        parameters = ConnectionParameters(host=self.config["queue"]["host"],
+                                          port=self.config["queue"]["port"])
+        self.asyncQueueConn = AsyncioConnection(
+            parameters,
+            on_open_callback=self.onConnectionOpen,
+            on_open_error_callback=self.onConnectionError,
+            on_close_callback=self.onConnectionClosed,
+            custom_ioloop=self.loop
+        )
+
+    def onChannelOpen(self, channel):
+        """
+        Callback when the channel is opened: set up the consumer of the first queue
+        :param channel: opened channel
+        """
+        self.channel = channel
+        self.consumedQueues = self.getConsumedQueues()
+        self.declareQueue(0)
+
+    def declareQueue(self, index: int):
+        """
+        Declare a consumed queue
+        :param index: index of the queue in consumedQueues
+        """
+        queueName: str = self.consumedQueues[index][0]
+        self.channel.queue_declare(queueName, durable=True, callback=partial(self.onQueueDeclared, index))
+
+    def onQueueDeclared(self, index: int, frame):
+        """
+        Callback when a queue is declared: set the prefetch window of its consumer
+        :param index: index of the queue in consumedQueues
+        :param frame: Queue.DeclareOk frame
+        """
+        # prefetch window bounds the number of jobs in flight, it applies to the consumers created afterwards
+        prefetchCount: int = self.consumedQueues[index][1]
+        self.channel.basic_qos(prefetch_count=prefetchCount, callback=partial(self.onQosSet, index))
+
+    def onQosSet(self, index: int, frame):
+        """
+        Callback when the prefetch window is set: start consuming the queue then set up the next one
+        :param index: index of the queue in consumedQueues
+        :param frame: Basic.QosOk frame
+        """
+        queueName, prefetchCount, onMessage = self.consumedQueues[index]
+        self.logger.info("start_consuming queue: %s", queueName)
+        self.consumerTags.append(self.channel.basic_consume(queueName, onMessage))
+        if index + 1 < len(self.consumedQueues):
+            self.declareQueue(index + 1)
+        else:
+            self.connectAttempts = 0
+            self.reportStartup()
+
+    def stop(self, signum=None, frame=None):
+        """
+        Stop consuming so that the process drains gracefully: used as SIGTERM handler
+        :param signum: number of the received signal
+        :param frame: current stack frame
+        """
+        self.logger.info("stopping consumer of pid: %s", os.getpid())
+        self.stopping = True
+        self.loop.create_task(self.drain())
+
+    async def drain(self):
+        """
+        Cancel the consumers, wait for every in-flight job to be acknowledged then close the connection
+        """
+        if self.channel is not None:
+            for consumerTag in self.consumerTags:
+                self.channel.basic_cancel(consumerTag)
+        await asyncio.gather(*self.inFlightJobs, return_exceptions=True)
+        self.logger.info("in-flight jobs are drained")
+        # the connection may be closed while waiting to reconnect
+        if self.asyncQueueConn is not None and not self.asyncQueueConn.is_closed:
+            self.asyncQueueConn.close()
+        else:
+            self.loop.stop()
+
+    def processJob(self):
+        """
+        Process job from the queue server using the asyncio event loop
+        """
+        self.logger.info("processJob (async) by pid: %s", os.getpid())
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.add_signal_handler(signal.SIGTERM, self.stop)
+        self.ioExecutor = ThreadPoolExecutor(max_workers=self.ioPoolSize)
+        self.cpuExecutor = ProcessPoolExecutor(max_workers=self.cpuPoolSize)
+        try:
+            self.connect()
+            self.loop.run_forever()
+        except Exception as exc:
+            self.logger.critical(exc)
+        finally:
+            self.ioExecutor.shutdown(wait=False)
+            self.cpuExecutor.shutdown(wait=False)
+            self.loop.close()
+            exit(0 if self.stopping and not self.failed else 1)
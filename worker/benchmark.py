@@ -0,0 +1,288 @@
+"""
+Offline benchmark of the thumbnail pipeline
+Drives Worker.executeProcess (and through it Worker.makeThumbnail) against a synthetic image corpus with an
+in-process fake broker and fakeredis, and reports jobs/s, p50/p99 latency and peak RSS per configuration.
+Each configuration runs in fresh processes so that peak RSS is not polluted by previous runs.
+Resize backends are also compared alone: time per image, one by one and as a stack of same-size images, and PSNR of
+their output against the Wand resize.
+
+usage: python3 benchmark.py --sizes small,large --formats jpeg,tiff --pool-sizes 1,4 --batch-sizes 1,10 \
+    --resize-backends wand,numpy:box,numpy:lanczos
+"""
+import argparse
+import itertools
+import math
+import os
+import resource
+import shutil
+import tempfile
+import time
+from logging import Logger, getLogger, NullHandler
+from multiprocessing import get_context
+from types import SimpleNamespace
+from typing import Dict, List, Tuple
+from constants import FILE_PATH_REDIS_KEY, JOB_STATUS_REDIS_KEY, THUMBNAIL_PATH_REDIS_KEY, THUMBNAIL_MAX_PIXEL
+from job_status_enum import JobStatusEnum
+
+CORPUS_SIZES: Dict[str, Tuple[int, int]] = {
+    "small": (640, 480),
+    "medium": (2048, 1536),
+    "large": (6000, 4000),
+}
+CORPUS_FORMATS: Dict[str, str] = {"png": ".png", "jpeg": ".jpg", "gif": ".gif", "tiff": ".tif"}
+
+
+class FakeChannel:
+    """
+    In-process stand-in of a pika channel recording when each delivery is acknowledged
+    """
+
+    def __init__(self):
+        self.unacked: List[int] = []
+        self.ackedAt: Dict[int, float] = {}
+
+    def deliver(self, deliveryTag: int):
+        """
+        Record a delivery waiting for its acknowledgement
+        :param deliveryTag: delivery tag of the message
+        """
+        self.unacked.append(deliveryTag)
+
+    def basic_ack(self, delivery_tag: int = 0, multiple: bool = False):
+        """
+        Acknowledge one delivery, or every delivery up to delivery_tag if multiple
+        :param delivery_tag: delivery tag of the message
+        :param multiple: acknowledge every previous unacknowledged delivery as well
+        """
+        now: float = time.perf_counter()
+        acked: List[int] = [tag for tag in self.unacked if tag <= delivery_tag] if multiple else [delivery_tag]
+        for tag in acked:
+            self.ackedAt[tag] = now
+            self.unacked.remove(tag)
+
+
+class FakeConnection:
+    """
+    In-process stand-in of a pika BlockingConnection: timers never fire, the benchmark flushes the last batch itself
+    """
+
+    def call_later(self, delay: float, callback):
+        return None
+
+    def remove_timeout(self, timeoutId):
+        pass
+
+    def close(self):
+        pass
+
+
+def generateCorpus(corpusDir: str, sizes: List[str], formats: List[str], logger: Logger) -> List[str]:
+    """
+    Generate synthetic images with ImageMagick plasma fractals, reusing images already in corpusDir
+    :param corpusDir: directory of the corpus
+    :param sizes: names of the sizes to generate
+    :param formats: names of the formats to generate
+    :param logger: logger object
+    :return: paths of the images of the corpus
+    """
+    from wand.image import Image
+    paths: List[str] = []
+    for size, imageFormat in itertools.product(sizes, formats):
+        width, height = CORPUS_SIZES[size]
+        path: str = os.path.join(corpusDir, "%s_%sx%s%s" % (size, width, height, CORPUS_FORMATS[imageFormat]))
+        if not os.path.exists(path):
+            logger.warning("generating %s" % path)
+            with Image(width=width, height=height, pseudo="plasma:fractal") as img:
+                img.format = imageFormat
+                img.save(filename=path)
+        paths.append(path)
+    return paths
+
+
+def runJobs(appConfig: dict, filePaths: List[str], resultQueue):
+    """
+    Process jobs with a single worker against fakeredis and the fake broker (entry point of a benchmark process)
+    :param appConfig: App section of the configuration
+    :param filePaths: input image of every job
+    :param resultQueue: queue receiving latencies, elapsed time and peak RSS of the process
+    """
+    import fakeredis
+    from worker import Worker
+    logger: Logger = getLogger("benchmark.worker")
+    logger.addHandler(NullHandler())
+    logger.propagate = False
+    worker: Worker = Worker(appConfig, logger)
+    worker.redisClient = fakeredis.FakeStrictRedis()
+    worker.queueConn = FakeConnection()
+    for jobId, filePath in enumerate(filePaths, 1):
+        worker.redisClient.hmset(str(jobId), {
+            FILE_PATH_REDIS_KEY: filePath,
+            JOB_STATUS_REDIS_KEY: JobStatusEnum.READY_FOR_PROCESSING.value,
+            THUMBNAIL_PATH_REDIS_KEY: "",
+        })
+
+    channel: FakeChannel = FakeChannel()
+    receivedAt: Dict[int, float] = {}
+    start: float = time.perf_counter()
+    for deliveryTag in range(1, len(filePaths) + 1):
+        receivedAt[deliveryTag] = time.perf_counter()
+        channel.deliver(deliveryTag)
+        worker.executeProcess(channel, SimpleNamespace(delivery_tag=deliveryTag), None, str(deliveryTag).encode())
+    worker.flushJobs(channel)
+    elapsed: float = time.perf_counter() - start
+
+    latencies: List[float] = [channel.ackedAt[tag] - receivedAt[tag] for tag in receivedAt]
+    # ru_maxrss is in kilobytes on Linux
+    peakRss: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    resultQueue.put((latencies, elapsed, peakRss))
+
+
+def percentile(values: List[float], ratio: float) -> float:
+    """
+    Get percentile of values with the nearest-rank method
+    :param values: observed values
+    :param ratio: percentile between 0 and 1
+    :return: percentile value
+    """
+    ordered: List[float] = sorted(values)
+    return ordered[min(int(ratio * len(ordered)), len(ordered) - 1)]
+
+
+def runConfiguration(appConfig: dict, filePaths: List[str], poolSize: int) -> Dict[str, float]:
+    """
+    Run one configuration with poolSize processes sharing the jobs
+    :param appConfig: App section of the configuration
+    :param filePaths: input image of every job
+    :param poolSize: number of worker processes
+    :return: jobs/s, p50 and p99 latency in ms and peak RSS in MB (max over processes)
+    """
+    context = get_context("fork")
+    resultQueue = context.Queue()
+    processes = [
+        context.Process(target=runJobs, args=(appConfig, filePaths[index::poolSize], resultQueue))
+        for index in range(poolSize)
+    ]
+    start: float = time.perf_counter()
+    for process in processes:
+        process.start()
+    results = [resultQueue.get() for _ in processes]
+    for process in processes:
+        process.join()
+    wallTime: float = time.perf_counter() - start
+
+    latencies: List[float] = [latency for result in results for latency in result[0]]
+    return {
+        "jobsPerSecond": len(latencies) / wallTime,
+        "p50Ms": percentile(latencies, 0.5) * 1000,
+        "p99Ms": percentile(latencies, 0.99) * 1000,
+        "peakRssMb": max(result[2] for result in results) / 1024 / 1024,
+    }
+
+
+def parseResizeBackend(value: str) -> dict:
+    """
+    Read a resize backend given on the command line
+    :param value: backend name, optionally followed by :filter (numpy:box)
+    :return: resize section of the worker configuration
+    """
+    backendName, _, resizeFilter = value.partition(":")
+    return {"backend": backendName, "filter": resizeFilter} if resizeFilter else {"backend": backendName}
+
+
+def compareResizeBackends(corpus: List[str], backendValues: List[str], size: int, repeat: int = 3):
+    """
+    Time every resize backend on the decoded corpus and measure the PSNR of its output against the Wand resize
+    :param corpus: paths of the images of the corpus
+    :param backendValues: resize backends given on the command line
+    :param size: maximum width and height of the resized images
+    :param repeat: number of timed resizes of each image
+    """
+    import numpy
+    from wand.image import Image
+    from resize_backend import createResizeBackend, NumpyResizeBackend
+
+    def readPixels(img: Image):
+        return numpy.frombuffer(img.make_blob("RGB"), dtype=numpy.uint8).reshape(img.height, img.width, 3)
+
+    print("%-16s %12s %12s %10s" % ("resize", "ms/image", "stacked ms", "PSNR dB"))
+    for backendValue in backendValues:
+        backend = createResizeBackend(parseResizeBackend(backendValue))
+        seconds: float = 0
+        squaredErrors: List[float] = []
+        stackedSeconds: float = 0
+        for path in corpus:
+            with Image(filename=path) as original:
+                original.depth = 8
+                width, height = max(original.width * size // max(original.width, original.height), 1), \
+                    max(original.height * size // max(original.width, original.height), 1)
+                for _ in range(repeat):
+                    with original.clone() as img:
+                        start: float = time.perf_counter()
+                        backend.resize(img, width, height)
+                        seconds += time.perf_counter() - start
+                with original.clone() as img, original.clone() as reference:
+                    backend.resize(img, width, height)
+                    reference.resize(width, height)
+                    squaredErrors.append(float(numpy.mean(
+                        (readPixels(img).astype(numpy.float64) - readPixels(reference)) ** 2
+                    )))
+                if isinstance(backend, NumpyResizeBackend):
+                    stack = numpy.stack([readPixels(original)] * repeat)
+                    start = time.perf_counter()
+                    backend.resizeArray(stack, width, height)
+                    stackedSeconds += time.perf_counter() - start
+        meanSquaredError: float = sum(squaredErrors) / len(squaredErrors)
+        psnr: float = 10 * math.log10(255 ** 2 / meanSquaredError) if meanSquaredError else float("inf")
+        stackedMs: str = "%.2f" % (stackedSeconds / len(corpus) / repeat * 1000) if stackedSeconds else "-"
+        print("%-16s %12.2f %12s %10.1f" % (backendValue, seconds / len(corpus) / repeat * 1000, stackedMs, psnr))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the thumbnail pipeline")
+    parser.add_argument("--jobs", type=int, default=50, help="number of jobs per configuration")
+    parser.add_argument("--sizes", default="small,medium", help="comma separated among %s" % list(CORPUS_SIZES))
+    parser.add_argument("--formats", default="png,jpeg,gif,tiff",
+                        help="comma separated among %s" % list(CORPUS_FORMATS))
+    parser.add_argument("--pool-sizes", default="1", help="comma separated numbers of worker processes")
+    parser.add_argument("--batch-sizes", default="1,10", help="comma separated values of App.worker.batchSize")
+    parser.add_argument("--decode-modes", default="shrink,full",
+                        help="comma separated among shrink (shrink-on-load) and full")
+    parser.add_argument("--resize-backends", default="wand",
+                        help="comma separated among wand, numpy:box and numpy:lanczos")
+    parser.add_argument("--corpus-dir", default=os.path.join(tempfile.gettempdir(), "thumbnail-benchmark-corpus"))
+    args = parser.parse_args()
+
+    logger: Logger = getLogger("benchmark")
+    os.makedirs(args.corpus_dir, exist_ok=True)
+    corpus: List[str] = generateCorpus(args.corpus_dir, args.sizes.split(","), args.formats.split(","), logger)
+    filePaths: List[str] = list(itertools.islice(itertools.cycle(corpus), args.jobs))
+    thumbnailDir: str = tempfile.mkdtemp(prefix="thumbnail-benchmark-")
+
+    resizeBackends: List[str] = args.resize_backends.split(",")
+
+    print("%-8s %-6s %-7s %-16s %10s %10s %10s %10s"
+          % ("pool", "batch", "decode", "resize", "jobs/s", "p50 ms", "p99 ms", "RSS MB"))
+    try:
+        for poolSize, batchSize, decodeMode, resizeBackend in itertools.product(
+                [int(value) for value in args.pool_sizes.split(",")],
+                [int(value) for value in args.batch_sizes.split(",")],
+                args.decode_modes.split(","), resizeBackends):
+            appConfig: dict = {
+                "fileStorage": {"thumbnailPath": thumbnailDir + "/"},
+                "queue": {"queueName": "benchmark"},
+                "worker": {"batchSize": batchSize, "shrinkOnLoad": decodeMode == "shrink",
+                           "resize": parseResizeBackend(resizeBackend)},
+            }
+            result: Dict[str, float] = runConfiguration(appConfig, filePaths, poolSize)
+            print("%-8s %-6s %-7s %-16s %10.1f %10.1f %10.1f %10.1f"
+                  % (poolSize, batchSize, decodeMode, resizeBackend, result["jobsPerSecond"], result["p50Ms"],
+                     result["p99Ms"], result["peakRssMb"]))
+        if len(resizeBackends) > 1:
+            print()
+            compareResizeBackends(corpus, resizeBackends, THUMBNAIL_MAX_PIXEL)
+    finally:
+        shutil.rmtree(thumbnailDir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
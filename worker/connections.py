@@ -0,0 +1,97 @@
+import itertools
+import random
+import time
+from logging import Logger
+from redis import BlockingConnectionPool
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from typing import Callable, Dict, Tuple, Type, TypeVar, Union
+from constants import DEFAULT_RECONNECT_MAX_ATTEMPTS, DEFAULT_RECONNECT_BASE_DELAY, DEFAULT_RECONNECT_MAX_DELAY, \
+    DEFAULT_REDIS_MAX_CONNECTIONS, DEFAULT_REDIS_POOL_TIMEOUT, DEFAULT_REDIS_HEALTH_CHECK_INTERVAL
+
+# errors after which Redis commands are sent again on another connection of the pool
+REDIS_CONNECTION_ERRORS = (RedisConnectionError, RedisTimeoutError)
+
+T = TypeVar("T")
+
+
+class Backoff:
+    """
+    Exponential backoff with full jitter between connection attempts: the delay after the n-th failed attempt is drawn
+    uniformly between 0 and min(baseDelay * 2 ** (n - 1), maxDelay), so that processes which lost their connection
+    together do not hit the server together when it comes back
+    """
+
+    def __init__(self, reconnectConfig: dict):
+        self.maxAttempts: int = max(reconnectConfig.get("maxAttempts", DEFAULT_RECONNECT_MAX_ATTEMPTS), 1)
+        self.baseDelay: float = reconnectConfig.get("baseDelay", DEFAULT_RECONNECT_BASE_DELAY)
+        self.maxDelay: float = reconnectConfig.get("maxDelay", DEFAULT_RECONNECT_MAX_DELAY)
+
+    def getDelay(self, attempt: int) -> float:
+        """
+        Draw the delay after a failed attempt
+        :param attempt: number of the failed attempt, from 1
+        :return: delay in seconds
+        """
+        return random.uniform(0, min(self.baseDelay * 2 ** (attempt - 1), self.maxDelay))
+
+    def call(self, operation: Callable[[], T], errors: Tuple[Type[BaseException], ...], description: str,
+             logger: Logger, onRetry: Union[Callable[[], None], None] = None) -> T:
+        """
+        Call an operation until it succeeds, waiting a jittered delay after each failure with one of errors
+        :param operation: operation to call, such as opening a connection or sending commands
+        :param errors: errors after which the operation is called again
+        :param description: description of the operation for logs
+        :param logger: logger
+        :param onRetry: called before each new attempt
+        :return: result of the operation
+        :raise: error of the last attempt once maxAttempts attempts failed, other errors right away
+        """
+        for attempt in itertools.count(1):
+            try:
+                return operation()
+            except errors as exc:
+                if attempt >= self.maxAttempts:
+                    raise
+                delay: float = self.getDelay(attempt)
+                logger.warning("%s failed (attempt %s of %s): %s, retrying in %.2f s",
+                               description, attempt, self.maxAttempts, exc, delay)
+                if onRetry is not None:
+                    onRetry()
+                time.sleep(delay)
+
+
+def createRedisPool(kvsConfig: dict) -> BlockingConnectionPool:
+    """
+    Create the Redis connection pool of a process, shared by all its threads
+    The pool holds at most maxConnections connections, a caller waits up to poolTimeout seconds for a free one.
+    Connections idle for more than healthCheckInterval seconds are checked with a PING before being used again, so that
+    connections closed by the server or by a network device are replaced before a command is lost on them
+    :param kvsConfig: kvs section of the configuration
+    :return: connection pool
+    """
+    return BlockingConnectionPool(
+        max_connections=kvsConfig.get("maxConnections", DEFAULT_REDIS_MAX_CONNECTIONS),
+        timeout=kvsConfig.get("poolTimeout", DEFAULT_REDIS_POOL_TIMEOUT),
+        host=kvsConfig["host"],
+        port=kvsConfig["port"],
+        socket_timeout=kvsConfig.get("socketTimeout"),
+        socket_connect_timeout=kvsConfig.get("socketTimeout"),
+        socket_keepalive=True,
+        health_check_interval=kvsConfig.get("healthCheckInterval", DEFAULT_REDIS_HEALTH_CHECK_INTERVAL),
+    )
+
+
+def getPoolStats(pool: BlockingConnectionPool) -> Dict[str, int]:
+    """
+    Get the occupancy of a Redis connection pool
+    :param pool: connection pool
+    :return: maximum, open and in-use connections by metric name
+    """
+    openConnections: int = len(pool._connections)
+    # free slots of the pool hold None until a connection is opened in them
+    idleConnections: int = sum(1 for connection in list(pool.pool.queue) if connection is not None)
+    return {
+        "redis_pool_max_connections": pool.max_connections,
+        "redis_pool_connections": openConnections,
+        "redis_pool_connections_in_use": openConnections - idleConnections,
+    }
@@ -1,9 +1,198 @@
 JOB_STATUS_REDIS_KEY = "jobstatus"
 FILE_PATH_REDIS_KEY = "filepath"
 THUMBNAIL_PATH_REDIS_KEY = "thumbnailpath"
+ATTEMPTS_REDIS_KEY = "attempts"
+CLAIM_TOKEN_REDIS_KEY = "claimtoken"
+CLAIMED_STATUS_REDIS_KEY = "claimedstatus"
+CLAIMED_AT_REDIS_KEY = "claimedat"
+# job status transitions are appended to a stream trimmed to about DEFAULT_STATUS_STREAM_MAX_LENGTH entries
+DEFAULT_STATUS_STREAM = "jobstatus:events"
+DEFAULT_STATUS_STREAM_MAX_LENGTH = 100000
+# fields of the stream entries, also written by CLAIM_JOBS_SCRIPT
+STATUS_EVENT_JOB_FIELD = "job"
+STATUS_EVENT_STATUS_FIELD = "status"
+STATUS_MESSAGE_FORMAT = "%s:%s"
+CACHE_LRU_REDIS_KEY = "thumbnailcache:lru"
+CACHE_SIZES_REDIS_KEY = "thumbnailcache:sizes"
+CACHE_TOTAL_BYTES_REDIS_KEY = "thumbnailcache:bytes"
 
-ERROR_SAME_JOB_STATUS = "A problem occurred due to same status for current and next job. Aborting"
+ERROR_JOB_NOT_CLAIMED = "Job does not exist or is already being processed by another worker. Skipping"
 ERROR_PROCESSING_IMAGE = "A problem occurred during processing of image file with Image Magick."
+ERROR_MALFORMED_MESSAGE = "Message is malformed, rejecting it."
+ERROR_IMAGE_TOO_LARGE = "Image has more pixels than the worker accepts:"
+ERROR_POISON_JOB = "Job was claimed more times than retries allow, dead-lettering it."
+ERROR_INVALID_RENDITION = "Rendition cannot be made:"
 
 THUMBNAIL_MAX_PIXEL = 100
+# renditions, configured or requested by messages, are at most DEFAULT_MAX_RENDITION_SIZE pixels wide and high
+DEFAULT_MAX_RENDITION_SIZE = 4096
+THUMBNAIL_DEFAULT_FORMAT = "jpeg"
+THUMBNAIL_FILE_EXTENSIONS = {"jpeg": ".jpg", "webp": ".webp", "png": ".png", "gif": ".gif", "avif": ".avif"}
+# formats of animated thumbnails, made from at most DEFAULT_ANIMATION_MAX_FRAMES frames when animation is enabled
+ANIMATED_THUMBNAIL_FORMATS = ("gif", "webp")
+DEFAULT_ANIMATION_MAX_FRAMES = 30
+# formats written only when the local ImageMagick has their delegate library
+OPTIONAL_THUMBNAIL_FORMATS = ("webp", "avif")
+# sharded thumbnail directories are named after SHARD_NAME_LENGTH hexadecimal characters of a hash per level
+SHARD_NAME_LENGTH = 2
+# files are on a local (or shared) file system by default, in an S3-compatible bucket with the s3 backend
+DEFAULT_STORAGE_BACKEND = "local"
+# S3 clients keep up to DEFAULT_S3_MAX_POOL_CONNECTIONS connections alive, input files are downloaded by ranges of
+# DEFAULT_S3_RANGE_SIZE bytes with DEFAULT_S3_RANGE_CONCURRENCY concurrent requests
+DEFAULT_S3_MAX_POOL_CONNECTIONS = 10
+DEFAULT_S3_RANGE_SIZE = 8 * 1024 * 1024
+DEFAULT_S3_RANGE_CONCURRENCY = 4
+S3_DEFAULT_CONTENT_TYPE = "application/octet-stream"
+S3_MISSING_ERROR_CODES = ("404", "NoSuchKey", "NotFound")
+S3_TRANSIENT_ERROR_CODES = ("SlowDown", "Throttling", "RequestTimeout", "RequestTimeTooSkewed")
+# encoder settings by output format, overridden by App.worker.encoding.profiles
+DEFAULT_ENCODING_PROFILES = {
+    "jpeg": {"quality": 82, "progressive": True, "chromaSubsampling": "4:2:0"},
+    "webp": {"quality": 80, "options": {"webp:method": "4"}},
+    "avif": {"quality": 60},
+    "png": {"options": {"png:compression-level": "6"}},
+}
+JPEG_SAMPLING_FACTOR_OPTION = "jpeg:sampling-factor"
+PROGRESSIVE_INTERLACE_SCHEME = "plane"
+NO_INTERLACE_SCHEME = "no"
+# images with alpha up to this size in pixel are kept in PNG when their thumbnail path is a PNG file
+DEFAULT_PNG_FAST_PATH_SIZE = 256
+# decoder is asked for an image at least DECODE_HINT_FACTOR times bigger than the thumbnail to keep resize quality
+DECODE_HINT_FACTOR = 2
+JPEG_SIZE_HINT_OPTION = "jpeg:size"
+JPEG_FORMATS = ("JPEG", "JPG")
+# decoder pre-scale factors, from the biggest: libjpeg scales DCT decoding by 1/2, 1/4 or 1/8
+DECODE_PRE_SCALES = (8, 4, 2)
+# thumbnail fit modes: inside the box, covering the box then cropped, or at most the box area
+FIT_MODE_BOX = "box"
+FIT_MODE_COVER = "cover"
+FIT_MODE_AREA = "area"
+# streaming decode reads images in strips of about STREAM_STRIP_BYTES, used from DEFAULT_STREAM_MIN_PIXELS pixels
+STREAM_STRIP_BYTES = 16 * 1024 * 1024
+# PNG rows filtered with Average or Paeth are unfiltered along anti-diagonals by blocks of at least this many rows
+PNG_DIAGONAL_MIN_ROWS = 16
+DEFAULT_STREAM_MIN_PIXELS = 100000000
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+TIFF_SIGNATURES = (b"II*\x00", b"MM\x00*")
+DEFAULT_RESIZE_BACKEND = "wand"
+DEFAULT_RESIZE_FILTER = "lanczos"
+# the numpy resize backend keeps the weights of the RESIZE_WEIGHT_CACHE_SIZE most recent (input, output) sizes
+RESIZE_WEIGHT_CACHE_SIZE = 128
 EMPTY_STR = ""
+
+DEFAULT_PREFETCH_COUNT = 10
+DEFAULT_BATCH_SIZE = 1
+DEFAULT_BATCH_TIMEOUT = 0.5
+# a job stays claimed by a worker for DEFAULT_CLAIM_LEASE seconds, then another worker may claim it again
+DEFAULT_CLAIM_LEASE = 600
+# a message starting with this prefix carries a JSON array of jobs instead of a single job id
+BATCH_MESSAGE_PREFIX = "["
+DEFAULT_QUEUE_WEIGHT = 1
+# a job failing with a transient error at its n-th attempt waits min(baseDelay * 2 ** (n - 1), maxDelay) seconds in
+# a delay queue before going back to its queue, jobs failing DEFAULT_RETRY_MAX_ATTEMPTS times are dead-lettered
+DEFAULT_RETRY_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_BASE_DELAY = 1
+DEFAULT_RETRY_MAX_DELAY = 300
+# delay queues are named after their queue and their delay, so that changing delays never redeclares a queue
+RETRY_QUEUE_FORMAT = "%s.retry.%sms"
+DEAD_LETTER_QUEUE_SUFFIX = ".dead"
+RETRY_COUNT_HEADER = "x-retry-count"
+ERROR_HEADER = "x-error"
+# Redis connections are pooled per process, idle connections are checked with a PING before reuse. Lost Redis and
+# RabbitMQ connections are retried DEFAULT_RECONNECT_MAX_ATTEMPTS times with jittered exponential backoff
+DEFAULT_REDIS_MAX_CONNECTIONS = 16
+DEFAULT_REDIS_POOL_TIMEOUT = 5
+DEFAULT_REDIS_HEALTH_CHECK_INTERVAL = 30
+DEFAULT_RECONNECT_MAX_ATTEMPTS = 8
+DEFAULT_RECONNECT_BASE_DELAY = 0.1
+DEFAULT_RECONNECT_MAX_DELAY = 10
+
+BLOCKING_MODE = "blocking"
+ASYNC_MODE = "async"
+DEFAULT_MAX_IN_FLIGHT = 32
+DEFAULT_IO_POOL_SIZE = 8
+DEFAULT_CPU_POOL_SIZE = 4
+THREADED_MODE = "threaded"
+DEFAULT_RESIZE_THREADS = 4
+# OpenMP threads of ImageMagick operations, so that resize threads times ImageMagick threads fit in the cores
+DEFAULT_IMAGEMAGICK_THREADS = 1
+
+DEFAULT_SUPERVISOR_CHECK_INTERVAL = 5
+DEFAULT_RESTART_BACKOFF = 1
+DEFAULT_MAX_RESTART_BACKOFF = 60
+DEFAULT_STABLE_UPTIME = 60
+DEFAULT_MESSAGES_PER_WORKER = 50
+DEFAULT_DRAIN_TIMEOUT = 30
+# ImageMagick coders loaded before forking consumers on warm start, on top of the coders of the renditions
+WARM_START_FORMATS = ("jpeg", "png", "gif")
+
+DEFAULT_MAX_IMAGE_PIXELS = 250 * 1000 * 1000
+DEFAULT_PROCESS_PIXELS = 50 * 1000 * 1000
+DEFAULT_ADMISSION_TIMEOUT = 10
+DEFAULT_CONSTRAINED_MEMORY = 256 * 1024 * 1024
+
+REDIS_FETCH_STAGE = "redis_fetch"
+STATUS_UPDATE_STAGE = "status_update"
+DECODE_STAGE = "decode"
+RESIZE_STAGE = "resize"
+ENCODE_SAVE_STAGE = "encode_save"
+ACK_STAGE = "ack"
+METRICS_STAGES = (REDIS_FETCH_STAGE, STATUS_UPDATE_STAGE, DECODE_STAGE, RESIZE_STAGE, ENCODE_SAVE_STAGE, ACK_STAGE)
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_PATH = "/metrics"
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+CONNECTION_METRICS = {
+    "redis_pool_max_connections": "Maximum number of connections of the Redis pool",
+    "redis_pool_connections": "Open connections of the Redis pool",
+    "redis_pool_connections_in_use": "Connections of the Redis pool in use",
+    "redis_retries_total": "Redis commands sent again after a connection or timeout error",
+    "amqp_reconnects_total": "RabbitMQ reconnections after a lost or refused connection",
+}
+
+CACHE_DIR_NAME = ".cache"
+DEFAULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+
+LOG_FILE = "worker.log"
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# single record summing up a finished job, as key=value pairs
+JOB_LOG_FORMAT = "job=%s status=%s file=%s thumbnails=%s duration_ms=%.1f"
+
+# Atomically read job info and move every claimable job to PROCESSING (compare-and-set on job status)
+# KEYS: job ids, ARGV[1]: job status field, ARGV[2]: file path field, ARGV[3]: PROCESSING status value,
+# ARGV[4]: attempts field, incremented on every claim, ARGV[5]: claim token field, ARGV[6]: claimed status field,
+# ARGV[7]: claim token, unique to each claim, ARGV[8]: status event stream, ARGV[9]: maximum length of the stream,
+# ARGV[10]: status event channel (no event is sent for empty names), ARGV[11]: claimed at field,
+# ARGV[12]: claim lease in seconds, ARGV[13]: one character per job, "1" if its message was redelivered,
+# ARGV[14]: current time in seconds
+# returns for each job its previous job status, its file path and its number of attempts if claimed
+# Claimed jobs keep the token and their previous status, so that a claim sent again after a lost reply claims the same
+# jobs again instead of seeing them PROCESSING. A PROCESSING job is claimed again once its lease expired or when its
+# message was redelivered: the consumer which received it died, lost its connection or gave it back unprocessed
+CLAIM_JOBS_SCRIPT = """
+local jobs = {}
+for i, jobId in ipairs(KEYS) do
+    local info = redis.call('HMGET', jobId, ARGV[1], ARGV[2], ARGV[4], ARGV[5], ARGV[6], ARGV[11])
+    local status = info[1]
+    local attempts = false
+    if status == ARGV[3] and info[4] == ARGV[7] then
+        status = info[5]
+        attempts = tonumber(info[3])
+    elseif status and (status ~= ARGV[3] or string.sub(ARGV[13], i, i) == '1'
+            or tonumber(info[6] or 0) + tonumber(ARGV[12]) <= tonumber(ARGV[14])) then
+        if status == ARGV[3] then
+            status = info[5] or status
+        end
+        redis.call('HMSET', jobId, ARGV[1], ARGV[3], ARGV[5], ARGV[7], ARGV[6], status, ARGV[11], ARGV[14])
+        attempts = redis.call('HINCRBY', jobId, ARGV[4], 1)
+        if ARGV[8] ~= '' then
+            redis.call('XADD', ARGV[8], 'MAXLEN', '~', ARGV[9], '*', 'job', jobId, 'status', ARGV[3])
+        end
+        if ARGV[10] ~= '' then
+            redis.call('PUBLISH', ARGV[10], jobId .. ':' .. ARGV[3])
+        end
+    end
+    jobs[i] = {status, info[2], attempts}
+end
+return jobs
+"""
@@ -0,0 +1,110 @@
+from logging import Logger
+from typing import NamedTuple, Dict, Union
+from wand.image import Image
+from wand.version import formats
+from constants import DEFAULT_ENCODING_PROFILES, OPTIONAL_THUMBNAIL_FORMATS, THUMBNAIL_DEFAULT_FORMAT, \
+    JPEG_SAMPLING_FACTOR_OPTION, PROGRESSIVE_INTERLACE_SCHEME, NO_INTERLACE_SCHEME, DEFAULT_PNG_FAST_PATH_SIZE
+from rendition import Rendition
+
+
+class EncodingProfile(NamedTuple):
+    """
+    Encoder settings of an output format: quality (None for the ImageMagick default), progressive (interlaced) output,
+    chroma subsampling such as 4:2:0 (None for the default), removal of metadata and ICC profiles, and extra
+    ImageMagick coder options such as webp:method
+    """
+    quality: Union[int, None] = None
+    progressive: bool = False
+    chromaSubsampling: Union[str, None] = None
+    strip: bool = True
+    options: Dict[str, str] = {}
+
+
+def parseEncodingProfiles(encodingConfig: dict) -> Dict[str, EncodingProfile]:
+    """
+    Read encoding profiles from encoding configuration, on top of the default profiles
+    :param encodingConfig: encoding section of the worker configuration
+    :return: encoding profile by lower case format
+    """
+    profileConfigs: Dict[str, dict] = dict(DEFAULT_ENCODING_PROFILES)
+    for imageFormat, profileConfig in encodingConfig.get("profiles", {}).items():
+        profileConfigs[imageFormat.lower()] = dict(profileConfigs.get(imageFormat.lower(), {}), **profileConfig)
+    return {
+        imageFormat: EncodingProfile(
+            profileConfig.get("quality"), profileConfig.get("progressive", False),
+            profileConfig.get("chromaSubsampling"), profileConfig.get("strip", True),
+            {key: str(value) for key, value in profileConfig.get("options", {}).items()},
+        )
+        for imageFormat, profileConfig in profileConfigs.items()
+    }
+
+
+class Encoder:
+    """
+    Applies encoding profiles to thumbnails before they are saved
+    WebP and AVIF renditions fall back to JPEG when the local ImageMagick cannot write them. Small images with an
+    alpha channel whose thumbnail path is a PNG file are kept in PNG rather than flattened into JPEG
+    """
+
+    def __init__(self, encodingConfig: dict, logger: Logger):
+        self.profiles: Dict[str, EncodingProfile] = parseEncodingProfiles(encodingConfig)
+        self.pngFastPathSize: int = encodingConfig.get("pngFastPathSize", DEFAULT_PNG_FAST_PATH_SIZE)
+        self.logger = logger
+        self.availableFormats: Dict[str, bool] = {}
+
+    def isAvailable(self, imageFormat: str) -> bool:
+        """
+        Check whether the local ImageMagick has a coder for an optional format
+        :param imageFormat: lower case format
+        :return: True if thumbnails can be written in this format
+        """
+        if imageFormat not in OPTIONAL_THUMBNAIL_FORMATS:
+            return True
+        if imageFormat not in self.availableFormats:
+            self.availableFormats[imageFormat] = bool(formats(imageFormat.upper()))
+            if not self.availableFormats[imageFormat]:
+                self.logger.warning("%s is not supported by ImageMagick, falling back to %s",
+                                    imageFormat, THUMBNAIL_DEFAULT_FORMAT)
+        return self.availableFormats[imageFormat]
+
+    def resolveRendition(self, rendition: Rendition) -> Rendition:
+        """
+        Replace the format of a rendition which cannot be written locally by the default format
+        :param rendition: requested rendition
+        :return: rendition which can be made
+        """
+        if self.isAvailable(rendition.format):
+            return rendition
+        return Rendition(rendition.size, THUMBNAIL_DEFAULT_FORMAT)
+
+    def chooseFormat(self, rendition: Rendition, img: Image, thumbnailPath: str) -> str:
+        """
+        Choose the output format of a thumbnail: PNG fast path for small images with alpha, rendition format otherwise
+        :param rendition: rendition of the thumbnail
+        :param img: resized image
+        :param thumbnailPath: path the thumbnail is saved to
+        :return: lower case output format
+        """
+        if img.alpha_channel and thumbnailPath.lower().endswith(".png") \
+                and max(img.width, img.height) <= self.pngFastPathSize:
+            return "png"
+        return rendition.format
+
+    def apply(self, img: Image, imageFormat: str):
+        """
+        Set output format and encoder settings of an image
+        Quality and interlacing are always set, since renditions are saved one after the other from the same image
+        :param img: image about to be saved
+        :param imageFormat: lower case output format
+        """
+        img.format = imageFormat
+        profile: EncodingProfile = self.profiles.get(imageFormat, EncodingProfile())
+        if profile.strip:
+            img.strip()
+        # 0 lets the coder pick its default quality
+        img.compression_quality = profile.quality or 0
+        img.interlace_scheme = PROGRESSIVE_INTERLACE_SCHEME if profile.progressive else NO_INTERLACE_SCHEME
+        if profile.chromaSubsampling is not None:
+            img.options[JPEG_SAMPLING_FACTOR_OPTION] = profile.chromaSubsampling
+        for key, value in profile.options.items():
+            img.options[key] = value
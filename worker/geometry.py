@@ -0,0 +1,68 @@
+from typing import NamedTuple
+from constants import FIT_MODE_BOX, FIT_MODE_COVER, FIT_MODE_AREA, DECODE_PRE_SCALES, DECODE_HINT_FACTOR
+
+FIT_MODES = (FIT_MODE_BOX, FIT_MODE_COVER, FIT_MODE_AREA)
+
+
+class Geometry(NamedTuple):
+    """
+    Thumbnail geometry: size the image is resized to, then size of the centered crop (same size when not cropped)
+    """
+    width: int
+    height: int
+    cropWidth: int
+    cropHeight: int
+
+
+def fitGeometry(width: int, height: int, size: int, mode: str = FIT_MODE_BOX) -> Geometry:
+    """
+    Compute in one step the aspect-preserving geometry of a thumbnail, images are never upscaled
+    - box: biggest size fitting in size x size
+    - cover: smallest size covering size x size, cropped to size x size around the center
+    - area: biggest size of at most size x size pixels
+    :param width: width of the image in pixel
+    :param height: height of the image in pixel
+    :param size: size of the thumbnail box in pixel
+    :param mode: fit mode among FIT_MODES
+    :return: geometry of the thumbnail
+    """
+    if mode == FIT_MODE_BOX:
+        scale: float = min(size / width, size / height)
+    elif mode == FIT_MODE_COVER:
+        scale = max(size / width, size / height)
+    elif mode == FIT_MODE_AREA:
+        scale = (size * size / (width * height)) ** 0.5
+    else:
+        raise ValueError("unknown fit mode: %s" % mode)
+    if scale >= 1:
+        targetWidth, targetHeight = width, height
+    else:
+        targetWidth, targetHeight = max(int(width * scale + 0.5), 1), max(int(height * scale + 0.5), 1)
+        if mode == FIT_MODE_BOX:
+            targetWidth, targetHeight = min(targetWidth, size), min(targetHeight, size)
+        elif mode == FIT_MODE_AREA:
+            # rounding must not go over the pixel count
+            while targetWidth * targetHeight > size * size:
+                if targetWidth * height > targetHeight * width:
+                    targetWidth -= 1
+                else:
+                    targetHeight -= 1
+    if mode == FIT_MODE_COVER:
+        return Geometry(targetWidth, targetHeight, min(targetWidth, size), min(targetHeight, size))
+    return Geometry(targetWidth, targetHeight, targetWidth, targetHeight)
+
+
+def preScaleFactor(width: int, height: int, geometry: Geometry) -> int:
+    """
+    Pick the biggest decoder pre-scale factor (1/2, 1/4 or 1/8) keeping the decoded image DECODE_HINT_FACTOR times
+    bigger than the resize target, so that the decoder does most of the downsampling
+    :param width: width of the image in pixel
+    :param height: height of the image in pixel
+    :param geometry: geometry of the biggest thumbnail
+    :return: denominator of the pre-scale factor, 1 if the image must be fully decoded
+    """
+    for factor in DECODE_PRE_SCALES:
+        if -(-width // factor) >= geometry.width * DECODE_HINT_FACTOR \
+                and -(-height // factor) >= geometry.height * DECODE_HINT_FACTOR:
+            return factor
+    return 1
@@ -1,39 +1,71 @@
 import pprint
 from yaml import YAMLError, safe_load
-from typing import Dict
-from logging import Logger, FileHandler, StreamHandler, Formatter, DEBUG, getLogger
+from typing import Dict, List, Union
+from logging import Logger, FileHandler, StreamHandler, Formatter, Handler, DEBUG, getLogger, getLevelName
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing import get_context
+from constants import LOG_FILE, LOG_FORMAT
 
+# listener writing records of every process to the real handlers when logging is asynchronous
+logListener: Union[QueueListener, None] = None
 
-def setupLogging() -> Logger:
+
+def setupLogging(loggingConfig: Union[dict, None] = None) -> Logger:
     """
     Setup logging for the worker
     There are two types of handlers: console handler and file handler.
     Both are used by the same logger object
+    In asynchronous mode, the logger only puts records into a multiprocessing queue. Consumer processes forked
+    afterwards inherit this queue, and a listener thread of the current process is the single writer of both handlers
+    :param loggingConfig: logging section of the configuration: level and async
     :return: main logger object
     """
+    global logListener
+    loggingConfig = loggingConfig or {}
+    stopLogging()
 
     logger: Logger = getLogger('worker')
-    logger.setLevel(DEBUG)
+    logger.setLevel(getLevelName(str(loggingConfig.get("level", "DEBUG")).upper()))
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
 
     # create file handler which logs even debug messages
-    fh: FileHandler = FileHandler('worker.log')
+    fh: FileHandler = FileHandler(LOG_FILE)
     fh.setLevel(DEBUG)
 
     # create console handler
     ch: StreamHandler = StreamHandler()
 
     # create formatter and add it to the handlers
-    formatter: Formatter = Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    formatter: Formatter = Formatter(LOG_FORMAT)
     fh.setFormatter(formatter)
     ch.setFormatter(formatter)
+    handlers: List[Handler] = [fh, ch]
+
+    if loggingConfig.get("async", False):
+        logQueue = get_context("fork").Queue(-1)
+        logListener = QueueListener(logQueue, *handlers, respect_handler_level=True)
+        logListener.start()
+        handlers = [QueueHandler(logQueue)]
 
     # add the handlers to the logger
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+    for handler in handlers:
+        logger.addHandler(handler)
 
     return logger
 
 
+def stopLogging():
+    """
+    Stop the listener of asynchronous logging, writing every record still in the queue
+    """
+    global logListener
+    if logListener is not None:
+        logListener.stop()
+        logListener = None
+
+
 def readConf(path: str, logger: Logger) -> Dict:
     """
     Read values from configuration YAML file
@@ -46,7 +78,7 @@ def readConf(path: str, logger: Logger) -> Dict:
     with open(path, 'r') as stream:
         try:
             config: Dict = safe_load(stream)
-            logger.info("config: \n%s" % pp.pformat(config))
+            logger.info("config: \n%s", pp.pformat(config))
             return config
         except YAMLError as exc:
             logger.critical(exc)
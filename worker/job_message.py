@@ -0,0 +1,76 @@
+import json
+from typing import NamedTuple, List, Union
+from rendition import Rendition, parseRenditions
+from constants import BATCH_MESSAGE_PREFIX
+
+
+class JobRequest(NamedTuple):
+    """
+    Job requested by a queue message: job id, the renditions asked for this job (None for configured renditions) and
+    whether the message was redelivered by RabbitMQ
+    """
+    jobId: str
+    renditions: Union[List[Rendition], None] = None
+    redelivered: bool = False
+
+
+def parseJobId(value) -> str:
+    """
+    Validate a job id of a queue message
+    :param value: job id as number or decimal string
+    :return: job id as decimal string
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, str)) or not str(value).strip().isdigit():
+        raise ValueError("invalid job id: %r" % (value,))
+    return str(value).strip()
+
+
+def parseJobMessage(body: bytes, encoding: str, redelivered: bool = False) -> List[JobRequest]:
+    """
+    Read the jobs requested by a queue message
+    The body is either a single decimal job id or a JSON array whose items are job ids or objects such as
+    {"id": 12, "renditions": [{"size": 256, "format": "webp"}]} overriding the configured renditions for that job
+    :param body: body of the message
+    :param encoding: encoding of the body
+    :param redelivered: whether the message was redelivered
+    :return: requested jobs in message order
+    :raise ValueError: if the body is malformed
+    """
+    text: str = body.decode(encoding).strip()
+    if not text.startswith(BATCH_MESSAGE_PREFIX):
+        return [JobRequest(parseJobId(text), redelivered=redelivered)]
+    items = json.loads(text)
+    if not isinstance(items, list):
+        raise ValueError("batch message must be a JSON array")
+    jobs: List[JobRequest] = []
+    for item in items:
+        if not isinstance(item, dict):
+            jobs.append(JobRequest(parseJobId(item), redelivered=redelivered))
+            continue
+        renditions: Union[List[Rendition], None] = None
+        if item.get("renditions"):
+            try:
+                renditions = parseRenditions(item)
+            except (KeyError, TypeError, AttributeError) as exc:
+                raise ValueError("invalid renditions of job %s: %s" % (item.get("id"), exc))
+        jobs.append(JobRequest(parseJobId(item.get("id")), renditions, redelivered))
+    return jobs
+
+
+def formatJobMessage(jobs: List[JobRequest], encoding: str) -> bytes:
+    """
+    Write the body of a queue message requesting jobs, the reverse of parseJobMessage
+    :param jobs: requested jobs
+    :param encoding: encoding of the body
+    :return: a single job id, or a JSON array if there are many jobs or renditions of a job
+    """
+    if len(jobs) == 1 and jobs[0].renditions is None:
+        return jobs[0].jobId.encode(encoding)
+    items: list = [
+        int(job.jobId) if job.renditions is None else {
+            "id": int(job.jobId),
+            "renditions": [{"size": rendition.size, "format": rendition.format} for rendition in job.renditions],
+        }
+        for job in jobs
+    ]
+    return json.dumps(items, separators=(",", ":")).encode(encoding)
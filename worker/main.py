@@ -1,16 +1,17 @@
-from concurrent.futures import ProcessPoolExecutor
 from typing import Dict, Hashable, Any
-from helper import readConf, setupLogging
+from helper import readConf, setupLogging, stopLogging
 from logging import Logger
-from worker import Worker
+from supervisor import Supervisor
+from constants import BLOCKING_MODE
 
 if __name__ == "__main__":
     logger: Logger = setupLogging()
     config: Dict[Hashable, Any] = readConf("/config/default.yaml", logger)
-    nbWorkers: int = config["App"]["worker"]["numberWorker"]
-    logger.info(" Starting pool executors with %s workers " % nbWorkers)
-    executor: ProcessPoolExecutor = ProcessPoolExecutor(max_workers=nbWorkers)
-    for workerId in range(0, nbWorkers):
-        logger.info("Submitting job for worker: %s" % workerId)
-        worker: Worker = Worker(config["App"], logger)
-        executor.submit(worker.processJob)
+    # reconfigure logging before forking consumers so that they inherit the configured handlers
+    logger = setupLogging(config["App"].get("logging", {}))
+    logger.info(" Starting supervisor of %s workers ", config["App"]["worker"].get("mode", BLOCKING_MODE))
+    supervisor: Supervisor = Supervisor(config["App"], logger)
+    try:
+        supervisor.run()
+    finally:
+        stopLogging()
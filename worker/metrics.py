@@ -0,0 +1,190 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import Logger
+from typing import Callable, Dict, List, Tuple, Union
+from constants import METRICS_BUCKETS, METRICS_STAGES, METRICS_PATH, METRICS_CONTENT_TYPE, CONNECTION_METRICS
+
+
+class Histogram:
+    """
+    Histogram of durations in seconds with fixed buckets, in the manner of Prometheus histograms
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = METRICS_BUCKETS):
+        self.buckets: Tuple[float, ...] = buckets
+        # last count is for observations over the biggest bucket (+Inf)
+        self.counts: List[int] = [0] * (len(buckets) + 1)
+        self.sum: float = 0.0
+
+    def observe(self, value: float):
+        """
+        Record one observation
+        :param value: observed value
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def merge(self, counts: List[int], total: float):
+        """
+        Add observations recorded by another histogram with the same buckets
+        :param counts: bucket counts of the other histogram
+        :param total: sum of the other histogram
+        """
+        self.counts = [count + otherCount for count, otherCount in zip(self.counts, counts)]
+        self.sum += total
+
+
+class WorkerMetrics:
+    """
+    Metrics of the worker hot path for one process: per-stage duration histograms, job counters and input
+    megapixels. They are served in Prometheus text format by an optional local HTTP endpoint
+    """
+
+    def __init__(self, metricsConfig: dict, logger: Logger):
+        self.enabled: bool = metricsConfig.get("enabled", False)
+        self.port: int = metricsConfig.get("port", 0)
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.histograms: Dict[str, Histogram] = {stage: Histogram() for stage in METRICS_STAGES}
+        self.jobCounts: Dict[str, int] = {"completed": 0, "errored": 0}
+        self.megapixels: float = 0.0
+        # time from the spawn of the consumer to consuming messages, set once it consumes
+        self.startupSeconds: Union[float, None] = None
+        # statistics of the Redis and RabbitMQ connections by metric name, read when rendering
+        self.connectionStats: Union[Callable[[], Dict[str, int]], None] = None
+        self.server: Union[ThreadingHTTPServer, None] = None
+
+    def observe(self, stage: str, seconds: float):
+        """
+        Record duration of a stage
+        :param stage: name of the stage
+        :param seconds: duration in seconds
+        """
+        with self.lock:
+            self.histograms[stage].observe(seconds)
+
+    @contextmanager
+    def time(self, stage: str):
+        """
+        Context manager recording the duration of the enclosed block into the histogram of a stage
+        :param stage: name of the stage
+        """
+        start: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def countJob(self, completed: bool):
+        """
+        Count one finished job
+        :param completed: True if the job is complete, False if it ended in error
+        """
+        with self.lock:
+            self.jobCounts["completed" if completed else "errored"] += 1
+
+    def addMegapixels(self, width: int, height: int):
+        """
+        Count pixels of a processed input image
+        :param width: width in pixel
+        :param height: height in pixel
+        """
+        with self.lock:
+            self.megapixels += width * height / 1e6
+
+    def flush(self) -> dict:
+        """
+        Export metrics recorded since the last flush and reset them
+        Used to forward metrics recorded inside pool processes to the process serving them
+        :return: snapshot of the metrics
+        """
+        with self.lock:
+            snapshot: dict = {
+                "histograms": {stage: (h.counts, h.sum) for stage, h in self.histograms.items()},
+                "jobCounts": self.jobCounts,
+                "megapixels": self.megapixels,
+            }
+            self.histograms = {stage: Histogram() for stage in METRICS_STAGES}
+            self.jobCounts = {"completed": 0, "errored": 0}
+            self.megapixels = 0.0
+        return snapshot
+
+    def merge(self, snapshot: dict):
+        """
+        Add metrics exported by flush
+        :param snapshot: snapshot of the metrics of another process
+        """
+        with self.lock:
+            for stage, (counts, total) in snapshot["histograms"].items():
+                self.histograms[stage].merge(counts, total)
+            for status, count in snapshot["jobCounts"].items():
+                self.jobCounts[status] += count
+            self.megapixels += snapshot["megapixels"]
+
+    def render(self) -> str:
+        """
+        Render metrics in Prometheus text exposition format
+        :return: metrics as text
+        """
+        lines: List[str] = [
+            "# HELP worker_stage_duration_seconds Duration of the stages of the worker hot path",
+            "# TYPE worker_stage_duration_seconds histogram",
+        ]
+        with self.lock:
+            for stage, histogram in self.histograms.items():
+                cumulative: int = 0
+                for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le: str = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append('worker_stage_duration_seconds_bucket{stage="%s",le="%s"} %s'
+                                 % (stage, le, cumulative))
+                lines.append('worker_stage_duration_seconds_sum{stage="%s"} %s' % (stage, histogram.sum))
+                lines.append('worker_stage_duration_seconds_count{stage="%s"} %s' % (stage, cumulative))
+            lines.append("# HELP worker_jobs_total Finished jobs by status")
+            lines.append("# TYPE worker_jobs_total counter")
+            for status, count in self.jobCounts.items():
+                lines.append('worker_jobs_total{status="%s"} %s' % (status, count))
+            lines.append("# HELP worker_input_megapixels_total Megapixels of processed input images")
+            lines.append("# TYPE worker_input_megapixels_total counter")
+            lines.append("worker_input_megapixels_total %s" % self.megapixels)
+            if self.startupSeconds is not None:
+                lines.append("# HELP worker_startup_seconds Time from the spawn of the consumer to consuming messages")
+                lines.append("# TYPE worker_startup_seconds gauge")
+                lines.append("worker_startup_seconds %s" % self.startupSeconds)
+            if self.connectionStats is not None:
+                for name, value in self.connectionStats().items():
+                    lines.append("# HELP worker_%s %s" % (name, CONNECTION_METRICS[name]))
+                    lines.append("# TYPE worker_%s %s" % (name, "counter" if name.endswith("_total") else "gauge"))
+                    lines.append("worker_%s %s" % (name, value))
+        return "\n".join(lines) + "\n"
+
+    def start(self, portOffset: int = 0):
+        """
+        Serve metrics on a local HTTP endpoint in a background thread if enabled
+        :param portOffset: offset added to the configured port, so that every process gets its own port
+        """
+        if not self.enabled:
+            return
+        metrics: WorkerMetrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != METRICS_PATH:
+                    self.send_error(404)
+                    return
+                body: bytes = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("", self.port + portOffset), MetricsHandler)
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+        self.logger.info("serving metrics on port: %s", self.server.server_address[1])
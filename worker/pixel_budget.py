@@ -0,0 +1,186 @@
+import threading
+import time
+from contextlib import contextmanager
+from logging import Logger
+from typing import Dict, Union
+from constants import DEFAULT_MAX_IMAGE_PIXELS, DEFAULT_PROCESS_PIXELS, DEFAULT_ADMISSION_TIMEOUT, \
+    DEFAULT_CONSTRAINED_MEMORY, ERROR_IMAGE_TOO_LARGE
+
+
+class ImageTooLargeError(ValueError):
+    """
+    Raised when an input image is over the maximum number of pixels accepted by the worker
+    """
+
+
+class HostPixelBudget:
+    """
+    Number of pixels decoded at the same time by every consumer process of the host
+    It lives in shared memory created by the supervisor before forking consumers, usage is tracked by consumer slot so
+    that the supervisor can give back the pixels held by a consumer which died
+    """
+
+    def __init__(self, hostPixels: int, slots: int, context):
+        self.hostPixels: int = hostPixels
+        self.condition = context.Condition()
+        # protected by the lock of condition
+        self.inUse = context.Array('q', slots, lock=False)
+        self.slot: int = 0
+
+    def acquire(self, pixels: int, timeout: float) -> bool:
+        """
+        Wait until pixels fit in the host budget and take them
+        An image bigger than the whole budget is admitted once nothing else is being decoded
+        :param pixels: number of decoded pixels
+        :param timeout: maximum waiting time in seconds
+        :return: True if pixels were taken, False on timeout
+        """
+        deadline: float = time.monotonic() + timeout
+        with self.condition:
+            while 0 < sum(self.inUse) and sum(self.inUse) + pixels > self.hostPixels:
+                remaining: float = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.inUse[self.slot] += pixels
+        return True
+
+    def release(self, pixels: int):
+        """
+        Give back pixels taken by acquire
+        :param pixels: number of decoded pixels
+        """
+        with self.condition:
+            self.inUse[self.slot] -= pixels
+            self.condition.notify_all()
+
+    def reset(self, slot: int):
+        """
+        Give back every pixel held by a consumer slot: used when its process died
+        :param slot: index of the consumer
+        """
+        with self.condition:
+            self.inUse[slot] = 0
+            self.condition.notify_all()
+
+
+# budget shared by the consumer processes of the host, created by the supervisor before forking them
+hostBudget: Union[HostPixelBudget, None] = None
+
+
+class PixelBudget:
+    """
+    Admission control of decoded pixels
+    Images over maxImagePixels are refused. Images which do not fit within admissionTimeout in the budget of the
+    process, shared by the images decoded at the same time by its threads, or in the host budget, are decoded on a
+    constrained path where ImageMagick keeps at most constrainedMemory bytes of pixel cache in memory and spills the
+    rest to disk
+    """
+
+    def __init__(self, budgetConfig: dict, logger: Logger):
+        self.enabled: bool = budgetConfig.get("enabled", False)
+        self.maxImagePixels: int = budgetConfig.get("maxImagePixels", DEFAULT_MAX_IMAGE_PIXELS)
+        self.processPixels: int = budgetConfig.get("processPixels", DEFAULT_PROCESS_PIXELS)
+        self.admissionTimeout: float = budgetConfig.get("admissionTimeout", DEFAULT_ADMISSION_TIMEOUT)
+        self.constrainedMemory: int = budgetConfig.get("constrainedMemory", DEFAULT_CONSTRAINED_MEMORY)
+        self.logger = logger
+        self.condition = threading.Condition()
+        # pixels admitted in the process and not released yet, protected by the lock of condition
+        self.inUse: int = 0
+        # ImageMagick limits are global to the process: concurrent constrained decodes share them
+        self.constrainedLock = threading.Lock()
+        self.constrainedDecodes: int = 0
+        self.previousLimits: Dict[str, int] = {}
+
+    @staticmethod
+    def estimatePixels(width: int, height: int, preScale: int) -> int:
+        """
+        Estimate the number of pixels of the decoded image
+        :param width: width in pixel read from the image header
+        :param height: height in pixel read from the image header
+        :param preScale: denominator of the decoder pre-scale factor, 1 if the image is fully decoded
+        :return: number of decoded pixels
+        """
+        return -(-width // preScale) * -(-height // preScale)
+
+    def acquire(self, pixels: int, deadline: float) -> bool:
+        """
+        Wait until pixels fit in the budget of the process and take them
+        An image bigger than the whole budget is admitted once nothing else is being decoded
+        :param pixels: number of decoded pixels
+        :param deadline: monotonic time after which waiting gives up
+        :return: True if pixels were taken, False on timeout
+        """
+        with self.condition:
+            while 0 < self.inUse and self.inUse + pixels > self.processPixels:
+                remaining: float = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.inUse += pixels
+        return True
+
+    def release(self, pixels: int):
+        """
+        Give back pixels taken by acquire
+        :param pixels: number of decoded pixels
+        """
+        with self.condition:
+            self.inUse -= pixels
+            self.condition.notify_all()
+
+    @contextmanager
+    def admit(self, pixels: int):
+        """
+        Context manager reserving pixels for the decode and the resize of an image, released once the image is freed
+        :param pixels: number of decoded pixels
+        :raise ImageTooLargeError: if the image is over maxImagePixels
+        """
+        if not self.enabled:
+            yield
+            return
+        if pixels > self.maxImagePixels:
+            raise ImageTooLargeError("%s %s > %s" % (ERROR_IMAGE_TOO_LARGE, pixels, self.maxImagePixels))
+        acquired: bool = False
+        if pixels <= self.processPixels:
+            deadline: float = time.monotonic() + self.admissionTimeout
+            acquired = self.acquire(pixels, deadline)
+            if acquired and hostBudget is not None \
+                    and not hostBudget.acquire(pixels, max(deadline - time.monotonic(), 0)):
+                self.release(pixels)
+                acquired = False
+        try:
+            if acquired:
+                yield
+            else:
+                self.logger.info("decoding %s pixels on the constrained path", pixels)
+                with self.limitResources():
+                    yield
+        finally:
+            if acquired:
+                self.release(pixels)
+                if hostBudget is not None:
+                    hostBudget.release(pixels)
+
+    @contextmanager
+    def limitResources(self):
+        """
+        Context manager limiting the memory ImageMagick may use for pixel cache, restoring previous limits afterwards
+        With threads, limits are set by the first constrained decode and restored once the last one is over
+        """
+        # imported on first use: the supervisor creates the host budget and must not load the ImageMagick libraries
+        from wand.resource import limits
+        with self.constrainedLock:
+            if self.constrainedDecodes == 0:
+                self.previousLimits = {resource: limits[resource] for resource in ("memory", "map")}
+                for resource in self.previousLimits:
+                    limits[resource] = self.constrainedMemory
+            self.constrainedDecodes += 1
+        try:
+            yield
+        finally:
+            with self.constrainedLock:
+                self.constrainedDecodes -= 1
+                if self.constrainedDecodes == 0:
+                    for resource, value in self.previousLimits.items():
+                        limits[resource] = value
@@ -0,0 +1,48 @@
+from typing import NamedTuple, List
+from constants import THUMBNAIL_PATH_REDIS_KEY, THUMBNAIL_MAX_PIXEL, THUMBNAIL_DEFAULT_FORMAT, THUMBNAIL_FILE_EXTENSIONS
+
+
+class Rendition(NamedTuple):
+    """
+    Thumbnail rendition: maximum width and height in pixel and output image format
+    """
+    size: int
+    format: str
+
+    @property
+    def redisKey(self) -> str:
+        """
+        Field of the job hash in Redis in which the path of this rendition is recorded
+        :return: redis field name such as thumbnailpath:128:webp
+        """
+        return "%s:%s:%s" % (THUMBNAIL_PATH_REDIS_KEY, self.size, self.format)
+
+
+def parseRenditions(workerConfig: dict) -> List[Rendition]:
+    """
+    Read thumbnail renditions from worker configuration
+    The first configured rendition is the primary one whose path is stored in thumbnailpath
+    :param workerConfig: worker section of the configuration
+    :return: list of renditions, defaults to a single jpeg thumbnail of THUMBNAIL_MAX_PIXEL
+    """
+    renditionConfigs: List[dict] = workerConfig.get("renditions") or [
+        {"size": THUMBNAIL_MAX_PIXEL, "format": THUMBNAIL_DEFAULT_FORMAT}
+    ]
+    return [
+        Rendition(int(renditionConfig["size"]), renditionConfig.get("format", THUMBNAIL_DEFAULT_FORMAT).lower())
+        for renditionConfig in renditionConfigs
+    ]
+
+
+def checkRenditions(renditions: List[Rendition], maxSize: int):
+    """
+    Check that renditions can be made: a size between 1 and maxSize pixels and a known thumbnail format
+    :param renditions: configured or requested renditions
+    :param maxSize: maximum width and height of a rendition in pixel
+    :raise ValueError: if a rendition cannot be made
+    """
+    for rendition in renditions:
+        if not 1 <= rendition.size <= maxSize:
+            raise ValueError("rendition size %s is not between 1 and %s" % (rendition.size, maxSize))
+        if rendition.format not in THUMBNAIL_FILE_EXTENSIONS:
+            raise ValueError("unknown rendition format: %s" % rendition.format)
@@ -0,0 +1,168 @@
+import math
+from functools import lru_cache
+from typing import Dict, Tuple
+from wand.image import Image
+from constants import DEFAULT_RESIZE_BACKEND, DEFAULT_RESIZE_FILTER, RESIZE_WEIGHT_CACHE_SIZE
+try:
+    import numpy
+except ImportError:
+    # the numpy backend is unavailable without numpy, the wand backend is always available
+    numpy = None
+
+
+class ResizeBackend:
+    """
+    Resizes decoded images in place
+    """
+    name: str = ""
+
+    def resize(self, img: Image, width: int, height: int):
+        """
+        Resize a decoded image in place
+        :param img: decoded image
+        :param width: target width in pixel
+        :param height: target height in pixel
+        """
+        raise NotImplementedError
+
+    def __repr__(self) -> str:
+        return self.name
+
+
+class WandResizeBackend(ResizeBackend):
+    """
+    ImageMagick resize with its default filter
+    """
+    name: str = "wand"
+
+    def resize(self, img: Image, width: int, height: int):
+        img.resize(width, height)
+
+
+def boxWeights(positions, centers, scale: float):
+    """
+    Area averaging weights: overlap of each input pixel with the footprint of the output pixel
+    :param positions: left edges of input pixels, array of shape (outputSize, taps)
+    :param centers: centers of output pixels in input coordinates, array of shape (outputSize, 1)
+    :param scale: input size / output size
+    :return: weights of shape (outputSize, taps)
+    """
+    halfWidth: float = max(scale, 1.0) / 2
+    return numpy.clip(numpy.minimum(positions + 1, centers + halfWidth) - numpy.maximum(positions, centers - halfWidth),
+                      0, None)
+
+
+def lanczosWeights(positions, centers, scale: float):
+    """
+    Lanczos 3 weights, the kernel is stretched by the scale when downsampling
+    :param positions: left edges of input pixels, array of shape (outputSize, taps)
+    :param centers: centers of output pixels in input coordinates, array of shape (outputSize, 1)
+    :param scale: input size / output size
+    :return: weights of shape (outputSize, taps)
+    """
+    distances = (positions + 0.5 - centers) / max(scale, 1.0)
+    return numpy.where(numpy.abs(distances) < 3, numpy.sinc(distances) * numpy.sinc(distances / 3), 0)
+
+
+# filter name: weight function and support radius in output pixels
+RESIZE_FILTERS: Dict[str, Tuple] = {
+    "box": (boxWeights, 0.5),
+    "lanczos": (lanczosWeights, 3.0),
+}
+
+
+class NumpyResizeBackend(ResizeBackend):
+    """
+    Separable resampling vectorized with numpy: each axis is resized by a weighted sum over a fixed number of taps,
+    every tap being a single array operation over all rows (or columns) and channels at once.
+    Arrays may hold a stack of same-size images, resized in one call
+    """
+    name: str = "numpy"
+
+    def __init__(self, resizeFilter: str):
+        if resizeFilter not in RESIZE_FILTERS:
+            raise ValueError("unknown resize filter: %s" % resizeFilter)
+        self.resizeFilter: str = resizeFilter
+        # thumbnails of inputs of many sizes need many weights: only the most recently used ones are kept
+        self.getWeights = lru_cache(maxsize=RESIZE_WEIGHT_CACHE_SIZE)(self.computeWeights)
+
+    def __repr__(self) -> str:
+        return "%s:%s" % (self.name, self.resizeFilter)
+
+    def computeWeights(self, inputSize: int, outputSize: int) -> Tuple:
+        """
+        Compute the input pixel indexes and the normalized weights of every output pixel along one axis, cached by
+        getWeights
+        Input pixels outside the image are clamped to the edge
+        :param inputSize: size of the axis before resizing
+        :param outputSize: size of the axis after resizing
+        :return: indexes and weights, both of shape (outputSize, taps)
+        """
+        weightFunction, radius = RESIZE_FILTERS[self.resizeFilter]
+        scale: float = inputSize / outputSize
+        support: float = radius * max(scale, 1.0)
+        centers = ((numpy.arange(outputSize) + 0.5) * scale)[:, numpy.newaxis]
+        positions = numpy.floor(centers - support) + numpy.arange(math.ceil(2 * support) + 1)
+        weights = weightFunction(positions, centers, scale)
+        weights /= weights.sum(axis=1, keepdims=True)
+        indexes = numpy.clip(positions, 0, inputSize - 1).astype(numpy.intp)
+        return indexes, weights.astype(numpy.float32)
+
+    def resizeAxis(self, pixels, axis: int, outputSize: int):
+        """
+        Resize float32 pixels along one axis
+        :param pixels: array of shape (..., height, width, channels)
+        :param axis: -3 for height, -2 for width
+        :param outputSize: size of the axis after resizing
+        :return: resized array
+        """
+        indexes, weights = self.getWeights(pixels.shape[axis], outputSize)
+        broadcastShape: Tuple[int, ...] = (outputSize,) + (1,) * (-axis - 1)
+        resized = None
+        for tap in range(indexes.shape[1]):
+            contribution = numpy.take(pixels, indexes[:, tap], axis=axis) * weights[:, tap].reshape(broadcastShape)
+            resized = contribution if resized is None else resized + contribution
+        return resized
+
+    def resizeArray(self, pixels, width: int, height: int):
+        """
+        Resize 8 bit pixels of one image, or of a stack of same-size images
+        :param pixels: array of shape (height, width, channels) or (images, height, width, channels) of uint8
+        :param width: target width in pixel
+        :param height: target height in pixel
+        :return: resized array of uint8
+        """
+        resized = pixels.astype(numpy.float32)
+        if resized.shape[-3] != height:
+            resized = self.resizeAxis(resized, -3, height)
+        if resized.shape[-2] != width:
+            resized = self.resizeAxis(resized, -2, width)
+        return numpy.clip(numpy.rint(resized), 0, 255).astype(numpy.uint8)
+
+    def resize(self, img: Image, width: int, height: int):
+        channelMap: str = "RGBA" if img.alpha_channel else "RGB"
+        img.depth = 8
+        pixels = numpy.frombuffer(img.make_blob(channelMap), dtype=numpy.uint8).reshape(
+            img.height, img.width, len(channelMap)
+        )
+        resized = self.resizeArray(pixels, width, height)
+        # point sampling only sets the new geometry cheaply, every pixel is then overwritten
+        img.sample(width, height)
+        img.import_pixels(width=width, height=height, channel_map=channelMap, storage="char", data=resized.tobytes())
+
+
+def createResizeBackend(resizeConfig: dict) -> ResizeBackend:
+    """
+    Create the resize backend selected in configuration
+    :param resizeConfig: resize section of the worker configuration
+    :return: resize backend
+    :raise ValueError: if the backend or the filter is unknown, or if numpy is not installed for the numpy backend
+    """
+    backendName: str = resizeConfig.get("backend", DEFAULT_RESIZE_BACKEND)
+    if backendName == WandResizeBackend.name:
+        return WandResizeBackend()
+    if backendName == NumpyResizeBackend.name:
+        if numpy is None:
+            raise ValueError("numpy resize backend requires numpy")
+        return NumpyResizeBackend(resizeConfig.get("filter", DEFAULT_RESIZE_FILTER))
+    raise ValueError("unknown resize backend: %s" % backendName)
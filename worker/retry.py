@@ -0,0 +1,120 @@
+import errno
+from logging import Logger
+from pika import BasicProperties
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from typing import Dict, List, Set, Union
+from constants import DEFAULT_RETRY_MAX_ATTEMPTS, DEFAULT_RETRY_BASE_DELAY, DEFAULT_RETRY_MAX_DELAY, \
+    RETRY_QUEUE_FORMAT, DEAD_LETTER_QUEUE_SUFFIX, RETRY_COUNT_HEADER, ERROR_HEADER
+from job_message import JobRequest, formatJobMessage
+
+# I/O errors worth retrying: full or failing disks, stale network file handles, exhausted descriptors
+TRANSIENT_ERRNOS = (errno.EIO, errno.ENOSPC, errno.ESTALE, errno.EAGAIN, errno.EMFILE, errno.ENFILE, errno.ENOMEM)
+
+
+class TransientError(Exception):
+    """
+    Raised when processing a job failed for a reason which may go away, such as an unreachable storage server or
+    exhausted resources: the job may succeed if it is retried later
+    """
+
+
+def isTransient(exc: BaseException) -> bool:
+    """
+    Classify an error raised while processing a job
+    Connection, timeout and resource errors (Wand resource limit errors are MemoryError) are transient. Missing,
+    unreadable or corrupt input files are permanent, like any other error
+    :param exc: error raised while processing a job
+    :return: True if retrying the job may succeed
+    """
+    if isinstance(exc, (TransientError, ConnectionError, TimeoutError, MemoryError, RedisConnectionError,
+                        RedisTimeoutError)):
+        return True
+    # ImageMagick read errors are OSError without errno
+    return isinstance(exc, OSError) and exc.errno in TRANSIENT_ERRNOS
+
+
+class RetryPolicy:
+    """
+    Bounded retries of jobs failing with transient errors, with exponential backoff through delay queues
+    A job failing at its n-th attempt is published into a delay queue of its queue whose messages expire after
+    min(baseDelay * 2 ** (n - 1), maxDelay) seconds and are then dead-lettered back to the queue by RabbitMQ.
+    Jobs failing maxAttempts times, or claimed more than maxAttempts times (poison messages), are published into the
+    dead-letter queue with the reason of their failure
+    """
+
+    def __init__(self, retryConfig: dict, queueName: str, encoding: str, logger: Logger):
+        self.enabled: bool = retryConfig.get("enabled", False)
+        self.maxAttempts: int = max(retryConfig.get("maxAttempts", DEFAULT_RETRY_MAX_ATTEMPTS), 1)
+        self.baseDelay: float = retryConfig.get("baseDelay", DEFAULT_RETRY_BASE_DELAY)
+        self.maxDelay: float = retryConfig.get("maxDelay", DEFAULT_RETRY_MAX_DELAY)
+        self.deadLetterQueue: str = retryConfig.get("deadLetterQueue", queueName + DEAD_LETTER_QUEUE_SUFFIX)
+        self.encoding = encoding
+        self.logger = logger
+        self.declaredQueues: Set[str] = set()
+
+    def getDelay(self, attempt: int) -> float:
+        """
+        Get the backoff delay after a failed attempt
+        :param attempt: number of the failed attempt, from 1
+        :return: delay in seconds
+        """
+        return min(self.baseDelay * 2 ** (attempt - 1), self.maxDelay)
+
+    def canRetry(self, attempts: int) -> bool:
+        """
+        Check whether a failed job is retried
+        :param attempts: number of attempts of the job so far
+        :return: True if the job is retried, False if it is dead-lettered
+        """
+        return attempts < self.maxAttempts
+
+    def isPoison(self, attempts: int) -> bool:
+        """
+        Check whether a claimed job has been claimed more times than retries allow, such as a job which kills the
+        consumer processing it or which is published again and again
+        :param attempts: number of attempts of the job, including this one
+        :return: True if the job must not be processed
+        """
+        return self.enabled and attempts > self.maxAttempts
+
+    def declareQueue(self, channel, queueName: str, arguments: Union[Dict[str, object], None] = None):
+        """
+        Declare a durable queue once per consumer
+        :param channel: channel used to publish
+        :param queueName: name of the queue
+        :param arguments: queue arguments
+        """
+        if queueName not in self.declaredQueues:
+            channel.queue_declare(queueName, durable=True, arguments=arguments)
+            self.declaredQueues.add(queueName)
+
+    def publishRetry(self, channel, queueName: str, jobs: List[JobRequest], attempt: int):
+        """
+        Publish jobs which failed at the same attempt into the delay queue sending them back to their queue
+        :param channel: channel used to publish
+        :param queueName: queue the jobs go back to
+        :param jobs: failed jobs
+        :param attempt: number of the failed attempt, from 1
+        """
+        delayMs: int = int(self.getDelay(attempt) * 1000)
+        retryQueue: str = RETRY_QUEUE_FORMAT % (queueName, delayMs)
+        self.declareQueue(channel, retryQueue, {
+            "x-message-ttl": delayMs, "x-dead-letter-exchange": "", "x-dead-letter-routing-key": queueName,
+        })
+        self.logger.info("retrying jobs %s of queue %s in %s ms", [job.jobId for job in jobs], queueName, delayMs)
+        channel.basic_publish("", retryQueue, formatJobMessage(jobs, self.encoding),
+                              BasicProperties(delivery_mode=2, headers={RETRY_COUNT_HEADER: attempt}))
+
+    def publishDeadLetter(self, channel, job: JobRequest, attempts: int, reason: str):
+        """
+        Publish a job which will not be retried into the dead-letter queue
+        :param channel: channel used to publish
+        :param job: failed job
+        :param attempts: number of attempts of the job
+        :param reason: reason of the last failure
+        """
+        self.declareQueue(channel, self.deadLetterQueue)
+        self.logger.error("dead-lettering job %s after %s attempts: %s", job.jobId, attempts, reason)
+        channel.basic_publish("", self.deadLetterQueue, formatJobMessage([job], self.encoding),
+                              BasicProperties(delivery_mode=2, headers={RETRY_COUNT_HEADER: attempts,
+                                                                        ERROR_HEADER: reason}))
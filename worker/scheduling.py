@@ -0,0 +1,103 @@
+from collections import deque
+from typing import NamedTuple, List, Dict, Deque, Tuple, Union, Any
+from constants import DEFAULT_QUEUE_WEIGHT
+
+
+class QueueClass(NamedTuple):
+    """
+    Queue consumed by the worker: name, scheduling weight and biggest input file size routed to it (None for any size)
+    """
+    name: str
+    weight: int
+    maxFileSize: Union[int, None] = None
+
+
+def parseQueueClasses(queueConfig: dict) -> List[QueueClass]:
+    """
+    Read consumed queues from queue configuration
+    :param queueConfig: queue section of the configuration
+    :return: list of queue classes, defaults to the single queueName queue
+    """
+    classConfigs: List[dict] = queueConfig.get("queues") or [{"name": queueConfig["queueName"]}]
+    return [
+        QueueClass(classConfig["name"], max(int(classConfig.get("weight", DEFAULT_QUEUE_WEIGHT)), 1),
+                   classConfig.get("maxFileSize"))
+        for classConfig in classConfigs
+    ]
+
+
+def classifyFileSize(queueClasses: List[QueueClass], fileSize: Union[int, None]) -> QueueClass:
+    """
+    Find the queue of a job from the size of its input file
+    :param queueClasses: queue classes in configuration order
+    :param fileSize: size of the input file in bytes, None if unknown
+    :return: first queue class accepting the size, last one if none does or if the size is unknown
+    """
+    if fileSize is not None:
+        for queueClass in queueClasses:
+            if queueClass.maxFileSize is None or fileSize <= queueClass.maxFileSize:
+                return queueClass
+    return queueClasses[-1]
+
+
+def splitPrefetchCount(queueClasses: List[QueueClass], prefetchCount: int) -> Dict[str, int]:
+    """
+    Share a prefetch window between queues according to their weight, so that one queue cannot take every slot
+    :param queueClasses: queue classes
+    :param prefetchCount: total number of unacknowledged messages
+    :return: prefetch count by queue name, at least 1 for each queue
+    """
+    totalWeight: int = sum(queueClass.weight for queueClass in queueClasses)
+    return {
+        queueClass.name: max(round(prefetchCount * queueClass.weight / totalWeight), 1) for queueClass in queueClasses
+    }
+
+
+class WeightedScheduler:
+    """
+    Smooth weighted round robin over per-queue buffers of delivered messages
+    Every non-empty queue is served in proportion to its weight and in an interleaved order, so a backlog in a heavy
+    queue cannot starve the others
+    """
+
+    def __init__(self, queueClasses: List[QueueClass]):
+        self.weights: Dict[str, int] = {queueClass.name: queueClass.weight for queueClass in queueClasses}
+        self.currentWeights: Dict[str, int] = {name: 0 for name in self.weights}
+        self.buffers: Dict[str, Deque[Any]] = {name: deque() for name in self.weights}
+
+    def __len__(self) -> int:
+        return sum(len(buffer) for buffer in self.buffers.values())
+
+    def push(self, name: str, item: Any):
+        """
+        Buffer an item of a queue
+        :param name: name of the queue
+        :param item: buffered item
+        """
+        self.buffers[name].append(item)
+
+    def pop(self) -> Union[Tuple[str, Any], None]:
+        """
+        Take the next item to serve
+        :return: name of the queue and item, None if every buffer is empty
+        """
+        candidates: List[str] = [name for name, buffer in self.buffers.items() if buffer]
+        if not candidates:
+            return None
+        totalWeight: int = 0
+        for name in candidates:
+            self.currentWeights[name] += self.weights[name]
+            totalWeight += self.weights[name]
+        chosen: str = max(candidates, key=lambda name: self.currentWeights[name])
+        self.currentWeights[chosen] -= totalWeight
+        return chosen, self.buffers[chosen].popleft()
+
+    def drain(self) -> List[Any]:
+        """
+        Take every buffered item without scheduling
+        :return: buffered items
+        """
+        items: List[Any] = [item for buffer in self.buffers.values() for item in buffer]
+        for buffer in self.buffers.values():
+            buffer.clear()
+        return items
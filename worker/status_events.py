@@ -0,0 +1,43 @@
+from typing import List, Union
+from constants import DEFAULT_STATUS_STREAM, DEFAULT_STATUS_STREAM_MAX_LENGTH, STATUS_EVENT_JOB_FIELD, \
+    STATUS_EVENT_STATUS_FIELD, STATUS_MESSAGE_FORMAT
+from job_status_enum import JobStatusEnum
+
+
+class StatusEvents:
+    """
+    Notifications of job status transitions, so that clients waiting for a job can be woken up instead of polling
+    Every transition is appended to a Redis stream capped at about maxLength entries, as an entry with the job id and
+    the status value, and optionally published as "<job id>:<status value>" on a pub/sub channel. Events are sent in
+    the same round trip as the status update: by the claim script for PROCESSING, by the status pipeline otherwise
+    """
+
+    def __init__(self, eventsConfig: dict):
+        self.enabled: bool = eventsConfig.get("enabled", False)
+        self.stream: str = eventsConfig.get("stream", DEFAULT_STATUS_STREAM)
+        self.maxLength: int = eventsConfig.get("maxLength", DEFAULT_STATUS_STREAM_MAX_LENGTH)
+        self.channel: Union[str, None] = eventsConfig.get("channel")
+
+    def add(self, pipeline, jobId: str, status: JobStatusEnum):
+        """
+        Queue the event of a status transition into a pipeline
+        :param pipeline: pipeline updating the job status
+        :param jobId: id of the job
+        :param status: new status of the job
+        """
+        if not self.enabled:
+            return
+        # trimming is approximate, so that Redis only drops whole nodes of the stream
+        pipeline.xadd(self.stream, {STATUS_EVENT_JOB_FIELD: jobId, STATUS_EVENT_STATUS_FIELD: status.value},
+                      maxlen=self.maxLength, approximate=True)
+        if self.channel:
+            pipeline.publish(self.channel, STATUS_MESSAGE_FORMAT % (jobId, status.value))
+
+    def getScriptArgs(self) -> List[Union[str, int]]:
+        """
+        Get the arguments of the claim script sending the events of claimed jobs
+        :return: stream, maximum length and channel, empty names when events are disabled or not published
+        """
+        if not self.enabled:
+            return ["", 0, ""]
+        return [self.stream, self.maxLength, self.channel or ""]
@@ -0,0 +1,319 @@
+import errno
+import io
+import mimetypes
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from hashlib import blake2b
+from logging import Logger
+from typing import Iterable, Iterator, List, Set, Tuple, Union
+from constants import SHARD_NAME_LENGTH, DEFAULT_STORAGE_BACKEND, DEFAULT_S3_MAX_POOL_CONNECTIONS, \
+    DEFAULT_S3_RANGE_SIZE, DEFAULT_S3_RANGE_CONCURRENCY, S3_DEFAULT_CONTENT_TYPE, HASH_CHUNK_SIZE, \
+    S3_MISSING_ERROR_CODES, S3_TRANSIENT_ERROR_CODES
+from retry import TransientError
+try:
+    import boto3
+    from boto3.exceptions import S3UploadFailedError
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
+    from botocore.exceptions import BotoCoreError, ClientError
+except ImportError:
+    # the s3 backend is unavailable without boto3, the local backend is always available
+    boto3 = None
+
+
+class Storage:
+    """
+    Where input images are read from and thumbnails are written to
+    Thumbnail paths are the same whatever the backend, with shardDepth > 0 thumbnails are spread over levels of
+    subdirectories named after a hash of the input file name
+    """
+    name: str = ""
+
+    def __init__(self, fileStorageConfig: dict, logger: Logger):
+        self.thumbnailDir: str = fileStorageConfig["thumbnailPath"]
+        self.shardDepth: int = fileStorageConfig.get("shardDepth", 0)
+        self.logger = logger
+
+    def getThumbnailDir(self, filename: str) -> str:
+        """
+        Get the directory of the thumbnails of an input file
+        :param filename: input file name
+        :return: directory path ending with a separator, such as /img/thumbnail/3f/a0/
+        """
+        if self.shardDepth <= 0:
+            return self.thumbnailDir
+        digest: str = blake2b(filename.encode("utf-8"), digest_size=16).hexdigest()
+        shards: List[str] = [
+            digest[level * SHARD_NAME_LENGTH:(level + 1) * SHARD_NAME_LENGTH] for level in range(self.shardDepth)
+        ]
+        return os.path.join(self.thumbnailDir, *shards) + os.sep
+
+    def fetch(self, filePath: str):
+        """
+        Context manager giving a local copy of an input file, removed on exit
+        :param filePath: input file path
+        :return: context manager of the local file path
+        """
+        raise NotImplementedError
+
+    def getSize(self, filePath: str) -> Union[int, None]:
+        """
+        Get the size of an input file
+        :param filePath: input file path
+        :return: size in bytes, None if the file cannot be read
+        """
+        raise NotImplementedError
+
+    def write(self, path: str, data: bytes):
+        """
+        Write a thumbnail atomically: readers see either the previous file or the complete new one
+        :param path: thumbnail path
+        :param data: thumbnail content
+        """
+        raise NotImplementedError
+
+    def sync(self, paths: Iterable[str]):
+        """
+        Make written thumbnails durable before their jobs are marked as complete
+        :param paths: paths of the written thumbnails
+        """
+        raise NotImplementedError
+
+
+class LocalStorage(Storage):
+    """
+    Files on a local (or shared) file system
+    Files are written through a temporary file renamed over the final path, so that readers never see a partially
+    written thumbnail. When fsync is enabled, written files and their directories are flushed to disk together by
+    sync (group commit) before job statuses are updated and messages are acknowledged
+    """
+    name: str = "local"
+
+    def __init__(self, fileStorageConfig: dict, logger: Logger):
+        super().__init__(fileStorageConfig, logger)
+        self.fsync: bool = fileStorageConfig.get("fsync", False)
+
+    @contextmanager
+    def fetch(self, filePath: str) -> Iterator[str]:
+        # input files are read in place
+        yield filePath
+
+    def getSize(self, filePath: str) -> Union[int, None]:
+        try:
+            return os.path.getsize(filePath)
+        except OSError:
+            return None
+
+    def write(self, path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # unique to the thread, threads of a process may write the same thumbnail
+        tmpPath: str = "%s.%s.%s.tmp" % (path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmpPath, "wb") as stream:
+                stream.write(data)
+            os.replace(tmpPath, path)
+        except OSError:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+    def sync(self, paths: Iterable[str]):
+        """
+        Flush written files, then their directories, to disk in a single pass
+        A file which cannot be flushed is logged: its job is not redone, but the file may be lost on power failure
+        :param paths: paths of the written files
+        """
+        if not self.fsync:
+            return
+        directories: Set[str] = set()
+        for path in set(paths):
+            self.syncPath(path)
+            directories.add(os.path.dirname(path))
+        # renames are durable once the directory entries are flushed
+        for directory in directories:
+            self.syncPath(directory)
+
+    def syncPath(self, path: str):
+        """
+        Flush a file or a directory to disk
+        :param path: file or directory path
+        """
+        try:
+            fd: int = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError as exc:
+            self.logger.error("cannot flush %s to disk: %s", path, exc)
+
+
+class S3Storage(Storage):
+    """
+    Objects in a bucket of an S3-compatible server (AWS S3, MinIO, ...), so that workers can run on many hosts
+    File paths map to object keys without their leading separator: /img/thumbnail/a.jpg is the key img/thumbnail/a.jpg.
+    A single client per process keeps a pool of keep-alive connections. Input files are downloaded into a temporary
+    file by concurrent ranged reads and thumbnails are streamed to the server, in multiple parts when they are big
+    """
+    name: str = "s3"
+
+    def __init__(self, fileStorageConfig: dict, logger: Logger):
+        super().__init__(fileStorageConfig, logger)
+        s3Config: dict = fileStorageConfig.get("s3", {})
+        if not s3Config.get("bucket"):
+            raise ValueError("s3 storage requires a bucket")
+        self.bucket: str = s3Config["bucket"]
+        self.s3Config: dict = s3Config
+        self.rangeSize: int = s3Config.get("rangeSize", DEFAULT_S3_RANGE_SIZE)
+        self.rangeConcurrency: int = s3Config.get("rangeConcurrency", DEFAULT_S3_RANGE_CONCURRENCY)
+        self.maxPoolConnections: int = max(
+            s3Config.get("maxPoolConnections", DEFAULT_S3_MAX_POOL_CONNECTIONS), self.rangeConcurrency
+        )
+        self.transferConfig = TransferConfig(multipart_threshold=self.rangeSize, multipart_chunksize=self.rangeSize,
+                                             max_concurrency=self.rangeConcurrency)
+        self.client = None
+        self.rangeExecutor: Union[ThreadPoolExecutor, None] = None
+
+    def getClient(self):
+        """
+        Get S3 client if exists else create a new client
+        Clients are created on first use, so that every worker process opens its own connections
+        :return: current or new S3 client
+        """
+        if self.client is None:
+            self.logger.info("creating new s3 client")
+            self.client = boto3.session.Session().client(
+                "s3",
+                endpoint_url=self.s3Config.get("endpointUrl"),
+                region_name=self.s3Config.get("region"),
+                aws_access_key_id=self.s3Config.get("accessKeyId"),
+                aws_secret_access_key=self.s3Config.get("secretAccessKey"),
+                config=Config(max_pool_connections=self.maxPoolConnections),
+            )
+        return self.client
+
+    def getRangeExecutor(self) -> ThreadPoolExecutor:
+        """
+        Get the thread pool downloading ranges of input files
+        :return: current or new thread pool
+        """
+        if self.rangeExecutor is None:
+            self.rangeExecutor = ThreadPoolExecutor(max_workers=self.rangeConcurrency)
+        return self.rangeExecutor
+
+    @staticmethod
+    def toKey(path: str) -> str:
+        """
+        Get the object key of a file path
+        :param path: file path
+        :return: object key
+        """
+        return path.lstrip("/")
+
+    @staticmethod
+    def translateError(exc: Exception) -> Exception:
+        """
+        Map an S3 error to the errors of the worker, so that failed jobs are retried only when it may help
+        :param exc: botocore or boto3 error
+        :return: FileNotFoundError for missing objects, TransientError for connection, throttling and server errors,
+        the error itself otherwise
+        """
+        if isinstance(exc, (BotoCoreError, S3UploadFailedError)):
+            return TransientError(str(exc))
+        code: str = exc.response.get("Error", {}).get("Code", "")
+        if code in S3_MISSING_ERROR_CODES:
+            return FileNotFoundError(errno.ENOENT, str(exc))
+        if code in S3_TRANSIENT_ERROR_CODES or exc.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500:
+            return TransientError(str(exc))
+        return exc
+
+    @contextmanager
+    def fetch(self, filePath: str) -> Iterator[str]:
+        # the extension is kept, some ImageMagick coders are picked from it
+        fd, localPath = tempfile.mkstemp(suffix=os.path.splitext(filePath)[1])
+        try:
+            try:
+                self.download(self.toKey(filePath), fd)
+            except (BotoCoreError, ClientError) as exc:
+                raise self.translateError(exc) from exc
+            finally:
+                os.close(fd)
+            yield localPath
+        finally:
+            os.remove(localPath)
+
+    def download(self, key: str, fd: int):
+        """
+        Download an object into a file, by ranges of rangeSize bytes read concurrently
+        :param key: object key
+        :param fd: descriptor of the file to write to
+        """
+        size: int = self.getClient().head_object(Bucket=self.bucket, Key=key)["ContentLength"]
+        os.ftruncate(fd, size)
+        byteRanges: List[Tuple[int, int]] = [
+            (start, min(start + self.rangeSize, size) - 1) for start in range(0, size, self.rangeSize)
+        ]
+        if len(byteRanges) == 1:
+            self.downloadRange(key, fd, byteRanges[0])
+            return
+        for _ in self.getRangeExecutor().map(partial(self.downloadRange, key, fd), byteRanges):
+            pass
+
+    def downloadRange(self, key: str, fd: int, byteRange: Tuple[int, int]):
+        """
+        Download a range of an object into the same range of a file
+        :param key: object key
+        :param fd: descriptor of the file to write to
+        :param byteRange: first and last byte of the range (inclusive)
+        """
+        body = self.getClient().get_object(
+            Bucket=self.bucket, Key=key, Range="bytes=%s-%s" % byteRange
+        )["Body"]
+        offset: int = byteRange[0]
+        for chunk in iter(lambda: body.read(HASH_CHUNK_SIZE), b""):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+
+    def getSize(self, filePath: str) -> Union[int, None]:
+        try:
+            return self.getClient().head_object(Bucket=self.bucket, Key=self.toKey(filePath))["ContentLength"]
+        except (BotoCoreError, ClientError):
+            return None
+
+    def write(self, path: str, data: bytes):
+        # objects only become visible once fully uploaded
+        try:
+            self.getClient().upload_fileobj(
+                io.BytesIO(data), self.bucket, self.toKey(path),
+                ExtraArgs={"ContentType": mimetypes.guess_type(path)[0] or S3_DEFAULT_CONTENT_TYPE},
+                Config=self.transferConfig,
+            )
+        except (BotoCoreError, ClientError, S3UploadFailedError) as exc:
+            raise self.translateError(exc) from exc
+
+    def sync(self, paths: Iterable[str]):
+        # uploaded objects are already durable
+        pass
+
+
+def createStorage(fileStorageConfig: dict, logger: Logger) -> Storage:
+    """
+    Create the storage backend selected in configuration
+    :param fileStorageConfig: fileStorage section of the configuration
+    :param logger: logger
+    :return: storage backend
+    :raise ValueError: if the backend is unknown, or if boto3 is not installed or the bucket is missing for the s3
+    backend
+    """
+    backendName: str = fileStorageConfig.get("backend", DEFAULT_STORAGE_BACKEND)
+    if backendName == LocalStorage.name:
+        return LocalStorage(fileStorageConfig, logger)
+    if backendName == S3Storage.name:
+        if boto3 is None:
+            raise ValueError("s3 storage requires boto3")
+        return S3Storage(fileStorageConfig, logger)
+    raise ValueError("unknown storage backend: %s" % backendName)
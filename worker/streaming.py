@@ -0,0 +1,453 @@
+import math
+import struct
+import zlib
+from typing import BinaryIO, Iterator, List, Tuple, Union
+from constants import STREAM_STRIP_BYTES, PNG_SIGNATURE, TIFF_SIGNATURES, PNG_DIAGONAL_MIN_ROWS
+try:
+    import numpy
+except ImportError:
+    # streaming decode is unavailable without numpy, images are then fully decoded by ImageMagick
+    numpy = None
+
+
+class RasterStream:
+    """
+    Image file whose pixels are read row by row without holding the full raster in memory
+    Rows are returned as 8 bit samples with 1 (gray), 2 (gray and alpha), 3 (RGB) or 4 (RGBA) channels
+    """
+
+    def __init__(self, stream: BinaryIO, width: int, height: int, channels: int):
+        self.stream: BinaryIO = stream
+        self.width: int = width
+        self.height: int = height
+        self.channels: int = channels
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the image file
+        """
+        self.stream.close()
+
+    def iterRows(self) -> Iterator:
+        """
+        Read rows of the image from top to bottom
+        :return: iterator of arrays of shape (rows, width, channels), the number of rows depends on the format
+        """
+        raise NotImplementedError
+
+    def iterStrips(self, stripRows: int) -> Iterator:
+        """
+        Read rows of the image by strips of stripRows rows (the last strip may be shorter)
+        :param stripRows: number of rows of a strip
+        :return: iterator of arrays of shape (stripRows, width, channels)
+        """
+        pending: List = []
+        pendingRows: int = 0
+        for rows in self.iterRows():
+            pending.append(rows)
+            pendingRows += len(rows)
+            while pendingRows >= stripRows:
+                buffered = numpy.concatenate(pending) if len(pending) > 1 else pending[0]
+                yield buffered[:stripRows]
+                pending = [buffered[stripRows:]]
+                pendingRows -= stripRows
+        if pendingRows:
+            yield numpy.concatenate(pending)
+
+
+def to8Bit(samples, maxValue: int):
+    """
+    Scale samples to 8 bit
+    :param samples: array of samples between 0 and maxValue
+    :param maxValue: maximum value of a sample
+    :return: array of uint8 samples
+    """
+    if maxValue == 255:
+        return samples.astype(numpy.uint8, copy=False)
+    return (samples.astype(numpy.uint32) * 255 // maxValue).astype(numpy.uint8)
+
+
+class PnmStream(RasterStream):
+    """
+    Binary PGM (P5) and PPM (P6) image
+    """
+
+    def __init__(self, stream: BinaryIO, magic: bytes):
+        tokens: List[bytes] = []
+        while len(tokens) < 3:
+            line: bytes = stream.readline()
+            if not line:
+                raise ValueError("truncated PNM header")
+            tokens += line.split(b"#")[0].split()
+        width, height, self.maxValue = (int(token) for token in tokens[:3])
+        super().__init__(stream, width, height, 1 if magic == b"P5" else 3)
+        self.sampleType: str = "u1" if self.maxValue < 256 else ">u2"
+
+    def iterRows(self) -> Iterator:
+        sampleSize: int = numpy.dtype(self.sampleType).itemsize
+        rowBytes: int = self.width * self.channels * sampleSize
+        readRows: int = max(STREAM_STRIP_BYTES // rowBytes, 1)
+        remainingRows: int = self.height
+        while remainingRows > 0:
+            rowCount: int = min(readRows, remainingRows)
+            data: bytes = self.stream.read(rowBytes * rowCount)
+            if len(data) < rowBytes * rowCount:
+                raise ValueError("truncated PNM data")
+            samples = numpy.frombuffer(data, dtype=self.sampleType)
+            yield to8Bit(samples, self.maxValue).reshape(rowCount, self.width, self.channels)
+            remainingRows -= rowCount
+
+
+class PngStream(RasterStream):
+    """
+    Non interlaced PNG image of 8 or 16 bit samples, or of 8 bit palette indexes
+    IDAT data is inflated incrementally and unfiltered by blocks of rows
+    """
+    CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+    def __init__(self, stream: BinaryIO):
+        length, chunkType = struct.unpack(">I4s", stream.read(8))
+        if chunkType != b"IHDR":
+            raise ValueError("PNG without IHDR")
+        width, height, self.bitDepth, self.colorType, compression, filterMethod, interlace = struct.unpack(
+            ">IIBBBBB", stream.read(length)
+        )
+        stream.read(4)
+        if interlace or self.colorType not in self.CHANNELS or self.bitDepth not in (8, 16) \
+                or (self.colorType == 3 and self.bitDepth != 8):
+            raise ValueError("unsupported PNG layout")
+        self.palette = None
+        super().__init__(stream, width, height, 3 if self.colorType == 3 else self.CHANNELS[self.colorType])
+        # bytes per complete pixel, used by filters as the distance to the left neighbour
+        self.pixelBytes: int = self.CHANNELS[self.colorType] * self.bitDepth // 8
+        self.rowBytes: int = self.width * self.pixelBytes
+
+    def iterChunks(self) -> Iterator[Tuple[bytes, bytes]]:
+        """
+        Read chunks following IHDR
+        :return: iterator of chunk type and chunk data
+        """
+        while True:
+            header: bytes = self.stream.read(8)
+            if len(header) < 8:
+                raise ValueError("truncated PNG data")
+            length, chunkType = struct.unpack(">I4s", header)
+            data: bytes = self.stream.read(length)
+            self.stream.read(4)
+            if chunkType == b"IEND":
+                return
+            yield chunkType, data
+
+    def unfilter(self, filterType: int, row, prior):
+        """
+        Reverse the filter of a row
+        :param filterType: PNG filter type of the row
+        :param row: array of the filtered row
+        :param prior: array of the previous unfiltered row
+        :return: array of the unfiltered row
+        """
+        step: int = self.pixelBytes
+        if filterType == 0:
+            return row
+        if filterType == 1:
+            # Sub: running sum of each byte lane modulo 256
+            return numpy.cumsum(row.reshape(-1, step), axis=0, dtype=numpy.uint8).reshape(-1)
+        if filterType == 2:
+            return row + prior
+        if filterType not in (3, 4):
+            raise ValueError("unknown PNG filter type: %s" % filterType)
+        # Average and Paeth of a row on its own are reversed byte by byte
+        unfiltered: bytearray = bytearray(row.tobytes())
+        priorBytes: bytes = prior.tobytes()
+        if filterType == 3:
+            for index in range(len(unfiltered)):
+                left: int = unfiltered[index - step] if index >= step else 0
+                unfiltered[index] = (unfiltered[index] + ((left + priorBytes[index]) >> 1)) & 0xFF
+        else:
+            for index in range(len(unfiltered)):
+                if index >= step:
+                    left, upLeft = unfiltered[index - step], priorBytes[index - step]
+                else:
+                    left, upLeft = 0, 0
+                up: int = priorBytes[index]
+                estimate: int = left + up - upLeft
+                leftDistance, upDistance, upLeftDistance = abs(estimate - left), abs(estimate - up), \
+                    abs(estimate - upLeft)
+                if leftDistance <= upDistance and leftDistance <= upLeftDistance:
+                    predictor: int = left
+                elif upDistance <= upLeftDistance:
+                    predictor = up
+                else:
+                    predictor = upLeft
+                unfiltered[index] = (unfiltered[index] + predictor) & 0xFF
+        return numpy.frombuffer(unfiltered, dtype=numpy.uint8)
+
+    def unfilterRows(self, filtered, prior):
+        """
+        Reverse the filters of consecutive rows
+        Average and Paeth predict a byte from the unfiltered byte on its left, so that they cannot be reversed with
+        whole row operations: they are unfiltered by unfilterDiagonals in blocks of getDiagonalRows rows, when blocks
+        hold at least PNG_DIAGONAL_MIN_ROWS rows, other rows one by one
+        :param filtered: array of shape (rows, 1 + rowBytes), the first byte of each row is its filter type
+        :param prior: unfiltered row before the first one
+        :return: array of shape (rows, rowBytes) of unfiltered rows
+        """
+        filterTypes = filtered[:, 0]
+        if filterTypes.max() > 4:
+            raise ValueError("unknown PNG filter type: %s" % filterTypes.max())
+        rows = numpy.empty((len(filtered), self.rowBytes), dtype=numpy.uint8)
+        diagonalRows: int = self.getDiagonalRows()
+        for first in range(0, len(filtered), diagonalRows):
+            last: int = min(first + diagonalRows, len(filtered))
+            blockTypes = filterTypes[first:last]
+            if last - first >= PNG_DIAGONAL_MIN_ROWS and (blockTypes >= 3).any():
+                rows[first:last] = self.unfilterDiagonals(blockTypes, filtered[first:last, 1:], prior)
+            else:
+                for index in range(first, last):
+                    rows[index] = self.unfilter(int(filterTypes[index]), filtered[index, 1:], prior)
+                    prior = rows[index]
+            prior = rows[last - 1]
+        return rows
+
+    def getDiagonalRows(self) -> int:
+        """
+        Get the number of rows unfiltered together by unfilterDiagonals, whose buffers hold (width + rows + 1) *
+        (rows + 1) pixels: blocks are sized so that both buffers fit in STREAM_STRIP_BYTES, whatever the image width
+        :return: number of rows, at least 1
+        """
+        # two buffers of 2 byte samples: (width + rows + 1) * (rows + 1) pixels must stay under maxPixels
+        maxPixels: int = STREAM_STRIP_BYTES // (4 * self.pixelBytes)
+        rows: int = int((math.sqrt(self.width ** 2 + 4 * maxPixels) - self.width) / 2) - 1
+        return max(rows, 1)
+
+    def unfilterDiagonals(self, filterTypes, filtered, prior):
+        """
+        Reverse the filters of a block of rows along anti-diagonals of pixels
+        Every predictor of pixel (r, c) only reads pixels (r, c - 1), (r - 1, c) and (r - 1, c - 1), so the pixels with
+        the same r + c are unfiltered together. Rows are stored skewed by one pixel per row and transposed, so that
+        each anti-diagonal is a contiguous slice and its neighbours are in the previous two slices
+        :param filterTypes: filter type of each row
+        :param filtered: array of shape (rows, rowBytes) of filtered rows
+        :param prior: unfiltered row before the first one
+        :return: array of shape (rows, rowBytes) of unfiltered rows
+        """
+        rowCount: int = len(filtered)
+        step: int = self.pixelBytes
+        # pixel c of row i is at diagonals[c + i + 2, i + 1], pixels of the prior row at diagonals[c + 1, 0]
+        diagonals = numpy.zeros((self.width + rowCount + 1, rowCount + 1, step), dtype=numpy.int16)
+        filteredDiagonals = numpy.zeros_like(diagonals)
+        diagonals[1:self.width + 1, 0] = prior.reshape(self.width, step)
+        for index in range(rowCount):
+            filteredDiagonals[index + 2:index + 2 + self.width, index + 1] = filtered[index].reshape(self.width, step)
+        # only the predictors of the filter types found in the block are computed, then picked by row
+        usedTypes: List[int] = [filterType for filterType in range(5) if (filterTypes == filterType).any()]
+        choices = numpy.searchsorted(usedTypes, filterTypes)[:, None]
+        for diagonal in range(2, self.width + rowCount + 1):
+            first, last = max(1, diagonal - self.width), min(rowCount, diagonal - 1)
+            left = diagonals[diagonal - 1, first:last + 1]
+            up = diagonals[diagonal - 1, first - 1:last]
+            upLeft = diagonals[diagonal - 2, first - 1:last]
+            predictors: List = []
+            for filterType in usedTypes:
+                if filterType == 0:
+                    predictors.append(0)
+                elif filterType == 1:
+                    predictors.append(left)
+                elif filterType == 2:
+                    predictors.append(up)
+                elif filterType == 3:
+                    predictors.append((left + up) >> 1)
+                else:
+                    leftDistance = numpy.abs(up - upLeft)
+                    upDistance = numpy.abs(left - upLeft)
+                    upLeftDistance = numpy.abs(left + up - 2 * upLeft)
+                    predictors.append(numpy.where(
+                        (leftDistance <= upDistance) & (leftDistance <= upLeftDistance), left,
+                        numpy.where(upDistance <= upLeftDistance, up, upLeft)
+                    ))
+            predictor = predictors[0] if len(predictors) == 1 else numpy.choose(choices[first - 1:last], predictors)
+            diagonals[diagonal, first:last + 1] = (filteredDiagonals[diagonal, first:last + 1] + predictor) & 0xFF
+        rows = numpy.empty((rowCount, self.rowBytes), dtype=numpy.uint8)
+        for index in range(rowCount):
+            rows[index] = diagonals[index + 2:index + 2 + self.width, index + 1].reshape(-1)
+        return rows
+
+    def toPixels(self, rows):
+        """
+        Convert unfiltered rows to 8 bit pixels
+        :param rows: array of shape (rows, rowBytes) of unfiltered rows
+        :return: array of shape (len(rows), width, channels)
+        """
+        samples = rows if self.bitDepth == 8 else (rows.view(">u2") >> 8).astype(numpy.uint8)
+        if self.palette is not None:
+            return self.palette[samples].reshape(len(rows), self.width, 3)
+        return samples.reshape(len(rows), self.width, self.channels)
+
+    def iterRows(self) -> Iterator:
+        inflater = zlib.decompressobj()
+        prior = numpy.zeros(self.rowBytes, dtype=numpy.uint8)
+        buffered: bytearray = bytearray()
+        rowCount: int = 0
+        # rows are unfiltered by blocks of about a strip
+        blockRows: int = max(STREAM_STRIP_BYTES // self.rowBytes, 1)
+        for chunkType, data in self.iterChunks():
+            if chunkType == b"PLTE":
+                self.palette = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 3)
+                continue
+            if chunkType != b"IDAT":
+                continue
+            buffered += inflater.decompress(data)
+            while rowCount < self.height:
+                readRows: int = min(blockRows, self.height - rowCount)
+                blockBytes: int = readRows * (self.rowBytes + 1)
+                if len(buffered) < blockBytes:
+                    break
+                filtered = numpy.frombuffer(buffered[:blockBytes], dtype=numpy.uint8).reshape(readRows, -1)
+                del buffered[:blockBytes]
+                rows = self.unfilterRows(filtered, prior)
+                prior = rows[-1]
+                rowCount += readRows
+                yield self.toPixels(rows)
+        if rowCount < self.height:
+            raise ValueError("truncated PNG data")
+
+
+class TiffStream(RasterStream):
+    """
+    Uncompressed, chunky (interleaved) TIFF image stored in strips of 8 or 16 bit samples
+    """
+    TAG_TYPES = {3: "H", 4: "I"}
+
+    def __init__(self, stream: BinaryIO, byteOrder: str):
+        self.byteOrder: str = byteOrder
+        firstIfdOffset, = struct.unpack(byteOrder + "I", stream.read(4))
+        tags: dict = self.readIfd(stream, firstIfdOffset)
+        width, height = tags[256][0], tags[257][0]
+        self.bitsPerSample: int = tags.get(258, [1])[0]
+        samplesPerPixel: int = tags.get(277, [1])[0]
+        if tags.get(259, [1])[0] != 1 or tags.get(284, [1])[0] != 1 or 322 in tags \
+                or tags.get(262, [1])[0] not in (1, 2) or self.bitsPerSample not in (8, 16) \
+                or samplesPerPixel not in (1, 2, 3, 4):
+            raise ValueError("unsupported TIFF layout")
+        super().__init__(stream, width, height, samplesPerPixel)
+        self.stripOffsets: List[int] = tags[273]
+        self.stripByteCounts: List[int] = tags[279]
+
+    def readIfd(self, stream: BinaryIO, offset: int) -> dict:
+        """
+        Read the SHORT and LONG tags of an image file directory
+        :param stream: TIFF file
+        :param offset: offset of the directory
+        :return: values of the tags by tag number
+        """
+        stream.seek(offset)
+        entryCount, = struct.unpack(self.byteOrder + "H", stream.read(2))
+        entries: List[Tuple[int, int, int, bytes]] = [
+            struct.unpack(self.byteOrder + "HHI4s", stream.read(12)) for _ in range(entryCount)
+        ]
+        tags: dict = {}
+        for tag, fieldType, count, valueOrOffset in entries:
+            if fieldType not in self.TAG_TYPES:
+                continue
+            valueFormat: str = self.byteOrder + self.TAG_TYPES[fieldType] * count
+            size: int = struct.calcsize(valueFormat)
+            if size <= 4:
+                data: bytes = valueOrOffset[:size]
+            else:
+                stream.seek(struct.unpack(self.byteOrder + "I", valueOrOffset)[0])
+                data = stream.read(size)
+            tags[tag] = list(struct.unpack(valueFormat, data))
+        return tags
+
+    def iterRows(self) -> Iterator:
+        sampleType: str = "u1" if self.bitsPerSample == 8 else self.byteOrder + "u2"
+        rowBytes: int = self.width * self.channels * self.bitsPerSample // 8
+        remainingRows: int = self.height
+        for offset, byteCount in zip(self.stripOffsets, self.stripByteCounts):
+            rowCount: int = min(byteCount // rowBytes, remainingRows)
+            if rowCount <= 0:
+                break
+            self.stream.seek(offset)
+            data: bytes = self.stream.read(rowCount * rowBytes)
+            samples = numpy.frombuffer(data, dtype=sampleType)
+            yield to8Bit(samples, (1 << self.bitsPerSample) - 1).reshape(rowCount, self.width, self.channels)
+            remainingRows -= rowCount
+        if remainingRows > 0:
+            raise ValueError("truncated TIFF data")
+
+
+def openRasterStream(filePath: str) -> Union[RasterStream, None]:
+    """
+    Open an image file for streaming decode if numpy is available and its format and layout are supported
+    :param filePath: input image file path
+    :return: raster stream, None if the image cannot be streamed
+    """
+    if numpy is None:
+        return None
+    stream: BinaryIO = open(filePath, "rb")
+    try:
+        magic: bytes = stream.read(8)
+        if magic[:2] in (b"P5", b"P6") and magic[2:3].isspace():
+            stream.seek(3)
+            return PnmStream(stream, magic[:2])
+        if magic == PNG_SIGNATURE:
+            return PngStream(stream)
+        if magic[:4] in TIFF_SIGNATURES:
+            stream.seek(4)
+            return TiffStream(stream, "<" if magic[:2] == b"II" else ">")
+    except (ValueError, KeyError, struct.error):
+        pass
+    stream.close()
+    return None
+
+
+def streamResize(rasterStream: RasterStream, factor: int):
+    """
+    Downsample an image by an integer factor with a box filter (area averaging), strip by strip
+    Memory is bounded by one strip of input rows and the output raster
+    :param rasterStream: opened raster stream
+    :param factor: downsampling factor, each output pixel averages a box of factor x factor input pixels
+    (smaller boxes on the right and bottom edges)
+    :return: array of shape (ceil(height / factor), ceil(width / factor), channels) of uint8
+    """
+    width, height = rasterStream.width, rasterStream.height
+    outputWidth: int = -(-width // factor)
+    outputHeight: int = -(-height // factor)
+    output = numpy.empty((outputHeight, outputWidth, rasterStream.channels), dtype=numpy.uint8)
+    columnStarts = numpy.arange(0, width, factor)
+    columnCounts = numpy.diff(numpy.append(columnStarts, width))
+    # strips hold whole boxes so that every strip completes its output rows
+    rowBytes: int = width * rasterStream.channels
+    stripRows: int = max(STREAM_STRIP_BYTES // rowBytes // factor, 1) * factor
+    outputRow: int = 0
+    for strip in rasterStream.iterStrips(stripRows):
+        rowStarts = numpy.arange(0, len(strip), factor)
+        rowCounts = numpy.diff(numpy.append(rowStarts, len(strip)))
+        sums = numpy.add.reduceat(numpy.add.reduceat(strip, columnStarts, axis=1, dtype=numpy.uint64),
+                                  rowStarts, axis=0)
+        counts = numpy.outer(rowCounts, columnCounts)[:, :, numpy.newaxis]
+        output[outputRow:outputRow + len(rowStarts)] = (sums + counts // 2) // counts
+        outputRow += len(rowStarts)
+    return output
+
+
+def toNetpbm(pixels) -> bytes:
+    """
+    Encode pixels as a Netpbm image readable by ImageMagick: PGM, PPM, or PAM when there is an alpha channel
+    :param pixels: array of shape (height, width, channels) of uint8
+    :return: image file content
+    """
+    height, width, channels = pixels.shape
+    if channels in (1, 3):
+        header: bytes = b"%s\n%d %d\n255\n" % (b"P5" if channels == 1 else b"P6", width, height)
+    else:
+        tupleType: bytes = b"GRAYSCALE_ALPHA" if channels == 2 else b"RGB_ALPHA"
+        header = b"P7\nWIDTH %d\nHEIGHT %d\nDEPTH %d\nMAXVAL 255\nTUPLTYPE %s\nENDHDR\n" \
+                 % (width, height, channels, tupleType)
+    return header + pixels.tobytes()
@@ -0,0 +1,261 @@
+import gc
+import math
+import signal
+import time
+from logging import Logger, getLogger
+from multiprocessing import get_context
+from multiprocessing.process import BaseProcess
+from pika import BlockingConnection, ConnectionParameters
+from pika.exceptions import ChannelClosedByBroker
+from pika.spec import NOT_FOUND
+from typing import Dict, List, Union
+import pixel_budget
+from pixel_budget import HostPixelBudget
+from scheduling import parseQueueClasses
+from constants import ASYNC_MODE, BLOCKING_MODE, THREADED_MODE, DEFAULT_SUPERVISOR_CHECK_INTERVAL, \
+    DEFAULT_RESTART_BACKOFF, DEFAULT_MAX_RESTART_BACKOFF, DEFAULT_STABLE_UPTIME, DEFAULT_MESSAGES_PER_WORKER, \
+    DEFAULT_DRAIN_TIMEOUT
+
+
+def createWorker(config: dict, logger: Logger):
+    """
+    Create the worker engine selected in the configuration
+    Worker modules load Wand (and the ImageMagick libraries), pika and redis: they are imported on first use
+    :param config: config data of the application
+    :param logger: main logger object
+    :return: worker engine
+    """
+    mode: str = config["worker"].get("mode", BLOCKING_MODE)
+    if mode == ASYNC_MODE:
+        from async_worker import AsyncWorker
+        return AsyncWorker(config, logger)
+    if mode == THREADED_MODE:
+        from threaded_worker import ThreadedWorker
+        return ThreadedWorker(config, logger)
+    from worker import Worker
+    return Worker(config, logger)
+
+
+def runConsumer(config: dict, logger: Logger, slot: int, spawnedAt: float, worker=None):
+    """
+    Entry point of a consumer process: run the worker engine selected in the configuration
+    :param config: config data of the application
+    :param logger: main logger object
+    :param slot: index of the consumer
+    :param spawnedAt: monotonic time at which the consumer was spawned, for the startup time report
+    :param worker: worker engine built before forking on warm start, None to build it in the consumer
+    """
+    if pixel_budget.hostBudget is not None:
+        pixel_budget.hostBudget.slot = slot
+    if worker is None:
+        worker = createWorker(config, logger)
+    worker.spawnedAt = spawnedAt
+    # every consumer process serves its own metrics endpoint
+    worker.metrics.start(slot)
+    worker.processJob()
+
+
+class Supervisor:
+    """
+    Supervisor of the consumer processes
+    Dead consumers are detected and respawned with exponential backoff, the number of consumers is scaled between
+    minWorkers and maxWorkers according to the queue depth and consumers are drained gracefully on SIGTERM.
+    On warm start, heavy libraries and the worker engine are initialized once before forking consumers
+    """
+
+    def __init__(self, config: dict, logger: Logger):
+        self.config = config
+        self.logger = logger
+        workerConfig: dict = config["worker"]
+        nbWorkers: int = workerConfig["numberWorker"]
+        self.minWorkers: int = workerConfig.get("minWorkers", nbWorkers)
+        self.maxWorkers: int = max(workerConfig.get("maxWorkers", nbWorkers), self.minWorkers)
+        self.messagesPerWorker: int = workerConfig.get("messagesPerWorker", DEFAULT_MESSAGES_PER_WORKER)
+        self.checkInterval: float = workerConfig.get("checkInterval", DEFAULT_SUPERVISOR_CHECK_INTERVAL)
+        self.restartBackoff: float = workerConfig.get("restartBackoff", DEFAULT_RESTART_BACKOFF)
+        self.maxRestartBackoff: float = workerConfig.get("maxRestartBackoff", DEFAULT_MAX_RESTART_BACKOFF)
+        self.drainTimeout: float = workerConfig.get("drainTimeout", DEFAULT_DRAIN_TIMEOUT)
+        self.warmStartEnabled: bool = workerConfig.get("warmStart", False)
+        # worker engine inherited by every consumer on warm start
+        self.worker = None
+        # consumers inherit the already imported libraries of the supervisor
+        self.context = get_context("fork")
+        self.consumers: Dict[int, BaseProcess] = {}
+        self.startedAt: Dict[int, float] = {}
+        self.failures: Dict[int, int] = {}
+        self.restartAt: Dict[int, float] = {}
+        self.targetWorkers: int = self.minWorkers
+        self.queueConn: Union[BlockingConnection, None] = None
+        self.stopping: bool = False
+        budgetConfig: dict = workerConfig.get("pixelBudget", {})
+        if budgetConfig.get("enabled", False) and budgetConfig.get("hostPixels"):
+            # shared memory inherited by every consumer forked afterwards
+            pixel_budget.hostBudget = HostPixelBudget(budgetConfig["hostPixels"], self.maxWorkers, self.context)
+
+    def warmStart(self):
+        """
+        Load and initialize the heavy libraries once, so that forked consumers start ready to consume: worker modules,
+        ImageMagick coders and the worker engine, built from the configuration without opening any connection.
+        Objects created so far are frozen out of garbage collection, which keeps their memory shared with the consumers
+        """
+        start: float = time.perf_counter()
+        self.worker = createWorker(self.config, self.logger)
+        built: float = time.perf_counter()
+        self.worker.warmUpCoders()
+        if self.config["worker"].get("mode", BLOCKING_MODE) == ASYNC_MODE:
+            import async_worker
+            from worker import Worker
+            # inherited by the processes of the CPU pool, which are forked from the consumer
+            async_worker.poolWorker = Worker(self.config, getLogger("worker"))
+        warmed: float = time.perf_counter()
+        gc.freeze()
+        self.logger.info("warm start in %.0f ms: imports and worker %.0f ms, ImageMagick coders %.0f ms",
+                         (warmed - start) * 1000, (built - start) * 1000, (warmed - built) * 1000)
+
+    def spawnConsumer(self, slot: int):
+        """
+        Start a consumer process in the given slot
+        :param slot: index of the consumer
+        """
+        process: BaseProcess = self.context.Process(
+            target=runConsumer, args=(self.config, self.logger, slot, time.monotonic(), self.worker),
+            name="consumer-%s" % slot
+        )
+        process.start()
+        self.consumers[slot] = process
+        self.startedAt[slot] = time.monotonic()
+        self.restartAt.pop(slot, None)
+        self.logger.info("started consumer %s with pid: %s", slot, process.pid)
+
+    def reapConsumers(self, now: float):
+        """
+        Detect dead consumers and schedule their respawn with exponential backoff
+        :param now: current monotonic time
+        """
+        for slot, process in list(self.consumers.items()):
+            if process.is_alive():
+                continue
+            del self.consumers[slot]
+            if pixel_budget.hostBudget is not None:
+                pixel_budget.hostBudget.reset(slot)
+            if slot >= self.targetWorkers and process.exitcode == 0:
+                self.logger.info("consumer %s is drained", slot)
+                continue
+            # a consumer which ran long enough is considered healthy again
+            if now - self.startedAt[slot] >= DEFAULT_STABLE_UPTIME:
+                self.failures[slot] = 0
+            self.failures[slot] = self.failures.get(slot, 0) + 1
+            backoff: float = min(self.restartBackoff * 2 ** (self.failures[slot] - 1), self.maxRestartBackoff)
+            self.restartAt[slot] = now + backoff
+            self.logger.error("consumer %s died with exit code %s, respawning in %ss",
+                              slot, process.exitcode, backoff)
+
+    def respawnConsumers(self, now: float):
+        """
+        Start consumers of every slot below the target number of consumers whose backoff has expired
+        :param now: current monotonic time
+        """
+        for slot in range(self.targetWorkers):
+            if slot not in self.consumers and self.restartAt.get(slot, 0) <= now:
+                self.spawnConsumer(slot)
+
+    def getQueueDepth(self) -> Union[int, None]:
+        """
+        Get number of messages ready in queueName and in every queue class, queues not declared yet hold no message
+        :return: number of messages, None if the queue server cannot be reached
+        """
+        queueNames: List[str] = [self.config["queue"]["queueName"]]
+        queueNames += [queueClass.name for queueClass in parseQueueClasses(self.config["queue"])
+                       if queueClass.name not in queueNames]
+        try:
+            if self.queueConn is None or self.queueConn.is_closed:
+                parameters = ConnectionParameters(host=self.config["queue"]["host"],
+                                                  port=self.config["queue"]["port"])
+                self.queueConn = BlockingConnection(parameters)
+            channel = self.queueConn.channel()
+            messageCount: int = 0
+            for queueName in queueNames:
+                try:
+                    frame = channel.queue_declare(queueName, durable=True, passive=True)
+                except ChannelClosedByBroker as exc:
+                    if exc.reply_code != NOT_FOUND:
+                        raise
+                    # consumers have not declared the queue yet, the broker closed the channel
+                    channel = self.queueConn.channel()
+                    continue
+                messageCount += frame.method.message_count
+            channel.close()
+            return messageCount
+        except Exception as exc:
+            self.logger.warning("cannot get queue depth: %s", exc)
+            if self.queueConn is not None:
+                try:
+                    self.queueConn.close()
+                except Exception:
+                    pass
+            self.queueConn = None
+            return None
+
+    def scaleConsumers(self, queueDepth: Union[int, None]):
+        """
+        Scale the number of consumers between minWorkers and maxWorkers according to the queue depth
+        Consumers over the target are asked to drain
+        :param queueDepth: number of messages ready in the queue
+        """
+        if queueDepth is None:
+            return
+        wanted: int = math.ceil(queueDepth / self.messagesPerWorker)
+        targetWorkers: int = min(max(wanted, self.minWorkers), self.maxWorkers)
+        if targetWorkers != self.targetWorkers:
+            self.logger.info("scaling consumers from %s to %s for queue depth: %s",
+                             self.targetWorkers, targetWorkers, queueDepth)
+        self.targetWorkers = targetWorkers
+        for slot, process in self.consumers.items():
+            if slot >= self.targetWorkers and process.is_alive():
+                process.terminate()
+
+    def stop(self, signum=None, frame=None):
+        """
+        Stop supervising: used as SIGTERM handler
+        :param signum: number of the received signal
+        :param frame: current stack frame
+        """
+        self.logger.info("supervisor received signal: %s", signum)
+        self.stopping = True
+
+    def drain(self):
+        """
+        Ask every consumer to drain and wait for them, killing those which exceed the drain timeout
+        """
+        self.logger.info("draining %s consumers", len(self.consumers))
+        for process in self.consumers.values():
+            if process.is_alive():
+                process.terminate()
+        deadline: float = time.monotonic() + self.drainTimeout
+        for slot, process in self.consumers.items():
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                self.logger.warning("consumer %s did not drain in time, killing it", slot)
+                process.kill()
+                process.join()
+        self.consumers.clear()
+        if self.queueConn is not None and self.queueConn.is_open:
+            self.queueConn.close()
+
+    def run(self):
+        """
+        Supervise consumers until SIGTERM or SIGINT is received
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if self.warmStartEnabled:
+            self.warmStart()
+        self.logger.info("supervising between %s and %s consumers", self.minWorkers, self.maxWorkers)
+        while not self.stopping:
+            now: float = time.monotonic()
+            self.reapConsumers(now)
+            if self.minWorkers != self.maxWorkers:
+                self.scaleConsumers(self.getQueueDepth())
+            self.respawnConsumers(now)
+            time.sleep(self.checkInterval)
+        self.drain()
@@ -0,0 +1,255 @@
+import asyncio
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from async_worker import AsyncWorker
+from helper import setupLogging
+from typing import Dict, Hashable, Any
+from logging import Logger
+from unittest.mock import patch, MagicMock, call
+from job_status_enum import JobStatusEnum
+from job_message import JobRequest
+from rendition import Rendition
+from metrics import WorkerMetrics
+from retry import TransientError
+from constants import THUMBNAIL_PATH_REDIS_KEY, DECODE_STAGE
+
+
+class TestAsyncWorker(unittest.TestCase):
+    logger: Logger = setupLogging()
+    config: Dict[Hashable, Any] = {
+        'kvs': {'host': 'kvs', 'indexKey': 'redisIndexKey', 'port': 6379},
+        'queue': {'host': 'queue', 'port': 5672, 'queueName': 'test_queue'},
+        'fileStorage': {'thumbnailPath': '/img/thumbnail/'},
+        'worker': {'mode': 'async', 'maxInFlight': 16, 'cpuPoolSize': 2}
+    }
+    jobId: str = '1'
+    filePath: str = '/img/uploaded/1566650412191_test.png'
+    thumbnailPaths: Dict[str, str] = {THUMBNAIL_PATH_REDIS_KEY: '/img/thumbnail/1566650412191_test.png'}
+
+    def setUp(self):
+        self.worker: AsyncWorker = AsyncWorker(self.config, self.logger)
+        self.worker.loop = asyncio.new_event_loop()
+        self.worker.ioExecutor = ThreadPoolExecutor(max_workers=2)
+        self.worker.cpuExecutor = ThreadPoolExecutor(max_workers=2)
+
+    def tearDown(self):
+        self.worker.ioExecutor.shutdown()
+        self.worker.cpuExecutor.shutdown()
+        self.worker.loop.close()
+
+    def test_constructor(self):
+        self.assertEqual(self.worker.maxInFlight, 16)
+        self.assertEqual(self.worker.cpuPoolSize, 2)
+
+    @patch('async_worker.renderThumbnail')
+    @patch.object(AsyncWorker, 'finishJobs')
+    @patch.object(AsyncWorker, 'claimJobs')
+    def test_handleJobSuccessful(self, mockClaimJobs: MagicMock, mockFinishJobs: MagicMock,
+                                 mockRenderThumbnail: MagicMock):
+        mockClaimJobs.return_value = [(self.jobId, JobStatusEnum.READY_FOR_PROCESSING, self.filePath, 1)]
+        poolMetrics: WorkerMetrics = WorkerMetrics({}, self.logger)
+        poolMetrics.observe(DECODE_STAGE, 0.2)
+        mockRenderThumbnail.return_value = (self.thumbnailPaths, poolMetrics.flush())
+        mockChannel: MagicMock = MagicMock()
+        self.worker.loop.run_until_complete(self.worker.handleJob(mockChannel, 3, [JobRequest(self.jobId)]))
+        # metrics recorded in the CPU pool are merged into the ones of the consumer process
+        self.assertEqual(self.worker.metrics.histograms[DECODE_STAGE].sum, 0.2)
+        mockClaimJobs.assert_called_once_with([self.jobId], set())
+        mockRenderThumbnail.assert_called_once_with(self.config, self.filePath, None)
+        mockFinishJobs.assert_called_once_with([(self.jobId, JobStatusEnum.COMPLETE, self.thumbnailPaths)])
+        mockChannel.basic_ack.assert_called_once_with(delivery_tag=3)
+
+    @patch('async_worker.renderThumbnail')
+    @patch.object(AsyncWorker, 'finishJobs')
+    @patch.object(AsyncWorker, 'claimJobs')
+    def test_handleJobNotClaimed(self, mockClaimJobs: MagicMock, mockFinishJobs: MagicMock,
+                                 mockRenderThumbnail: MagicMock):
+        mockClaimJobs.return_value = []
+        mockChannel: MagicMock = MagicMock()
+        self.worker.loop.run_until_complete(self.worker.handleJob(mockChannel, 3, [JobRequest(self.jobId)]))
+        mockRenderThumbnail.assert_not_called()
+        mockFinishJobs.assert_called_once_with([])
+        mockChannel.basic_ack.assert_called_once_with(delivery_tag=3)
+
+    @patch('async_worker.renderThumbnail')
+    @patch.object(AsyncWorker, 'finishJobs')
+    @patch.object(AsyncWorker, 'claimJobs')
+    def test_handleJobBatchMessage(self, mockClaimJobs: MagicMock, mockFinishJobs: MagicMock,
+                                   mockRenderThumbnail: MagicMock):
+        mockClaimJobs.return_value = [('1', JobStatusEnum.READY_FOR_PROCESSING, self.filePath, 1),
+                                      ('2', JobStatusEnum.READY_FOR_PROCESSING, self.filePath, 1)]
+        # rendering of the job with its own renditions fails
+        mockRenderThumbnail.side_effect = lambda config, filePath, renditions: (
+            {} if renditions else self.thumbnailPaths, WorkerMetrics({}, self.logger).flush()
+        )
+        mockChannel: MagicMock = MagicMock()
+        jobs = [JobRequest('1'), JobRequest('2', [Rendition(64, 'webp')])]
+        self.worker.loop.run_until_complete(self.worker.handleJob(mockChannel, 3, jobs))
+        mockClaimJobs.assert_called_once_with(['1', '2'], set())
+        mockRenderThumbnail.assert_any_call(self.config, self.filePath, [Rendition(64, 'webp')])
+        mockFinishJobs.assert_called_once_with([('1', JobStatusEnum.COMPLETE, self.thumbnailPaths),
+                                                ('2', JobStatusEnum.ERROR_DURING_PROCESSING, {})])
+        mockChannel.basic_ack.assert_called_once_with(delivery_tag=3)
+
+    @patch('async_worker.renderThumbnail')
+    @patch.object(AsyncWorker, 'finishJobs')
+    @patch.object(AsyncWorker, 'claimJobs')
+    def test_handleJobRetryTransientFailure(self, mockClaimJobs: MagicMock, mockFinishJobs: MagicMock,
+                                            mockRenderThumbnail: MagicMock):
+        self.worker.retryPolicy.enabled = True
+        mockClaimJobs.return_value = [(self.jobId, JobStatusEnum.READY_FOR_PROCESSING, self.filePath, 1)]
+        mockRenderThumbnail.side_effect = TransientError('Boom!')
+        mockChannel: MagicMock = MagicMock()
+        self.worker.loop.run_until_complete(self.worker.handleJob(mockChannel, 3, [JobRequest(self.jobId)]))
+        mockFinishJobs.assert_called_once_with([(self.jobId, JobStatusEnum.READY_FOR_PROCESSING, {})])
+        self.assertEqual(mockChannel.basic_publish.call_args[0][1], 'test_queue.retry.1000ms')
+        mockChannel.basic_ack.assert_called_once_with(delivery_tag=3)
+
+    def test_onMessageMalformed(self):
+        mockChannel: MagicMock = MagicMock()
+        self.worker.onMessage(mockChannel, MagicMock(delivery_tag=5, redelivered=False), None, b'{"id": 1}')
+        mockChannel.basic_reject.assert_called_once_with(delivery_tag=5, requeue=False)
+        self.assertEqual(self.worker.inFlightJobs, set())
+
+    @patch.object(AsyncWorker, 'handleJob', new_callable=MagicMock)
+    def test_onMessage(self, mockHandleJob: MagicMock):
+        loop: asyncio.AbstractEventLoop = self.worker.loop
+        self.worker.loop = MagicMock()
+        mockChannel: MagicMock = MagicMock()
+        self.worker.onMessage(mockChannel, MagicMock(delivery_tag=5, redelivered=False), None, b'1')
+        mockHandleJob.assert_called_once_with(mockChannel, 5, [JobRequest(self.jobId)])
+        self.worker.loop.create_task.assert_called_once_with(mockHandleJob.return_value)
+        self.worker.loop = loop
+
+    def test_drain(self):
+        self.worker.channel = MagicMock()
+        self.worker.consumerTags = ['ctag']
+        self.worker.asyncQueueConn = MagicMock(is_closed=False)
+        done: list = []
+
+        async def inFlightJob():
+            await asyncio.sleep(0)
+            done.append(True)
+        self.worker.inFlightJobs.add(self.worker.loop.create_task(inFlightJob()))
+        self.worker.loop.run_until_complete(self.worker.drain())
+        self.worker.channel.basic_cancel.assert_called_once_with('ctag')
+        self.assertEqual(done, [True])
+        self.worker.asyncQueueConn.close.assert_called_once()
+
+    @patch('async_worker.renderThumbnail')
+    @patch.object(AsyncWorker, 'finishJobs')
+    @patch.object(AsyncWorker, 'claimJobs')
+    def test_handleJobConnectionLost(self, mockClaimJobs: MagicMock, mockFinishJobs: MagicMock,
+                                     mockRenderThumbnail: MagicMock):
+        mockClaimJobs.return_value = [(self.jobId, JobStatusEnum.READY_FOR_PROCESSING, self.filePath, 1)]
+        mockRenderThumbnail.return_value = (self.thumbnailPaths, WorkerMetrics({}, self.logger).flush())
+        mockChannel: MagicMock = MagicMock(is_open=False)
+        self.worker.loop.run_until_complete(self.worker.handleJob(mockChannel, 3, [JobRequest(self.jobId)]))
+        mockFinishJobs.assert_called_once()
+        mockChannel.basic_ack.assert_not_called()
+
+    @patch.object(AsyncWorker, 'stop')
+    @patch('async_worker.renderThumbnail')
+    @patch.object(AsyncWorker, 'finishJobs')
+    @patch.object(AsyncWorker, 'claimJobs')
+    def test_handleJobBrokenPool(self, mockClaimJobs: MagicMock, mockFinishJobs: MagicMock,
+                                 mockRenderThumbnail: MagicMock, mockStop: MagicMock):
+        mockClaimJobs.return_value = [(self.jobId, JobStatusEnum.READY_FOR_PROCESSING, self.filePath, 1)]
+        mockRenderThumbnail.side_effect = BrokenProcessPool('a pool process died')
+        mockChannel: MagicMock = MagicMock()
+        self.worker.loop.run_until_complete(self.worker.handleJob(mockChannel, 3, [JobRequest(self.jobId)]))
+        # the message goes back to the queue and the process stops to get a new CPU pool
+        mockChannel.basic_nack.assert_called_once_with(delivery_tag=3, requeue=True)
+        mockChannel.basic_ack.assert_not_called()
+        mockFinishJobs.assert_not_called()
+        mockStop.assert_called_once()
+        self.assertTrue(self.worker.failed)
+
+    @patch.object(AsyncWorker, 'stop')
+    @patch.object(AsyncWorker, 'claimJobs')
+    def test_handleJobRedisLost(self, mockClaimJobs: MagicMock, mockStop: MagicMock):
+        mockClaimJobs.side_effect = SystemExit(1)
+        mockChannel: MagicMock = MagicMock()
+        self.worker.loop.run_until_complete(self.worker.handleJob(mockChannel, 3, [JobRequest(self.jobId)]))
+        mockChannel.basic_nack.assert_called_once_with(delivery_tag=3, requeue=True)
+        mockStop.assert_called_once()
+
+    @patch.object(AsyncWorker, 'stop')
+    @patch('async_worker.renderThumbnail')
+    @patch.object(AsyncWorker, 'finishJobs')
+    @patch.object(AsyncWorker, 'claimJobs')
+    def test_handleJobUnexpectedError(self, mockClaimJobs: MagicMock, mockFinishJobs: MagicMock,
+                                      mockRenderThumbnail: MagicMock, mockStop: MagicMock):
+        mockClaimJobs.return_value = [(self.jobId, JobStatusEnum.READY_FOR_PROCESSING, self.filePath, 1)]
+        mockRenderThumbnail.side_effect = ValueError('Boom!')
+        mockChannel: MagicMock = MagicMock()
+        self.worker.loop.run_until_complete(self.worker.handleJob(mockChannel, 3, [JobRequest(self.jobId)]))
+        # the job is claimed again from the redelivered message, until it is poison
+        mockChannel.basic_nack.assert_called_once_with(delivery_tag=3, requeue=True)
+        mockStop.assert_not_called()
+        self.assertFalse(self.worker.failed)
+
+    def test_reconnect(self):
+        loop: asyncio.AbstractEventLoop = self.worker.loop
+        self.worker.loop = MagicMock()
+        self.worker.channel = MagicMock()
+        self.worker.onConnectionClosed(MagicMock(), Exception('lost'))
+        self.worker.loop.call_later.assert_called_once()
+        self.assertEqual(self.worker.loop.call_later.call_args[0][1], self.worker.connect)
+        self.assertIsNone(self.worker.channel)
+        self.assertEqual(self.worker.reconnects['amqp'], 1)
+        self.worker.loop.stop.assert_not_called()
+        # attempts are counted until consumers are set up again
+        for _ in range(self.worker.backoff.maxAttempts - 1):
+            self.worker.onConnectionError(MagicMock(), Exception('refused'))
+        self.worker.loop.stop.assert_called_once()
+        self.worker.loop = loop
+
+    def test_connectionClosedWhenStopping(self):
+        loop: asyncio.AbstractEventLoop = self.worker.loop
+        self.worker.loop = MagicMock()
+        self.worker.stopping = True
+        self.worker.onConnectionClosed(MagicMock(), Exception('closed'))
+        self.worker.loop.stop.assert_called_once()
+        self.worker.loop.call_later.assert_not_called()
+        self.worker.loop = loop
+
+    def test_consumerSetup(self):
+        mockChannel: MagicMock = MagicMock()
+        self.worker.onChannelOpen(mockChannel)
+        mockChannel.queue_declare.assert_called_once()
+        self.assertEqual(mockChannel.queue_declare.call_args[0], ('test_queue',))
+        mockChannel.queue_declare.call_args[1]['callback'](MagicMock())
+        mockChannel.basic_qos.assert_called_once()
+        self.assertEqual(mockChannel.basic_qos.call_args[1]['prefetch_count'], 16)
+        mockChannel.basic_qos.call_args[1]['callback'](MagicMock())
+        mockChannel.basic_consume.assert_called_once_with('test_queue', self.worker.onMessage)
+        self.assertEqual(self.worker.consumerTags, [mockChannel.basic_consume.return_value])
+
+    def test_consumerSetupOfQueueClasses(self):
+        config: Dict[Hashable, Any] = dict(self.config, queue=dict(self.config['queue'], queues=[
+            {'name': 'small', 'weight': 3, 'maxFileSize': 1000}, {'name': 'large', 'weight': 1}
+        ]))
+        worker: AsyncWorker = AsyncWorker(config, self.logger)
+        mockChannel: MagicMock = MagicMock()
+        # run every declare and qos callback right away
+        mockChannel.queue_declare.side_effect = lambda name, durable, callback: callback(MagicMock())
+        mockChannel.basic_qos.side_effect = lambda prefetch_count, callback: callback(MagicMock())
+        worker.onChannelOpen(mockChannel)
+        self.assertEqual([c[1]['prefetch_count'] for c in mockChannel.basic_qos.call_args_list], [12, 4, 16])
+        self.assertEqual(mockChannel.basic_consume.call_args_list, [
+            call('small', worker.onMessage), call('large', worker.onMessage), call('test_queue', worker.onRouteMessage)
+        ])
+
+    @patch.object(AsyncWorker, 'classifyJobs')
+    def test_routeJobs(self, mockClassifyJobs: MagicMock):
+        mockClassifyJobs.return_value = {'small': [JobRequest('1')]}
+        mockChannel: MagicMock = MagicMock()
+        self.worker.loop.run_until_complete(self.worker.routeJobs(mockChannel, 2, [JobRequest('1')]))
+        mockChannel.basic_publish.assert_called_once()
+        self.assertEqual(mockChannel.basic_publish.call_args[0][:3], ('', 'small', b'1'))
+        mockChannel.basic_ack.assert_called_once_with(delivery_tag=2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+from helper import setupLogging
+from logging import Logger
+from redis.exceptions import ConnectionError as RedisConnectionError
+from connections import REDIS_CONNECTION_ERRORS, Backoff, createRedisPool, getPoolStats
+from unittest.mock import patch, MagicMock
+
+
+class TestBackoff(unittest.TestCase):
+    logger: Logger = setupLogging()
+
+    def test_getDelay(self):
+        backoff: Backoff = Backoff({'baseDelay': 0.5, 'maxDelay': 3})
+        for _ in range(100):
+            self.assertLessEqual(backoff.getDelay(1), 0.5)
+            self.assertLessEqual(backoff.getDelay(2), 1)
+            self.assertLessEqual(backoff.getDelay(10), 3)
+            self.assertGreaterEqual(backoff.getDelay(10), 0)
+
+    @patch('connections.time.sleep')
+    def test_callRetry(self, mockSleep: MagicMock):
+        backoff: Backoff = Backoff({'maxAttempts': 3})
+        operation: MagicMock = MagicMock(side_effect=[RedisConnectionError('lost'), 'OK'])
+        onRetry: MagicMock = MagicMock()
+        self.assertEqual(backoff.call(operation, REDIS_CONNECTION_ERRORS, 'ping', self.logger, onRetry), 'OK')
+        self.assertEqual(operation.call_count, 2)
+        onRetry.assert_called_once()
+        mockSleep.assert_called_once()
+
+    @patch('connections.time.sleep')
+    def test_callAttemptsExhausted(self, mockSleep: MagicMock):
+        backoff: Backoff = Backoff({'maxAttempts': 3})
+        operation: MagicMock = MagicMock(side_effect=RedisConnectionError('down'))
+        with self.assertRaises(RedisConnectionError):
+            backoff.call(operation, REDIS_CONNECTION_ERRORS, 'ping', self.logger)
+        self.assertEqual(operation.call_count, 3)
+        self.assertEqual(mockSleep.call_count, 2)
+
+    @patch('connections.time.sleep')
+    def test_callOtherError(self, mockSleep: MagicMock):
+        backoff: Backoff = Backoff({})
+        operation: MagicMock = MagicMock(side_effect=ValueError('bad reply'))
+        with self.assertRaises(ValueError):
+            backoff.call(operation, REDIS_CONNECTION_ERRORS, 'ping', self.logger)
+        operation.assert_called_once()
+        mockSleep.assert_not_called()
+
+
+class TestRedisPool(unittest.TestCase):
+
+    def test_createRedisPool(self):
+        pool = createRedisPool({'host': 'kvs', 'port': 6379, 'maxConnections': 4, 'healthCheckInterval': 10,
+                                'socketTimeout': 2})
+        self.assertEqual(pool.max_connections, 4)
+        self.assertEqual(pool.connection_kwargs['host'], 'kvs')
+        self.assertEqual(pool.connection_kwargs['health_check_interval'], 10)
+        self.assertEqual(pool.connection_kwargs['socket_timeout'], 2)
+
+    @patch('redis.connection.Connection.connect')
+    def test_getPoolStats(self, mockConnect: MagicMock):
+        pool = createRedisPool({'host': 'kvs', 'port': 6379, 'maxConnections': 4})
+        self.assertEqual({'redis_pool_max_connections': 4, 'redis_pool_connections': 0,
+                          'redis_pool_connections_in_use': 0}, getPoolStats(pool))
+        # connections are only opened when a command is sent
+        first = pool.get_connection('PING')
+        second = pool.get_connection('PING')
+        pool.release(first)
+        self.assertEqual({'redis_pool_max_connections': 4, 'redis_pool_connections': 2,
+                          'redis_pool_connections_in_use': 1}, getPoolStats(pool))
+        pool.release(second)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+from encoding import Encoder, EncodingProfile, parseEncodingProfiles
+from helper import setupLogging
+from logging import Logger
+from rendition import Rendition
+from unittest.mock import patch, MagicMock
+
+
+class TestEncoding(unittest.TestCase):
+    logger: Logger = setupLogging()
+
+    def test_parseEncodingProfiles(self):
+        profiles = parseEncodingProfiles({"profiles": {"JPEG": {"quality": 70}, "gif": {"strip": False}}})
+        # overrides are merged into the default profile
+        self.assertEqual(profiles["jpeg"], EncodingProfile(70, True, "4:2:0", True, {}))
+        self.assertEqual(profiles["gif"], EncodingProfile(strip=False))
+        self.assertEqual(profiles["webp"].options, {"webp:method": "4"})
+
+    def test_apply(self):
+        img: MagicMock = MagicMock()
+        Encoder({}, self.logger).apply(img, "jpeg")
+        self.assertEqual(img.format, "jpeg")
+        img.strip.assert_called_once_with()
+        self.assertEqual(img.compression_quality, 82)
+        self.assertEqual(img.interlace_scheme, "plane")
+        img.options.__setitem__.assert_called_once_with("jpeg:sampling-factor", "4:2:0")
+
+    def test_applyResetsPreviousSettings(self):
+        img: MagicMock = MagicMock()
+        encoder: Encoder = Encoder({"profiles": {"png": {"strip": False}}}, self.logger)
+        encoder.apply(img, "jpeg")
+        encoder.apply(img, "png")
+        self.assertEqual(img.format, "png")
+        img.strip.assert_called_once_with()
+        self.assertEqual(img.compression_quality, 0)
+        self.assertEqual(img.interlace_scheme, "no")
+        img.options.__setitem__.assert_called_with("png:compression-level", "6")
+
+    @patch('encoding.formats')
+    def test_resolveRendition(self, mockFormats: MagicMock):
+        mockFormats.side_effect = lambda pattern: ["WEBP"] if pattern == "WEBP" else []
+        encoder: Encoder = Encoder({}, self.logger)
+        self.assertEqual(encoder.resolveRendition(Rendition(256, "webp")), Rendition(256, "webp"))
+        self.assertEqual(encoder.resolveRendition(Rendition(256, "avif")), Rendition(256, "jpeg"))
+        self.assertEqual(encoder.resolveRendition(Rendition(256, "avif")), Rendition(256, "jpeg"))
+        self.assertEqual(encoder.resolveRendition(Rendition(256, "gif")), Rendition(256, "gif"))
+        # availability is checked once per format
+        self.assertEqual(mockFormats.call_count, 2)
+
+    def test_chooseFormat(self):
+        encoder: Encoder = Encoder({"pngFastPathSize": 128}, self.logger)
+        rendition: Rendition = Rendition(100, "jpeg")
+        self.assertEqual(encoder.chooseFormat(rendition, MagicMock(alpha_channel=True, width=100, height=80),
+                                              "/img/thumbnail/1.png"), "png")
+        self.assertEqual(encoder.chooseFormat(rendition, MagicMock(alpha_channel=False, width=100, height=80),
+                                              "/img/thumbnail/1.png"), "jpeg")
+        self.assertEqual(encoder.chooseFormat(rendition, MagicMock(alpha_channel=True, width=100, height=80),
+                                              "/img/thumbnail/1_100.jpg"), "jpeg")
+        self.assertEqual(encoder.chooseFormat(rendition, MagicMock(alpha_channel=True, width=200, height=80),
+                                              "/img/thumbnail/1.png"), "jpeg")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+from geometry import Geometry, fitGeometry, preScaleFactor
+
+
+class TestGeometry(unittest.TestCase):
+
+    def test_box(self):
+        self.assertEqual(fitGeometry(772, 563, 100), Geometry(100, 73, 100, 73))
+        self.assertEqual(fitGeometry(201, 201, 100), Geometry(100, 100, 100, 100))
+        self.assertEqual(fitGeometry(10000, 10, 100), Geometry(100, 1, 100, 1))
+        # never upscaled
+        self.assertEqual(fitGeometry(80, 63, 100), Geometry(80, 63, 80, 63))
+
+    def test_cover(self):
+        self.assertEqual(fitGeometry(772, 563, 100, "cover"), Geometry(137, 100, 100, 100))
+        self.assertEqual(fitGeometry(120, 80, 100, "cover"), Geometry(120, 80, 100, 80))
+
+    def test_area(self):
+        width, height, _, _ = fitGeometry(772, 563, 100, "area")
+        self.assertEqual((width, height), (117, 85))
+        self.assertLessEqual(width * height, 100 * 100)
+        width, height, _, _ = fitGeometry(3000, 1000, 100, "area")
+        self.assertLessEqual(width * height, 100 * 100)
+        self.assertAlmostEqual(width / height, 3, delta=0.05)
+
+    def test_unknownMode(self):
+        with self.assertRaises(ValueError):
+            fitGeometry(772, 563, 100, "stretch")
+
+    def test_preScaleFactor(self):
+        self.assertEqual(preScaleFactor(4000, 3000, Geometry(100, 75, 100, 75)), 8)
+        self.assertEqual(preScaleFactor(4000, 3000, Geometry(512, 384, 512, 384)), 2)
+        self.assertEqual(preScaleFactor(801, 601, Geometry(100, 75, 100, 75)), 4)
+        self.assertEqual(preScaleFactor(300, 200, Geometry(100, 67, 100, 67)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
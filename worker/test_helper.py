@@ -1,13 +1,27 @@
 import unittest
 from unittest.mock import patch, mock_open
-from helper import readConf, setupLogging
-from logging import Logger
+from helper import readConf, setupLogging, stopLogging
+from logging import Logger, INFO, DEBUG
+from logging.handlers import QueueHandler
 
 
 class TestHelper(unittest.TestCase):
     def test_setupLogging(self):
         logger: Logger = setupLogging()
         self.assertIsInstance(logger, Logger)
+        self.assertEqual(logger.level, DEBUG)
+        self.assertEqual(len(logger.handlers), 2)
+
+    def test_setupLoggingAsync(self):
+        logger: Logger = setupLogging({"level": "info", "async": True})
+        self.assertEqual(logger.level, INFO)
+        self.assertEqual(len(logger.handlers), 1)
+        self.assertIsInstance(logger.handlers[0], QueueHandler)
+        with patch('logging.FileHandler.emit') as mockEmit:
+            logger.info("job=%s", 1)
+            stopLogging()
+        self.assertEqual(mockEmit.call_args[0][0].getMessage(), "job=1")
+        setupLogging()
 
     @patch('builtins.open', mock_open(read_data='{"hello":"world"}'))
     def test_readConf(self):
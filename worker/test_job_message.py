@@ -0,0 +1,40 @@
+import unittest
+from job_message import JobRequest, parseJobMessage, formatJobMessage
+from rendition import Rendition
+
+
+class TestJobMessage(unittest.TestCase):
+    encoding: str = 'utf-8'
+
+    def test_parseJobMessageSingleId(self):
+        self.assertEqual(parseJobMessage(b'12', self.encoding), [JobRequest('12')])
+
+    def test_parseJobMessageBatch(self):
+        jobs = parseJobMessage(b'[1, "2", {"id": 3}, {"id": 4, "renditions": [{"size": 64, "format": "WEBP"}]}]',
+                               self.encoding)
+        self.assertEqual(jobs, [
+            JobRequest('1'), JobRequest('2'), JobRequest('3'), JobRequest('4', [Rendition(64, 'webp')])
+        ])
+
+    def test_parseJobMessageRedelivered(self):
+        self.assertEqual(parseJobMessage(b'[1, {"id": 2}]', self.encoding, True),
+                         [JobRequest('1', redelivered=True), JobRequest('2', redelivered=True)])
+
+    def test_parseJobMessageEmptyBatch(self):
+        self.assertEqual(parseJobMessage(b'[]', self.encoding), [])
+
+    def test_parseJobMessageMalformed(self):
+        for body in (b'abc', b'[1, ', b'{"id": 1}', b'[true]', b'[{"id": "x"}]', b'[{"id": 1, "renditions": [{}]}]'):
+            with self.assertRaises(ValueError):
+                parseJobMessage(body, self.encoding)
+
+
+    def test_formatJobMessage(self):
+        self.assertEqual(formatJobMessage([JobRequest('12')], self.encoding), b'12')
+        jobs = [JobRequest('1'), JobRequest('4', [Rendition(64, 'webp')])]
+        body: bytes = formatJobMessage(jobs, self.encoding)
+        self.assertEqual(body, b'[1,{"id":4,"renditions":[{"size":64,"format":"webp"}]}]')
+        self.assertEqual(parseJobMessage(body, self.encoding), jobs)
+
+if __name__ == '__main__':
+    unittest.main()
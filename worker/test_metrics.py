@@ -0,0 +1,96 @@
+import unittest
+from urllib.request import urlopen
+from metrics import Histogram, WorkerMetrics
+from helper import setupLogging
+from logging import Logger
+from constants import DECODE_STAGE, RESIZE_STAGE
+
+
+class TestMetrics(unittest.TestCase):
+    logger: Logger = setupLogging()
+
+    def test_histogramObserve(self):
+        histogram: Histogram = Histogram((0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(7)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertAlmostEqual(histogram.sum, 7.65)
+
+    def test_timeStage(self):
+        metrics: WorkerMetrics = WorkerMetrics({}, self.logger)
+        with metrics.time(DECODE_STAGE):
+            pass
+        with self.assertRaises(ValueError):
+            with metrics.time(RESIZE_STAGE):
+                raise ValueError()
+        self.assertEqual(sum(metrics.histograms[DECODE_STAGE].counts), 1)
+        self.assertEqual(sum(metrics.histograms[RESIZE_STAGE].counts), 1)
+
+    def test_render(self):
+        metrics: WorkerMetrics = WorkerMetrics({}, self.logger)
+        metrics.observe(DECODE_STAGE, 0.003)
+        metrics.observe(DECODE_STAGE, 20)
+        metrics.countJob(True)
+        metrics.countJob(False)
+        metrics.countJob(True)
+        metrics.addMegapixels(6000, 4000)
+        text: str = metrics.render()
+        self.assertIn('worker_stage_duration_seconds_bucket{stage="decode",le="0.0025"} 0', text)
+        self.assertIn('worker_stage_duration_seconds_bucket{stage="decode",le="0.005"} 1', text)
+        self.assertIn('worker_stage_duration_seconds_bucket{stage="decode",le="+Inf"} 2', text)
+        self.assertIn('worker_stage_duration_seconds_count{stage="decode"} 2', text)
+        self.assertIn('worker_stage_duration_seconds_count{stage="ack"} 0', text)
+        self.assertIn('worker_jobs_total{status="completed"} 2', text)
+        self.assertIn('worker_jobs_total{status="errored"} 1', text)
+        self.assertIn('worker_input_megapixels_total 24.0', text)
+        self.assertNotIn('worker_startup_seconds', text)
+        metrics.startupSeconds = 0.25
+        self.assertIn('worker_startup_seconds 0.25', metrics.render())
+
+    def test_renderConnectionStats(self):
+        metrics: WorkerMetrics = WorkerMetrics({}, self.logger)
+        metrics.connectionStats = lambda: {'redis_pool_connections_in_use': 3, 'amqp_reconnects_total': 1}
+        text: str = metrics.render()
+        self.assertIn('# TYPE worker_redis_pool_connections_in_use gauge', text)
+        self.assertIn('worker_redis_pool_connections_in_use 3', text)
+        self.assertIn('# TYPE worker_amqp_reconnects_total counter', text)
+        self.assertIn('worker_amqp_reconnects_total 1', text)
+
+    def test_flushAndMerge(self):
+        poolMetrics: WorkerMetrics = WorkerMetrics({}, self.logger)
+        poolMetrics.observe(DECODE_STAGE, 0.5)
+        poolMetrics.countJob(True)
+        poolMetrics.addMegapixels(1000, 1000)
+        metrics: WorkerMetrics = WorkerMetrics({}, self.logger)
+        metrics.observe(DECODE_STAGE, 0.5)
+        metrics.merge(poolMetrics.flush())
+        self.assertEqual(sum(metrics.histograms[DECODE_STAGE].counts), 2)
+        self.assertEqual(metrics.jobCounts["completed"], 1)
+        self.assertEqual(metrics.megapixels, 1.0)
+        # flush resets metrics
+        self.assertEqual(sum(poolMetrics.histograms[DECODE_STAGE].counts), 0)
+        self.assertEqual(poolMetrics.jobCounts["completed"], 0)
+
+    def test_startDisabled(self):
+        metrics: WorkerMetrics = WorkerMetrics({}, self.logger)
+        metrics.start()
+        self.assertIsNone(metrics.server)
+
+    def test_serveMetrics(self):
+        metrics: WorkerMetrics = WorkerMetrics({"enabled": True, "port": 0}, self.logger)
+        metrics.countJob(True)
+        metrics.start()
+        try:
+            port: int = metrics.server.server_address[1]
+            with urlopen("http://127.0.0.1:%s/metrics" % port) as response:
+                self.assertEqual(response.status, 200)
+                self.assertIn('worker_jobs_total{status="completed"} 1', response.read().decode("utf-8"))
+        finally:
+            metrics.server.shutdown()
+            metrics.server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import threading
+import time
+import unittest
+import pixel_budget
+from multiprocessing import get_context
+from pixel_budget import PixelBudget, HostPixelBudget, ImageTooLargeError
+from helper import setupLogging
+from logging import Logger
+from typing import Dict
+from unittest.mock import patch, MagicMock
+
+
+class TestPixelBudget(unittest.TestCase):
+    logger: Logger = setupLogging()
+
+    def setUp(self):
+        self.budget: PixelBudget = PixelBudget(
+            {"enabled": True, "maxImagePixels": 1000, "processPixels": 100, "admissionTimeout": 0.01,
+             "constrainedMemory": 42}, self.logger
+        )
+        self.hostBudget: HostPixelBudget = HostPixelBudget(150, 2, get_context("fork"))
+
+    def tearDown(self):
+        pixel_budget.hostBudget = None
+
+    def test_estimatePixels(self):
+        self.assertEqual(PixelBudget.estimatePixels(4000, 3000, 1), 12000000)
+        self.assertEqual(PixelBudget.estimatePixels(4000, 3000, 8), 500 * 375)
+        # decoders round partial blocks up
+        self.assertEqual(PixelBudget.estimatePixels(4001, 3001, 2), 2001 * 1501)
+
+    def test_admitDisabled(self):
+        budget: PixelBudget = PixelBudget({}, self.logger)
+        with budget.admit(10 ** 12):
+            pass
+
+    def test_admitTooLarge(self):
+        with self.assertRaises(ImageTooLargeError):
+            with self.budget.admit(1001):
+                pass
+
+    @patch('wand.resource.limits')
+    def test_admitWithinBudget(self, mockLimits: MagicMock):
+        pixel_budget.hostBudget = self.hostBudget
+        with self.budget.admit(100):
+            self.assertEqual(sum(self.hostBudget.inUse), 100)
+        self.assertEqual(sum(self.hostBudget.inUse), 0)
+        mockLimits.__setitem__.assert_not_called()
+
+    @patch('wand.resource.limits')
+    def test_admitOverProcessBudget(self, mockLimits: MagicMock):
+        pixel_budget.hostBudget = self.hostBudget
+        mockLimits.__getitem__.side_effect = {"memory": 1000, "map": 2000}.get
+        with self.budget.admit(101):
+            mockLimits.__setitem__.assert_any_call("memory", 42)
+            mockLimits.__setitem__.assert_any_call("map", 42)
+            self.assertEqual(sum(self.hostBudget.inUse), 0)
+        mockLimits.__setitem__.assert_any_call("memory", 1000)
+        mockLimits.__setitem__.assert_any_call("map", 2000)
+
+    def test_limitResourcesConcurrently(self):
+        limits: Dict[str, int] = {"memory": 1000, "map": 2000}
+        # decodes of two threads overlap: limits are restored when the last one is over
+        with patch('wand.resource.limits', limits), self.budget.limitResources():
+            with self.budget.limitResources():
+                self.assertEqual(limits["memory"], 42)
+            self.assertEqual(limits["memory"], 42)
+        self.assertEqual(limits, {"memory": 1000, "map": 2000})
+
+    @patch('wand.resource.limits')
+    def test_admitHostBudgetExhausted(self, mockLimits: MagicMock):
+        pixel_budget.hostBudget = self.hostBudget
+        self.hostBudget.inUse[1] = 100
+        with self.budget.admit(60):
+            mockLimits.__setitem__.assert_any_call("memory", 42)
+        self.assertEqual(list(self.hostBudget.inUse), [0, 100])
+
+    @patch('wand.resource.limits')
+    def test_admitProcessBudgetSharedByThreads(self, mockLimits: MagicMock):
+        pixel_budget.hostBudget = self.hostBudget
+        with self.budget.admit(60):
+            self.assertEqual(self.budget.inUse, 60)
+            # an image decoded meanwhile by another thread does not fit in what is left of the process budget
+            with self.budget.admit(60):
+                mockLimits.__setitem__.assert_any_call("memory", 42)
+                self.assertEqual(self.budget.inUse, 60)
+            self.assertEqual(sum(self.hostBudget.inUse), 60)
+        self.assertEqual(self.budget.inUse, 0)
+        self.assertEqual(sum(self.hostBudget.inUse), 0)
+
+    def test_processBudgetWaitsForRelease(self):
+        self.assertTrue(self.budget.acquire(80, 0))
+        releaser: threading.Timer = threading.Timer(0.01, self.budget.release, (80,))
+        releaser.start()
+        self.assertTrue(self.budget.acquire(50, time.monotonic() + 5))
+        releaser.join()
+        self.assertEqual(self.budget.inUse, 50)
+
+    def test_hostBudget(self):
+        self.assertTrue(self.hostBudget.acquire(200, 0))
+        self.assertFalse(self.hostBudget.acquire(1, 0.01))
+        self.hostBudget.release(200)
+        self.assertTrue(self.hostBudget.acquire(100, 0))
+        self.assertTrue(self.hostBudget.acquire(50, 0))
+        self.hostBudget.reset(0)
+        self.assertEqual(sum(self.hostBudget.inUse), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+import resize_backend
+from resize_backend import WandResizeBackend, NumpyResizeBackend, createResizeBackend
+from unittest.mock import patch, MagicMock
+
+
+class TestCreateResizeBackend(unittest.TestCase):
+
+    def test_wandByDefault(self):
+        self.assertIsInstance(createResizeBackend({}), WandResizeBackend)
+
+    def test_unknownBackend(self):
+        with self.assertRaises(ValueError):
+            createResizeBackend({"backend": "pillow"})
+
+    @patch('resize_backend.numpy', None)
+    def test_numpyNotInstalled(self):
+        with self.assertRaises(ValueError):
+            createResizeBackend({"backend": "numpy"})
+
+    def test_wandResize(self):
+        img: MagicMock = MagicMock()
+        WandResizeBackend().resize(img, 100, 75)
+        img.resize.assert_called_once_with(100, 75)
+
+
+@unittest.skipIf(resize_backend.numpy is None, "numpy is not installed")
+class TestNumpyResizeBackend(unittest.TestCase):
+
+    def setUp(self):
+        numpy = resize_backend.numpy
+        self.pixels = numpy.random.RandomState(42).randint(0, 256, (40, 60, 3)).astype(numpy.uint8)
+
+    def test_createNumpyBackend(self):
+        backend = createResizeBackend({"backend": "numpy", "filter": "box"})
+        self.assertIsInstance(backend, NumpyResizeBackend)
+        self.assertEqual(backend.resizeFilter, "box")
+        with self.assertRaises(ValueError):
+            createResizeBackend({"backend": "numpy", "filter": "bicubic"})
+
+    def test_boxIntegerFactor(self):
+        numpy = resize_backend.numpy
+        resized = NumpyResizeBackend("box").resizeArray(self.pixels, 15, 10)
+        # every output pixel is the mean of a 4 x 4 block
+        expected = self.pixels.reshape(10, 4, 15, 4, 3).astype(numpy.float64).mean(axis=(1, 3))
+        self.assertEqual(resized.shape, (10, 15, 3))
+        self.assertLessEqual(numpy.abs(resized - expected).max(), 0.5 + 1e-3)
+
+    def test_lanczosKeepsFlatImage(self):
+        numpy = resize_backend.numpy
+        flat = numpy.full((40, 60, 4), 200, dtype=numpy.uint8)
+        resized = NumpyResizeBackend("lanczos").resizeArray(flat, 17, 11)
+        self.assertEqual(resized.shape, (11, 17, 4))
+        self.assertTrue((resized == 200).all())
+
+    def test_stack(self):
+        numpy = resize_backend.numpy
+        backend: NumpyResizeBackend = NumpyResizeBackend("lanczos")
+        stack = numpy.stack([self.pixels, self.pixels[::-1]])
+        resized = backend.resizeArray(stack, 25, 16)
+        self.assertEqual(resized.shape, (2, 16, 25, 3))
+        self.assertTrue((resized[0] == backend.resizeArray(self.pixels, 25, 16)).all())
+        self.assertTrue((resized[1] == backend.resizeArray(self.pixels[::-1], 25, 16)).all())
+
+    def test_weightCacheIsBounded(self):
+        with patch("resize_backend.RESIZE_WEIGHT_CACHE_SIZE", 2):
+            backend: NumpyResizeBackend = NumpyResizeBackend("box")
+        for inputSize in (40, 41, 42, 40):
+            backend.getWeights(inputSize, 10)
+        self.assertEqual(backend.getWeights.cache_info().currsize, 2)
+        self.assertEqual(backend.getWeights.cache_info().hits, 0)
+        backend.getWeights(40, 10)
+        self.assertEqual(backend.getWeights.cache_info().hits, 1)
+
+    def test_resizeImage(self):
+        img: MagicMock = MagicMock(width=60, height=40, alpha_channel=False)
+        img.make_blob.return_value = self.pixels.tobytes()
+        backend: NumpyResizeBackend = NumpyResizeBackend("box")
+        backend.resize(img, 15, 10)
+        img.make_blob.assert_called_once_with("RGB")
+        img.sample.assert_called_once_with(15, 10)
+        img.import_pixels.assert_called_once_with(width=15, height=10, channel_map="RGB", storage="char",
+                                                  data=backend.resizeArray(self.pixels, 15, 10).tobytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
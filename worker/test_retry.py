@@ -0,0 +1,74 @@
+import errno
+import unittest
+from helper import setupLogging
+from logging import Logger
+from redis.exceptions import ConnectionError as RedisConnectionError
+from job_message import JobRequest
+from retry import RetryPolicy, TransientError, isTransient
+from unittest.mock import MagicMock
+
+
+class TestIsTransient(unittest.TestCase):
+
+    def test_transientErrors(self):
+        self.assertTrue(isTransient(TransientError('s3 is unreachable')))
+        self.assertTrue(isTransient(ConnectionResetError()))
+        self.assertTrue(isTransient(TimeoutError()))
+        self.assertTrue(isTransient(MemoryError()))
+        self.assertTrue(isTransient(RedisConnectionError()))
+        self.assertTrue(isTransient(OSError(errno.ENOSPC, 'No space left on device')))
+
+    def test_permanentErrors(self):
+        self.assertFalse(isTransient(FileNotFoundError(errno.ENOENT, 'No such file or directory')))
+        # ImageMagick read errors carry no errno
+        self.assertFalse(isTransient(OSError('unable to open image')))
+        self.assertFalse(isTransient(ValueError('corrupt image')))
+
+
+class TestRetryPolicy(unittest.TestCase):
+    logger: Logger = setupLogging()
+
+    def setUp(self):
+        self.policy: RetryPolicy = RetryPolicy(
+            {'enabled': True, 'maxAttempts': 3, 'baseDelay': 2, 'maxDelay': 5}, 'thumbnail', 'utf-8', self.logger
+        )
+        self.channel: MagicMock = MagicMock()
+
+    def test_constructor(self):
+        policy: RetryPolicy = RetryPolicy({}, 'thumbnail', 'utf-8', self.logger)
+        self.assertFalse(policy.enabled)
+        self.assertEqual(policy.maxAttempts, 5)
+        self.assertEqual(policy.deadLetterQueue, 'thumbnail.dead')
+
+    def test_getDelay(self):
+        self.assertEqual([self.policy.getDelay(attempt) for attempt in range(1, 5)], [2, 4, 5, 5])
+
+    def test_canRetryAndIsPoison(self):
+        self.assertTrue(self.policy.canRetry(2))
+        self.assertFalse(self.policy.canRetry(3))
+        self.assertFalse(self.policy.isPoison(3))
+        self.assertTrue(self.policy.isPoison(4))
+        self.assertFalse(RetryPolicy({}, 'thumbnail', 'utf-8', self.logger).isPoison(100))
+
+    def test_publishRetry(self):
+        self.policy.publishRetry(self.channel, 'small', [JobRequest('1'), JobRequest('2')], 2)
+        self.policy.publishRetry(self.channel, 'small', [JobRequest('3')], 2)
+        # delay queue is declared once
+        self.channel.queue_declare.assert_called_once_with('small.retry.4000ms', durable=True, arguments={
+            'x-message-ttl': 4000, 'x-dead-letter-exchange': '', 'x-dead-letter-routing-key': 'small',
+        })
+        exchange, routingKey, body, properties = self.channel.basic_publish.call_args_list[0][0]
+        self.assertEqual((exchange, routingKey, body), ('', 'small.retry.4000ms', b'[1,2]'))
+        self.assertEqual(properties.headers, {'x-retry-count': 2})
+        self.assertEqual(properties.delivery_mode, 2)
+
+    def test_publishDeadLetter(self):
+        self.policy.publishDeadLetter(self.channel, JobRequest('7'), 3, 'Boom!')
+        self.channel.queue_declare.assert_called_once_with('thumbnail.dead', durable=True, arguments=None)
+        exchange, routingKey, body, properties = self.channel.basic_publish.call_args[0]
+        self.assertEqual((exchange, routingKey, body), ('', 'thumbnail.dead', b'7'))
+        self.assertEqual(properties.headers, {'x-retry-count': 3, 'x-error': 'Boom!'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+from scheduling import QueueClass, WeightedScheduler, parseQueueClasses, classifyFileSize, splitPrefetchCount
+from typing import List
+
+
+class TestScheduling(unittest.TestCase):
+    queueClasses: List[QueueClass] = [
+        QueueClass('small', 5, 1000), QueueClass('medium', 2, 100000), QueueClass('large', 1)
+    ]
+
+    def test_parseQueueClasses(self):
+        self.assertEqual(parseQueueClasses({'queueName': 'test_queue'}), [QueueClass('test_queue', 1)])
+        self.assertEqual(parseQueueClasses({'queueName': 'test_queue', 'queues': [
+            {'name': 'small', 'weight': 5, 'maxFileSize': 1000}, {'name': 'large', 'weight': 0}
+        ]}), [QueueClass('small', 5, 1000), QueueClass('large', 1)])
+
+    def test_classifyFileSize(self):
+        self.assertEqual(classifyFileSize(self.queueClasses, 1000).name, 'small')
+        self.assertEqual(classifyFileSize(self.queueClasses, 1001).name, 'medium')
+        self.assertEqual(classifyFileSize(self.queueClasses, 10 ** 9).name, 'large')
+        self.assertEqual(classifyFileSize(self.queueClasses, None).name, 'large')
+
+    def test_splitPrefetchCount(self):
+        self.assertEqual(splitPrefetchCount(self.queueClasses, 16), {'small': 10, 'medium': 4, 'large': 2})
+        self.assertEqual(splitPrefetchCount(self.queueClasses, 1), {'small': 1, 'medium': 1, 'large': 1})
+
+    def test_popSmoothWeightedRoundRobin(self):
+        scheduler: WeightedScheduler = WeightedScheduler(self.queueClasses)
+        for index in range(10):
+            for queueClass in self.queueClasses:
+                scheduler.push(queueClass.name, index)
+        served: List[str] = [scheduler.pop()[0] for _ in range(8)]
+        # heavy queue is interleaved with the others instead of being served in a burst
+        self.assertEqual(served, ['small', 'medium', 'small', 'small', 'large', 'small', 'medium', 'small'])
+        self.assertEqual(len(scheduler), 22)
+
+    def test_popDoesNotStarveLightQueue(self):
+        scheduler: WeightedScheduler = WeightedScheduler(self.queueClasses)
+        for index in range(100):
+            scheduler.push('small', index)
+        scheduler.push('large', 'big')
+        served: List[str] = [scheduler.pop()[0] for _ in range(6)]
+        self.assertIn('large', served)
+
+    def test_popEmpty(self):
+        scheduler: WeightedScheduler = WeightedScheduler(self.queueClasses)
+        self.assertIsNone(scheduler.pop())
+        scheduler.push('large', 1)
+        self.assertEqual(scheduler.pop(), ('large', 1))
+        self.assertIsNone(scheduler.pop())
+
+    def test_drain(self):
+        scheduler: WeightedScheduler = WeightedScheduler(self.queueClasses)
+        scheduler.push('small', 1)
+        scheduler.push('large', 2)
+        self.assertEqual(scheduler.drain(), [1, 2])
+        self.assertEqual(len(scheduler), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
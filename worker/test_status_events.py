@@ -0,0 +1,38 @@
+import unittest
+from job_status_enum import JobStatusEnum
+from status_events import StatusEvents
+from constants import DEFAULT_STATUS_STREAM
+from unittest.mock import MagicMock
+
+
+class TestStatusEvents(unittest.TestCase):
+
+    def test_disabled(self):
+        statusEvents: StatusEvents = StatusEvents({})
+        pipeline: MagicMock = MagicMock()
+        statusEvents.add(pipeline, '1', JobStatusEnum.COMPLETE)
+        pipeline.xadd.assert_not_called()
+        pipeline.publish.assert_not_called()
+        self.assertEqual(['', 0, ''], statusEvents.getScriptArgs())
+
+    def test_addToStream(self):
+        statusEvents: StatusEvents = StatusEvents({'enabled': True, 'maxLength': 1000})
+        pipeline: MagicMock = MagicMock()
+        statusEvents.add(pipeline, '1', JobStatusEnum.COMPLETE)
+        pipeline.xadd.assert_called_once_with(
+            DEFAULT_STATUS_STREAM, {'job': '1', 'status': JobStatusEnum.COMPLETE.value}, maxlen=1000, approximate=True
+        )
+        pipeline.publish.assert_not_called()
+        self.assertEqual([DEFAULT_STATUS_STREAM, 1000, ''], statusEvents.getScriptArgs())
+
+    def test_addToChannel(self):
+        statusEvents: StatusEvents = StatusEvents({'enabled': True, 'stream': 'events', 'channel': 'status'})
+        pipeline: MagicMock = MagicMock()
+        statusEvents.add(pipeline, '1', JobStatusEnum.ERROR_DURING_PROCESSING)
+        pipeline.xadd.assert_called_once()
+        pipeline.publish.assert_called_once_with('status', '1:%s' % JobStatusEnum.ERROR_DURING_PROCESSING.value)
+        self.assertEqual(['events', 100000, 'status'], statusEvents.getScriptArgs())
+
+
+if __name__ == '__main__':
+    unittest.main()
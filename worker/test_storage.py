@@ -0,0 +1,160 @@
+import os
+import tempfile
+import unittest
+import storage
+from logging import getLogger
+from storage import LocalStorage, S3Storage, createStorage
+from retry import TransientError
+from unittest.mock import patch, MagicMock, call
+try:
+    from moto import mock_s3
+except ImportError:
+    # S3 tests run against the in-process fake server of moto when it is installed
+    mock_s3 = None
+
+
+class TestCreateStorage(unittest.TestCase):
+
+    def test_localByDefault(self):
+        self.assertIsInstance(createStorage({"thumbnailPath": "/img/thumbnail/"}, getLogger("test")), LocalStorage)
+
+    def test_unknownBackend(self):
+        with self.assertRaises(ValueError):
+            createStorage({"thumbnailPath": "/img/thumbnail/", "backend": "ftp"}, getLogger("test"))
+
+    @patch('storage.boto3', None)
+    def test_boto3NotInstalled(self):
+        with self.assertRaises(ValueError):
+            createStorage({"thumbnailPath": "/img/thumbnail/", "backend": "s3", "s3": {"bucket": "img"}},
+                          getLogger("test"))
+
+
+class TestLocalStorage(unittest.TestCase):
+
+    def setUp(self):
+        tmpDir: tempfile.TemporaryDirectory = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpDir.cleanup)
+        self.thumbnailDir: str = tmpDir.name + os.sep
+        self.storage: LocalStorage = LocalStorage({"thumbnailPath": self.thumbnailDir}, getLogger("test"))
+
+    def test_getThumbnailDirWithoutSharding(self):
+        self.assertEqual(self.thumbnailDir, self.storage.getThumbnailDir("test.jpg"))
+
+    def test_getThumbnailDirSharded(self):
+        storage: LocalStorage = LocalStorage({"thumbnailPath": "/img/thumbnail/", "shardDepth": 2}, getLogger("test"))
+        thumbnailDir: str = storage.getThumbnailDir("test.jpg")
+        self.assertRegex(thumbnailDir, r"^/img/thumbnail/[0-9a-f]{2}/[0-9a-f]{2}/$")
+        self.assertEqual(thumbnailDir, storage.getThumbnailDir("test.jpg"))
+        self.assertNotEqual(thumbnailDir, storage.getThumbnailDir("other.jpg"))
+
+    def test_fetchInPlace(self):
+        with self.storage.fetch("/img/uploaded/test.jpg") as localPath:
+            self.assertEqual("/img/uploaded/test.jpg", localPath)
+
+    def test_getSize(self):
+        self.assertEqual(os.path.getsize(__file__), self.storage.getSize(__file__))
+        self.assertIsNone(self.storage.getSize(os.path.join(self.thumbnailDir, "missing.jpg")))
+
+    def test_write(self):
+        path: str = os.path.join(self.thumbnailDir, "3f", "a0", "test.jpg")
+        self.storage.write(path, b"first")
+        self.storage.write(path, b"second")
+        with open(path, "rb") as stream:
+            self.assertEqual(b"second", stream.read())
+        # no temporary file is left behind
+        self.assertEqual(["test.jpg"], os.listdir(os.path.dirname(path)))
+
+    @patch('storage.os.replace')
+    def test_writeFailure(self, mockReplace: MagicMock):
+        mockReplace.side_effect = OSError("disk full")
+        path: str = os.path.join(self.thumbnailDir, "test.jpg")
+        with self.assertRaises(OSError):
+            self.storage.write(path, b"data")
+        self.assertEqual([], os.listdir(self.thumbnailDir))
+
+    @patch('storage.os.fsync')
+    def test_syncDisabled(self, mockFsync: MagicMock):
+        self.storage.sync([os.path.join(self.thumbnailDir, "test.jpg")])
+        mockFsync.assert_not_called()
+
+    @patch('storage.os.fsync')
+    def test_syncFilesThenDirectories(self, mockFsync: MagicMock):
+        storage: LocalStorage = LocalStorage({"thumbnailPath": self.thumbnailDir, "fsync": True}, getLogger("test"))
+        paths = [os.path.join(self.thumbnailDir, name) for name in ("a.jpg", "b.jpg")]
+        for path in paths:
+            storage.write(path, b"data")
+        with patch.object(storage, 'syncPath', wraps=storage.syncPath) as mockSyncPath:
+            storage.sync(paths + paths[:1])
+        self.assertEqual(sorted(paths), sorted(args[0] for args, _ in mockSyncPath.call_args_list[:2]))
+        self.assertEqual(call(os.path.dirname(paths[0])), mockSyncPath.call_args_list[2])
+        self.assertEqual(3, mockFsync.call_count)
+
+    def test_syncMissingFile(self):
+        logger: MagicMock = MagicMock()
+        storage: LocalStorage = LocalStorage({"thumbnailPath": self.thumbnailDir, "fsync": True}, logger)
+        storage.sync([os.path.join(self.thumbnailDir, "missing.jpg")])
+        logger.error.assert_called_once()
+
+
+@unittest.skipIf(storage.boto3 is None or mock_s3 is None, "boto3 or moto is not installed")
+class TestS3Storage(unittest.TestCase):
+
+    def setUp(self):
+        # recent botocore checksum trailers are not understood by every fake server
+        environ = patch.dict(os.environ, AWS_ACCESS_KEY_ID="test", AWS_SECRET_ACCESS_KEY="test",
+                             AWS_REQUEST_CHECKSUM_CALCULATION="when_required")
+        environ.start()
+        self.addCleanup(environ.stop)
+        server = mock_s3()
+        server.start()
+        self.addCleanup(server.stop)
+        self.storage: S3Storage = createStorage({
+            "thumbnailPath": "/img/thumbnail/", "backend": "s3",
+            "s3": {"bucket": "img", "region": "us-east-1", "rangeSize": 1000, "rangeConcurrency": 3},
+        }, getLogger("test"))
+        self.storage.getClient().create_bucket(Bucket="img")
+        self.data: bytes = bytes(range(256)) * 20
+
+    def test_missingBucket(self):
+        with self.assertRaises(ValueError):
+            createStorage({"thumbnailPath": "/img/thumbnail/", "backend": "s3"}, getLogger("test"))
+
+    def test_writeAndFetch(self):
+        self.storage.write("/img/uploaded/test.jpg", self.data)
+        obj: dict = self.storage.getClient().get_object(Bucket="img", Key="img/uploaded/test.jpg")
+        self.assertEqual("image/jpeg", obj["ContentType"])
+        self.assertEqual(len(self.data), self.storage.getSize("/img/uploaded/test.jpg"))
+        # 5120 bytes are read by 6 ranges
+        with self.storage.fetch("/img/uploaded/test.jpg") as localPath:
+            self.assertTrue(localPath.endswith(".jpg"))
+            with open(localPath, "rb") as stream:
+                self.assertEqual(self.data, stream.read())
+        self.assertFalse(os.path.exists(localPath))
+
+    def test_fetchSmallFile(self):
+        self.storage.write("/img/uploaded/small.png", b"small")
+        with self.storage.fetch("/img/uploaded/small.png") as localPath:
+            with open(localPath, "rb") as stream:
+                self.assertEqual(b"small", stream.read())
+
+    def test_missingFile(self):
+        self.assertIsNone(self.storage.getSize("/img/uploaded/missing.jpg"))
+        with self.assertRaises(FileNotFoundError):
+            with self.storage.fetch("/img/uploaded/missing.jpg"):
+                pass
+
+    def test_translateError(self):
+        def clientError(code: str, status: int):
+            return storage.ClientError({"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}}, "Get")
+        self.assertIsInstance(S3Storage.translateError(clientError("SlowDown", 503)), TransientError)
+        self.assertIsInstance(S3Storage.translateError(clientError("InternalError", 500)), TransientError)
+        self.assertIsInstance(S3Storage.translateError(storage.BotoCoreError()), TransientError)
+        accessDenied = clientError("AccessDenied", 403)
+        self.assertIs(S3Storage.translateError(accessDenied), accessDenied)
+
+    def test_syncIsNoop(self):
+        self.storage.sync(["/img/thumbnail/test.jpg"])
+
+
+if __name__ == '__main__':
+    unittest.main()
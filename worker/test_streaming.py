@@ -0,0 +1,196 @@
+import os
+import struct
+import tempfile
+import time
+import tracemalloc
+import unittest
+import zlib
+import streaming
+from streaming import openRasterStream, streamResize, toNetpbm, PnmStream, PngStream, TiffStream
+from unittest.mock import patch
+
+
+def paeth(left: int, up: int, upLeft: int) -> int:
+    estimate: int = left + up - upLeft
+    distances = [abs(estimate - left), abs(estimate - up), abs(estimate - upLeft)]
+    return [left, up, upLeft][distances.index(min(distances))]
+
+
+def encodePng(pixels, colorType: int) -> bytes:
+    """
+    Encode 8 bit pixels as PNG, rows cycling through every filter type
+    """
+    height, width, channels = pixels.shape
+    step: int = channels
+    filtered: bytearray = bytearray()
+    prior: bytes = bytes(width * channels)
+    for rowIndex in range(height):
+        row: bytes = pixels[rowIndex].tobytes()
+        filterType: int = rowIndex % 5
+        filtered.append(filterType)
+        for index, value in enumerate(row):
+            left: int = row[index - step] if index >= step else 0
+            upLeft: int = prior[index - step] if index >= step else 0
+            predictor: int = [0, left, prior[index], (left + prior[index]) >> 1,
+                              paeth(left, prior[index], upLeft)][filterType]
+            filtered.append((value - predictor) & 0xFF)
+        prior = row
+
+    return writePng(bytes(filtered), width, height, colorType)
+
+
+def writePng(filtered: bytes, width: int, height: int, colorType: int) -> bytes:
+    """
+    Write filtered 8 bit rows, each starting with its filter type, as a PNG file
+    """
+    def chunk(chunkType: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + chunkType + data + struct.pack(">I", zlib.crc32(chunkType + data))
+
+    compressed: bytes = zlib.compress(filtered)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, colorType, 0, 0, 0)) \
+        + chunk(b"IDAT", compressed[:len(compressed) // 2]) + chunk(b"IDAT", compressed[len(compressed) // 2:]) \
+        + chunk(b"IEND", b"")
+
+
+def encodeTiff(pixels, rowsPerStrip: int, compression: int = 1) -> bytes:
+    """
+    Encode 8 bit pixels as a little endian uncompressed TIFF stored in strips
+    """
+    height, width, channels = pixels.shape
+    rowBytes: int = width * channels
+    strips = [pixels[row:row + rowsPerStrip].tobytes() for row in range(0, height, rowsPerStrip)]
+    stripCount: int = len(strips)
+    entryCount: int = 9
+    ifdSize: int = 2 + entryCount * 12 + 4
+    offsetsOffset: int = 8 + ifdSize
+    countsOffset: int = offsetsOffset + 4 * stripCount
+    dataOffset: int = countsOffset + 4 * stripCount
+    stripOffsets = [dataOffset + sum(len(strip) for strip in strips[:index]) for index in range(stripCount)]
+
+    def entry(tag: int, fieldType: int, count: int, value: int) -> bytes:
+        packed: bytes = struct.pack("<H", value) + b"\x00\x00" if fieldType == 3 else struct.pack("<I", value)
+        return struct.pack("<HHI", tag, fieldType, count) + packed
+
+    ifd: bytes = struct.pack("<H", entryCount) + b"".join([
+        entry(256, 4, 1, width), entry(257, 4, 1, height), entry(258, 3, 1, 8), entry(259, 3, 1, compression),
+        entry(262, 3, 1, 1 if channels == 1 else 2), entry(273, 4, stripCount, offsetsOffset),
+        entry(277, 3, 1, channels), entry(278, 4, 1, rowsPerStrip),
+        entry(279, 4, stripCount, countsOffset),
+    ]) + b"\x00\x00\x00\x00"
+    return b"II*\x00" + struct.pack("<I", 8) + ifd + struct.pack("<%dI" % stripCount, *stripOffsets) \
+        + struct.pack("<%dI" % stripCount, *[min(rowsPerStrip, height - row) * rowBytes
+                                             for row in range(0, height, rowsPerStrip)]) + b"".join(strips)
+
+
+@unittest.skipIf(streaming.numpy is None, "numpy is not installed")
+class TestStreaming(unittest.TestCase):
+
+    def setUp(self):
+        numpy = streaming.numpy
+        self.pixels = numpy.random.RandomState(42).randint(0, 256, (37, 23, 3)).astype(numpy.uint8)
+        self.tempDir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def writeImage(self, name: str, content: bytes) -> str:
+        path: str = os.path.join(self.tempDir.name, name)
+        with open(path, "wb") as imageFile:
+            imageFile.write(content)
+        return path
+
+    def assertDecoded(self, path: str, streamType: type, pixels):
+        rasterStream = openRasterStream(path)
+        self.assertIsInstance(rasterStream, streamType)
+        with rasterStream:
+            self.assertEqual((rasterStream.height, rasterStream.width, rasterStream.channels), pixels.shape)
+            decoded = streaming.numpy.concatenate(list(rasterStream.iterStrips(4)))
+        self.assertTrue((decoded == pixels).all())
+
+    def test_ppm(self):
+        path: str = self.writeImage("image.ppm", b"P6\n# comment\n23 37\n255\n" + self.pixels.tobytes())
+        self.assertDecoded(path, PnmStream, self.pixels)
+
+    def test_pgm16Bit(self):
+        numpy = streaming.numpy
+        samples = numpy.arange(0, 65536, 257, dtype=">u2").reshape(16, 16)
+        path: str = self.writeImage("image.pgm", b"P5 16 16 65535\n" + samples.tobytes())
+        self.assertDecoded(path, PnmStream, (samples // 257).astype(numpy.uint8).reshape(16, 16, 1))
+
+    def test_png(self):
+        path: str = self.writeImage("image.png", encodePng(self.pixels, 2))
+        self.assertDecoded(path, PngStream, self.pixels)
+
+    def test_pngAlpha(self):
+        pixels = streaming.numpy.concatenate([self.pixels, self.pixels[:, :, :1]], axis=2)
+        path: str = self.writeImage("image.png", encodePng(pixels, 6))
+        self.assertDecoded(path, PngStream, pixels)
+
+    def test_pngShortBlocks(self):
+        path: str = self.writeImage("image.png", encodePng(self.pixels, 2))
+        # blocks of 5 rows are unfiltered row by row
+        with patch("streaming.STREAM_STRIP_BYTES", 23 * 3 * 5):
+            self.assertDecoded(path, PngStream, self.pixels)
+
+    def test_pngPaethSpeed(self):
+        numpy = streaming.numpy
+        width, height = 1000, 500
+        filtered = numpy.random.RandomState(42).randint(0, 256, (height, 1 + width * 3)).astype(numpy.uint8)
+        filtered[:, 0] = 4
+        path: str = self.writeImage("image.png", writePng(filtered.tobytes(), width, height, 2))
+        start: float = time.perf_counter()
+        # Paeth rows of big blocks are never reversed byte by byte
+        with openRasterStream(path) as rasterStream, patch.object(PngStream, "unfilter", side_effect=AssertionError):
+            rowCount: int = sum(len(rows) for rows in rasterStream.iterRows())
+        self.assertEqual(rowCount, height)
+        self.assertLess(time.perf_counter() - start, 1.0)
+
+    def test_pngNarrowPaethMemory(self):
+        numpy = streaming.numpy
+        width, height, stripBytes = 300, 1200, 1024 * 1024
+        filtered = numpy.random.RandomState(42).randint(0, 256, (height, 1 + width * 3)).astype(numpy.uint8)
+        filtered[:, 0] = 4
+        path: str = self.writeImage("image.png", writePng(filtered.tobytes(), width, height, 2))
+        # a read block holds about 1165 rows: the diagonal blocks of a narrow image are sized on their own
+        with patch("streaming.STREAM_STRIP_BYTES", stripBytes), openRasterStream(path) as rasterStream:
+            tracemalloc.start()
+            try:
+                rows = numpy.concatenate(list(rasterStream.iterRows()))
+                peak: int = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        self.assertLess(peak, 8 * stripBytes)
+        with patch("streaming.PNG_DIAGONAL_MIN_ROWS", height + 1), openRasterStream(path) as rasterStream:
+            self.assertTrue((rows == numpy.concatenate(list(rasterStream.iterRows()))).all())
+
+    def test_tiff(self):
+        path: str = self.writeImage("image.tif", encodeTiff(self.pixels, 5))
+        self.assertDecoded(path, TiffStream, self.pixels)
+
+    def test_unsupported(self):
+        self.assertIsNone(openRasterStream(self.writeImage("image.tif", encodeTiff(self.pixels, 5, compression=5))))
+        self.assertIsNone(openRasterStream(self.writeImage("image.jpg", b"\xff\xd8\xff\xe0")))
+        with patch("streaming.numpy", None):
+            self.assertIsNone(openRasterStream(self.writeImage("image.ppm", b"P6\n23 37\n255\n")))
+
+    def test_streamResize(self):
+        numpy = streaming.numpy
+        path: str = self.writeImage("image.tif", encodeTiff(self.pixels, 5))
+        with openRasterStream(path) as rasterStream, patch("streaming.STREAM_STRIP_BYTES", 23 * 3 * 7):
+            output = streamResize(rasterStream, 4)
+        self.assertEqual(output.shape, (10, 6, 3))
+        # whole boxes are averaged, edge boxes are smaller
+        box = self.pixels[:4, :4].astype(numpy.uint64).sum(axis=(0, 1))
+        self.assertTrue((output[0, 0] == (box + 8) // 16).all())
+        edgeBox = self.pixels[36:, 20:].astype(numpy.uint64).sum(axis=(0, 1))
+        self.assertTrue((output[9, 5] == (edgeBox + 1) // 3).all())
+
+    def test_toNetpbm(self):
+        numpy = streaming.numpy
+        self.assertEqual(toNetpbm(numpy.zeros((1, 2, 3), dtype=numpy.uint8)), b"P6\n2 1\n255\n" + bytes(6))
+        self.assertEqual(toNetpbm(numpy.zeros((1, 1, 1), dtype=numpy.uint8)), b"P5\n1 1\n255\n\x00")
+        self.assertTrue(toNetpbm(numpy.zeros((1, 1, 4), dtype=numpy.uint8)).startswith(b"P7\nWIDTH 1\nHEIGHT 1\n"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+import os
+import subprocess
+import sys
+import unittest
+from supervisor import Supervisor, createWorker, runConsumer
+from helper import setupLogging
+from typing import Dict, Hashable, Any
+from logging import Logger
+from unittest.mock import patch, MagicMock
+from pika.exceptions import ChannelClosedByBroker
+
+
+class TestSupervisor(unittest.TestCase):
+    logger: Logger = setupLogging()
+    config: Dict[Hashable, Any] = {
+        'queue': {'host': 'queue', 'port': 5672, 'queueName': 'test_queue'},
+        'worker': {'numberWorker': 2, 'minWorkers': 1, 'maxWorkers': 3, 'messagesPerWorker': 10,
+                   'restartBackoff': 1, 'maxRestartBackoff': 4}
+    }
+
+    def setUp(self):
+        self.supervisor: Supervisor = Supervisor(self.config, self.logger)
+        self.supervisor.context = MagicMock()
+
+    def test_constructor(self):
+        self.assertEqual(self.supervisor.minWorkers, 1)
+        self.assertEqual(self.supervisor.maxWorkers, 3)
+        self.assertEqual(self.supervisor.targetWorkers, 1)
+        supervisor: Supervisor = Supervisor({'worker': {'numberWorker': 5}}, self.logger)
+        self.assertEqual(supervisor.minWorkers, 5)
+        self.assertEqual(supervisor.maxWorkers, 5)
+
+    def test_importDoesNotLoadImageMagick(self):
+        # the supervisor only forks consumers: Wand and the ImageMagick libraries are loaded by the worker modules
+        code: str = "import sys, supervisor; sys.exit('wand' in sys.modules)"
+        result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.returncode, 0)
+
+    def test_spawnConsumer(self):
+        self.supervisor.spawnConsumer(0)
+        self.supervisor.context.Process.assert_called_once()
+        self.supervisor.context.Process.return_value.start.assert_called_once()
+        self.assertEqual(self.supervisor.consumers[0], self.supervisor.context.Process.return_value)
+
+    @patch('supervisor.gc.freeze')
+    @patch('supervisor.createWorker')
+    def test_warmStart(self, mockCreateWorker: MagicMock, mockFreeze: MagicMock):
+        self.supervisor.warmStart()
+        mockCreateWorker.assert_called_once_with(self.config, self.logger)
+        mockCreateWorker.return_value.warmUpCoders.assert_called_once()
+        mockFreeze.assert_called_once()
+        # consumers inherit the worker engine built before forking
+        self.supervisor.spawnConsumer(0)
+        args: tuple = self.supervisor.context.Process.call_args[1]['args']
+        self.assertEqual(args[2], 0)
+        self.assertIs(args[4], mockCreateWorker.return_value)
+
+    @patch('threaded_worker.ThreadedWorker')
+    def test_createThreadedWorker(self, mockThreadedWorker: MagicMock):
+        config: Dict[Hashable, Any] = dict(self.config, worker={'mode': 'threaded'})
+        self.assertIs(createWorker(config, self.logger), mockThreadedWorker.return_value)
+        mockThreadedWorker.assert_called_once_with(config, self.logger)
+
+    @patch('supervisor.createWorker')
+    def test_runConsumer(self, mockCreateWorker: MagicMock):
+        warmWorker: MagicMock = MagicMock()
+        runConsumer(self.config, self.logger, 1, 12.5, warmWorker)
+        mockCreateWorker.assert_not_called()
+        self.assertEqual(warmWorker.spawnedAt, 12.5)
+        warmWorker.metrics.start.assert_called_once_with(1)
+        warmWorker.processJob.assert_called_once()
+        runConsumer(self.config, self.logger, 2, 13.5)
+        mockCreateWorker.assert_called_once_with(self.config, self.logger)
+        mockCreateWorker.return_value.processJob.assert_called_once()
+
+    def test_reapConsumersWithBackoff(self):
+        self.supervisor.spawnConsumer(0)
+        deadProcess: MagicMock = self.supervisor.consumers[0]
+        deadProcess.is_alive.return_value = False
+        deadProcess.exitcode = 1
+        startedAt: float = self.supervisor.startedAt[0]
+        backoffs = []
+        for _ in range(4):
+            self.supervisor.consumers[0] = deadProcess
+            self.supervisor.reapConsumers(startedAt + 1)
+            backoffs.append(self.supervisor.restartAt[0] - startedAt - 1)
+        self.assertEqual(backoffs, [1, 2, 4, 4])
+        self.assertNotIn(0, self.supervisor.consumers)
+        # not respawned before backoff expiration
+        self.supervisor.respawnConsumers(startedAt + 2)
+        self.assertNotIn(0, self.supervisor.consumers)
+        self.supervisor.respawnConsumers(startedAt + 5)
+        self.assertIn(0, self.supervisor.consumers)
+
+    def test_reapDrainedConsumer(self):
+        self.supervisor.spawnConsumer(2)
+        drainedProcess: MagicMock = self.supervisor.consumers[2]
+        drainedProcess.is_alive.return_value = False
+        drainedProcess.exitcode = 0
+        self.supervisor.reapConsumers(self.supervisor.startedAt[2] + 1)
+        self.assertNotIn(2, self.supervisor.consumers)
+        self.assertNotIn(2, self.supervisor.restartAt)
+
+    def test_scaleConsumers(self):
+        self.supervisor.scaleConsumers(25)
+        self.assertEqual(self.supervisor.targetWorkers, 3)
+        self.supervisor.respawnConsumers(0)
+        self.assertEqual(sorted(self.supervisor.consumers), [0, 1, 2])
+        self.supervisor.scaleConsumers(1000)
+        self.assertEqual(self.supervisor.targetWorkers, 3)
+        self.supervisor.scaleConsumers(0)
+        self.assertEqual(self.supervisor.targetWorkers, 1)
+        # consumers over target are asked to drain
+        self.supervisor.context.Process.return_value.terminate.assert_called()
+        self.supervisor.scaleConsumers(None)
+        self.assertEqual(self.supervisor.targetWorkers, 1)
+
+    @patch('supervisor.BlockingConnection')
+    def test_getQueueDepth(self, mockQueueConn: MagicMock):
+        mockChannel: MagicMock = mockQueueConn.return_value.channel.return_value
+        mockChannel.queue_declare.return_value.method.message_count = 42
+        mockQueueConn.return_value.is_closed = False
+        self.assertEqual(self.supervisor.getQueueDepth(), 42)
+        mockChannel.queue_declare.assert_called_once_with('test_queue', durable=True, passive=True)
+
+    @patch('supervisor.BlockingConnection')
+    def test_getQueueDepthOfQueueClasses(self, mockQueueConn: MagicMock):
+        config: Dict[Hashable, Any] = dict(self.config, queue=dict(self.config['queue'], queues=[
+            {'name': 'small', 'maxFileSize': 1000}, {'name': 'large'}
+        ]))
+        supervisor: Supervisor = Supervisor(config, self.logger)
+        mockChannel: MagicMock = mockQueueConn.return_value.channel.return_value
+        mockChannel.queue_declare.side_effect = [
+            MagicMock(**{'method.message_count': count}) for count in (1, 20, 300)
+        ]
+        self.assertEqual(supervisor.getQueueDepth(), 321)
+        self.assertEqual([c[0][0] for c in mockChannel.queue_declare.call_args_list],
+                         ['test_queue', 'small', 'large'])
+
+    @patch('supervisor.pixel_budget')
+    def test_hostPixelBudget(self, mockPixelBudget: MagicMock):
+        config: Dict[Hashable, Any] = dict(self.config, worker=dict(
+            self.config['worker'], pixelBudget={'enabled': True, 'hostPixels': 1000}
+        ))
+        supervisor: Supervisor = Supervisor(config, self.logger)
+        self.assertEqual(mockPixelBudget.hostBudget.hostPixels, 1000)
+        supervisor.context = MagicMock()
+        supervisor.spawnConsumer(1)
+        supervisor.consumers[1].is_alive.return_value = False
+        mockPixelBudget.hostBudget = MagicMock()
+        supervisor.reapConsumers(0)
+        mockPixelBudget.hostBudget.reset.assert_called_once_with(1)
+
+    @patch('supervisor.BlockingConnection')
+    def test_getQueueDepthFailure(self, mockQueueConn: MagicMock):
+        mockQueueConn.side_effect = Exception('Boom!')
+        self.assertIsNone(self.supervisor.getQueueDepth())
+        self.assertIsNone(self.supervisor.queueConn)
+
+    @patch('supervisor.BlockingConnection')
+    def test_getQueueDepthOfUndeclaredQueue(self, mockQueueConn: MagicMock):
+        config: Dict[Hashable, Any] = dict(self.config, queue=dict(self.config['queue'], queues=[
+            {'name': 'small', 'maxFileSize': 1000}, {'name': 'large'}
+        ]))
+        supervisor: Supervisor = Supervisor(config, self.logger)
+        mockChannel: MagicMock = mockQueueConn.return_value.channel.return_value
+        mockChannel.queue_declare.side_effect = [
+            MagicMock(**{'method.message_count': 1}), ChannelClosedByBroker(404, 'NOT_FOUND'),
+            MagicMock(**{'method.message_count': 300}),
+        ]
+        self.assertEqual(supervisor.getQueueDepth(), 301)
+        # the channel closed by the broker is replaced
+        self.assertEqual(mockQueueConn.return_value.channel.call_count, 2)
+
+    @patch('supervisor.BlockingConnection')
+    def test_getQueueDepthClosesConnectionOnFailure(self, mockQueueConn: MagicMock):
+        mockQueueConn.return_value.is_closed = False
+        mockQueueConn.return_value.channel.return_value.queue_declare.side_effect = ChannelClosedByBroker(
+            403, 'ACCESS_REFUSED'
+        )
+        self.assertIsNone(self.supervisor.getQueueDepth())
+        mockQueueConn.return_value.close.assert_called_once()
+        self.assertIsNone(self.supervisor.queueConn)
+
+    def test_drain(self):
+        self.supervisor.spawnConsumer(0)
+        process: MagicMock = self.supervisor.consumers[0]
+        process.is_alive.side_effect = [True, True]
+        self.supervisor.drain()
+        process.terminate.assert_called_once()
+        process.join.assert_called()
+        process.kill.assert_called_once()
+        self.assertEqual(self.supervisor.consumers, {})
+
+    @patch('supervisor.time.sleep')
+    @patch('supervisor.signal.signal')
+    def test_runUntilStopped(self, mockSignal: MagicMock, mockSleep: MagicMock):
+        mockSleep.side_effect = self.supervisor.stop
+        self.supervisor.getQueueDepth = MagicMock(return_value=0)
+        self.supervisor.run()
+        self.assertTrue(self.supervisor.stopping)
+        self.supervisor.context.Process.assert_called_once()
+        self.assertEqual(self.supervisor.consumers, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
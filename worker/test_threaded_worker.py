@@ -0,0 +1,110 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from threaded_worker import ThreadedWorker
+from helper import setupLogging
+from typing import Dict, Hashable, Any
+from logging import Logger
+from unittest.mock import patch, MagicMock
+from job_message import JobRequest
+from retry import TransientError
+
+
+class TestThreadedWorker(unittest.TestCase):
+    logger: Logger = setupLogging()
+    config: Dict[Hashable, Any] = {
+        'kvs': {'host': 'kvs', 'indexKey': 'redisIndexKey', 'port': 6379},
+        'queue': {'host': 'queue', 'port': 5672, 'queueName': 'test_queue'},
+        'fileStorage': {'thumbnailPath': '/img/thumbnail/'},
+        'worker': {'mode': 'threaded', 'threads': 2, 'maxInFlight': 8, 'imageMagickThreads': 2}
+    }
+    jobId: str = '1'
+
+    def setUp(self):
+        self.worker: ThreadedWorker = ThreadedWorker(self.config, self.logger)
+        self.worker.executor = ThreadPoolExecutor(max_workers=2)
+        self.worker.queueConn = MagicMock()
+        # callbacks handed back to the consumer thread run right away
+        self.worker.queueConn.add_callback_threadsafe.side_effect = lambda callback: callback()
+
+    def tearDown(self):
+        self.worker.executor.shutdown()
+
+    def test_constructor(self):
+        self.assertEqual(self.worker.threads, 2)
+        self.assertEqual(self.worker.maxInFlight, 8)
+        self.assertEqual(self.worker.imageMagickThreads, 2)
+        # prefetch window keeps every thread busy
+        worker: ThreadedWorker = ThreadedWorker(dict(self.config, worker={'threads': 4, 'maxInFlight': 2}), self.logger)
+        self.assertEqual(worker.maxInFlight, 4)
+
+    @patch.object(ThreadedWorker, 'runJobs')
+    def test_onMessage(self, mockRunJobs: MagicMock):
+        mockRunJobs.return_value = []
+        mockChannel: MagicMock = MagicMock()
+        self.worker.onMessage(mockChannel, MagicMock(delivery_tag=5, redelivered=False), None, b'1')
+        self.worker.executor.shutdown()
+        mockRunJobs.assert_called_once_with([JobRequest(self.jobId)])
+        mockChannel.basic_ack.assert_called_once_with(delivery_tag=5)
+        self.assertEqual(self.worker.inFlight, 0)
+
+    def test_onMessageMalformed(self):
+        mockChannel: MagicMock = MagicMock()
+        self.worker.onMessage(mockChannel, MagicMock(delivery_tag=5, redelivered=False), None, b'[{"id": 1}')
+        mockChannel.basic_reject.assert_called_once_with(delivery_tag=5, requeue=False)
+        self.assertEqual(self.worker.inFlight, 0)
+
+    @patch.object(ThreadedWorker, 'publishFailedJobs')
+    @patch.object(ThreadedWorker, 'runJobs')
+    def test_runMessageWithFailedJobs(self, mockRunJobs: MagicMock, mockPublishFailedJobs: MagicMock):
+        failedJobs: list = [(JobRequest(self.jobId), 1, 'timeout', 'test_queue')]
+        mockRunJobs.return_value = failedJobs
+        mockChannel: MagicMock = MagicMock()
+        self.worker.inFlight = 1
+        self.worker.runMessage(self.worker.queueConn, mockChannel, 3, [JobRequest(self.jobId)])
+        mockPublishFailedJobs.assert_called_once_with(mockChannel, failedJobs)
+        mockChannel.basic_ack.assert_called_once_with(delivery_tag=3)
+
+    @patch.object(ThreadedWorker, 'runJobs')
+    def test_runMessageFailure(self, mockRunJobs: MagicMock):
+        mockRunJobs.side_effect = SystemExit(1)
+        mockChannel: MagicMock = MagicMock()
+        self.worker.channel = mockChannel
+        self.worker.inFlight = 1
+        self.worker.runMessage(self.worker.queueConn, mockChannel, 3, [JobRequest(self.jobId)])
+        mockChannel.basic_ack.assert_not_called()
+        mockChannel.stop_consuming.assert_called_once()
+        self.assertTrue(self.worker.failed)
+        self.assertEqual(self.worker.inFlight, 0)
+
+    def test_handBackConnectionLost(self):
+        self.worker.queueConn.add_callback_threadsafe.side_effect = TransientError('closed')
+        callback: MagicMock = MagicMock()
+        self.worker.handBack(self.worker.queueConn, callback)
+        callback.assert_not_called()
+
+    @patch('threaded_worker.limits', {})
+    @patch.object(ThreadedWorker, 'getQueueConnection')
+    def test_processJobDrainAfterStop(self, mockGetQueueConn: MagicMock):
+        import threaded_worker
+        mockChannel: MagicMock = MagicMock()
+        mockGetQueueConn.return_value.channel.return_value = mockChannel
+
+        def startConsuming():
+            # a message is still in flight when consuming stops
+            self.worker.inFlight = 1
+            self.worker.stop()
+        mockChannel.start_consuming.side_effect = startConsuming
+        self.worker.queueConn.process_data_events.side_effect = \
+            lambda time_limit: setattr(self.worker, 'inFlight', 0)
+        with self.assertRaises(SystemExit) as context:
+            self.worker.processJob()
+        self.assertEqual(context.exception.code, 0)
+        self.assertEqual(threaded_worker.limits['thread'], 2)
+        mockChannel.basic_qos.assert_called_once_with(prefetch_count=8)
+        mockChannel.basic_consume.assert_called_once_with('test_queue', self.worker.onMessage)
+        self.worker.queueConn.process_data_events.assert_called_once()
+        self.worker.queueConn.close.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
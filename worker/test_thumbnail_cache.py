@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from thumbnail_cache import ThumbnailCache
+from helper import setupLogging
+from logging import Logger
+from unittest.mock import MagicMock, patch
+from typing import Dict, List
+from constants import CACHE_LRU_REDIS_KEY, CACHE_SIZES_REDIS_KEY, CACHE_TOTAL_BYTES_REDIS_KEY
+
+
+class TestThumbnailCache(unittest.TestCase):
+    logger: Logger = setupLogging()
+
+    def setUp(self):
+        self.tmpDir: str = tempfile.mkdtemp()
+        self.redisClient: MagicMock = MagicMock()
+        self.cache: ThumbnailCache = ThumbnailCache(
+            {"enabled": True, "maxBytes": 10}, self.tmpDir + "/", self.logger, lambda: self.redisClient
+        )
+        self.uploadedPath: str = os.path.join(self.tmpDir, "upload.png")
+        with open(self.uploadedPath, "wb") as stream:
+            stream.write(b"image bytes")
+        self.thumbnailPath: str = os.path.join(self.tmpDir, "thumbnail.jpg")
+        with open(self.thumbnailPath, "wb") as stream:
+            stream.write(b"thumb")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_constructor(self):
+        self.assertTrue(self.cache.enabled)
+        self.assertEqual(self.cache.cacheDir, os.path.join(self.tmpDir, ".cache"))
+        self.assertEqual(self.cache.maxBytes, 10)
+
+    def test_computeKey(self):
+        key: str = self.cache.computeKey(self.uploadedPath, "renditions")
+        self.assertEqual(len(key), 32)
+        self.assertEqual(key, self.cache.computeKey(self.uploadedPath, "renditions"))
+        self.assertNotEqual(key, self.cache.computeKey(self.uploadedPath, "other renditions"))
+
+    def test_computeKeyMissingFile(self):
+        self.assertIsNone(self.cache.computeKey(os.path.join(self.tmpDir, "missing.png"), "renditions"))
+
+    def test_fetchMiss(self):
+        self.assertFalse(self.cache.fetch("abcdef", {"thumb": self.thumbnailPath}))
+        self.redisClient.zadd.assert_not_called()
+
+    def test_storeThenFetch(self):
+        self.redisClient.pipeline.return_value.execute.return_value = [1, 1, 5]
+        self.cache.store("abcdef", {"thumb": self.thumbnailPath})
+        cachedPath: str = os.path.join(self.tmpDir, ".cache", "ab", "abcdef", "thumb")
+        self.assertTrue(os.path.isfile(cachedPath))
+        pipeline: MagicMock = self.redisClient.pipeline.return_value
+        pipeline.hset.assert_called_once_with(CACHE_SIZES_REDIS_KEY, "abcdef", 5)
+        pipeline.incrby.assert_called_once_with(CACHE_TOTAL_BYTES_REDIS_KEY, 5)
+        self.redisClient.zpopmin.assert_not_called()
+
+        otherPath: str = os.path.join(self.tmpDir, "other.jpg")
+        self.assertTrue(self.cache.fetch("abcdef", {"thumb": otherPath}))
+        with open(otherPath, "rb") as stream:
+            self.assertEqual(b"thumb", stream.read())
+        self.redisClient.zadd.assert_called_once()
+        self.assertEqual(CACHE_LRU_REDIS_KEY, self.redisClient.zadd.call_args[0][0])
+
+    def test_storeEvictLeastRecentlyUsed(self):
+        os.makedirs(os.path.join(self.tmpDir, ".cache", "ol", "old"))
+        self.redisClient.pipeline.return_value.execute.side_effect = [[1, 1, 15], [1, 8]]
+        self.redisClient.zpopmin.return_value = [(b"old", 1.0)]
+        self.redisClient.hget.return_value = b"7"
+        self.cache.store("abcdef", {"thumb": self.thumbnailPath})
+        self.redisClient.zpopmin.assert_called_once_with(CACHE_LRU_REDIS_KEY)
+        self.redisClient.pipeline.return_value.decrby.assert_called_once_with(CACHE_TOTAL_BYTES_REDIS_KEY, 7)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpDir, ".cache", "ol", "old")))
+        self.assertTrue(os.path.isdir(os.path.join(self.tmpDir, ".cache", "ab", "abcdef")))
+
+    def test_linkFileFromThreads(self):
+        targetPath: str = os.path.join(self.tmpDir, "linked", "thumbnail.jpg")
+        tmpPaths: List[str] = []
+        # both threads hold their temporary file at the same time
+        barrier: threading.Barrier = threading.Barrier(2, timeout=5)
+
+        def replace(sourcePath: str, path: str):
+            tmpPaths.append(sourcePath)
+            barrier.wait()
+            os.remove(sourcePath)
+        # threads linking the same target use their own temporary file
+        with patch("thumbnail_cache.os.replace", side_effect=replace):
+            threads: List[threading.Thread] = [
+                threading.Thread(target=ThumbnailCache.linkFile, args=(self.thumbnailPath, targetPath))
+                for _ in range(2)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(set(tmpPaths)), 2)
+
+    def test_storeRedisProblem(self):
+        self.redisClient.pipeline.return_value.execute.side_effect = Exception("Boom!")
+        thumbnailPaths: Dict[str, str] = {"thumb": self.thumbnailPath}
+        self.cache.store("abcdef", thumbnailPaths)
+        tmpDir: str = "abcdef.%s.%s.tmp" % (os.getpid(), threading.get_ident())
+        self.assertFalse(os.path.exists(os.path.join(self.tmpDir, ".cache", "ab", tmpDir)))
+
+
+if __name__ == '__main__':
+    unittest.main()
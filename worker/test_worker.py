@@ -4,13 +4,25 @@ from worker import Worker
 from helper import setupLogging
 from typing import Dict, Hashable, Any
 from pika import BlockingConnection, ConnectionParameters
+from pika.exceptions import AMQPConnectionError, StreamLostError
 from logging import Logger
 from redis import Redis
-from unittest.mock import patch, MagicMock
-from typing import List, Tuple
+from redis.exceptions import ConnectionError as RedisConnectionError
+from unittest.mock import patch, MagicMock, call
+from typing import List
 from job_status_enum import JobStatusEnum
+from rendition import Rendition
+from job_message import JobRequest
+from retry import TransientError
 from constants import FILE_PATH_REDIS_KEY, JOB_STATUS_REDIS_KEY, \
-    THUMBNAIL_PATH_REDIS_KEY, THUMBNAIL_MAX_PIXEL, ERROR_PROCESSING_IMAGE
+    THUMBNAIL_PATH_REDIS_KEY, THUMBNAIL_MAX_PIXEL, CLAIM_JOBS_SCRIPT, \
+    DECODE_HINT_FACTOR, JPEG_SIZE_HINT_OPTION, ATTEMPTS_REDIS_KEY, CLAIM_TOKEN_REDIS_KEY, CLAIMED_STATUS_REDIS_KEY, \
+    CLAIMED_AT_REDIS_KEY
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
 
 
 class TestWorker(unittest.TestCase):
@@ -21,12 +33,28 @@ class TestWorker(unittest.TestCase):
         'fileStorage': {'thumbnailPath': '/img/thumbnail/'}
     }
     worker: Worker = Worker(config, logger)
+    queueClassesConfig: Dict[Hashable, Any] = dict(config, worker={'prefetch': 20}, queue=dict(config['queue'], queues=[
+        {'name': 'small', 'weight': 3, 'maxFileSize': 10 ** 9}, {'name': 'large', 'weight': 1}
+    ]))
     exception: Exception = Exception('Boom!')
     jobId: str = '1'
     filePath: str = '/img/uploaded/1566650412191_test.png'
+    firstFramePath: str = filePath + '[0]'
     thumbnailPath: str = '/img/thumbnail/1566650412191_test.png'
-    width: int = 100
-    height: int = 80
+    width: int = 200
+    height: int = 160
+    thumbnailWidth: int = 100
+    thumbnailHeight: int = 80
+    thumbnailPaths: Dict[str, str] = {
+        'thumbnailpath:100:jpeg': thumbnailPath,
+        THUMBNAIL_PATH_REDIS_KEY: thumbnailPath
+    }
+
+    def setUp(self):
+        # thumbnails are encoded in memory and written through the storage layer
+        patcher = patch('worker.LocalStorage.write')
+        self.mockWrite: MagicMock = patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_constructor(self):
         self.assertEqual(self.worker.config, self.config)
@@ -43,7 +71,10 @@ class TestWorker(unittest.TestCase):
         # Get existing instance
         redisClient2: Redis = self.worker.getRedisClient()
         self.assertEqual(redisClient, redisClient2)
-        mockRedis.assert_called_once_with(host=self.config["kvs"]["host"], port=self.config["kvs"]["port"])
+        mockRedis.assert_called_once_with(connection_pool=self.worker.redisPool)
+        self.assertEqual(self.worker.redisPool.connection_kwargs['host'], self.config["kvs"]["host"])
+        self.worker.redisClient = None
+        self.worker.redisPool = None
 
     @patch('worker.Redis')
     def test_getRedisClientFailure(self, mockRedis):
@@ -51,7 +82,8 @@ class TestWorker(unittest.TestCase):
         with self.assertRaises(SystemExit):
             mockResult: Redis = self.worker.getRedisClient()
             self.assertEqual(None, mockResult)
-        mockRedis.assert_called_once_with(host=self.config["kvs"]["host"], port=self.config["kvs"]["port"])
+        mockRedis.assert_called_once()
+        self.worker.redisPool = None
 
     @patch('worker.BlockingConnection')
     def test_getQueueConnectionSuccessful(self, mockQueueConn):
@@ -76,116 +108,238 @@ class TestWorker(unittest.TestCase):
                                           port=self.config["queue"]["port"])
         mockQueueConn.assert_called_once_with(parameters)
 
+    @patch('connections.time.sleep')
+    @patch('worker.BlockingConnection')
+    def test_getQueueConnectionRetry(self, mockQueueConn: MagicMock, mockSleep: MagicMock):
+        worker: Worker = Worker(self.config, self.logger)
+        mockQueueConn.side_effect = [AMQPConnectionError('refused'), MagicMock()]
+        queueConn: BlockingConnection = worker.getQueueConnection()
+        self.assertEqual(queueConn, worker.queueConn)
+        self.assertEqual(mockQueueConn.call_count, 2)
+        self.assertEqual(worker.reconnects['amqp'], 1)
+
+    def test_getConnectionStats(self):
+        worker: Worker = Worker(self.config, self.logger)
+        self.assertEqual({'redis_retries_total': 0, 'amqp_reconnects_total': 0}, worker.getConnectionStats())
+        worker.getRedisClient()
+        stats: Dict[str, int] = worker.getConnectionStats()
+        self.assertEqual(stats['redis_pool_connections'], 0)
+        self.assertEqual(stats['redis_pool_connections_in_use'], 0)
+
+    @patch.object(Worker, 'getRedisClient')
+    def test_claimJobsSuccessful(self, mockGetRedisClient: MagicMock):
+        self.worker.claimJobsScript = None
+        mockScript: MagicMock = mockGetRedisClient.return_value.register_script.return_value
+        mockScript.return_value = [
+            [b'0', b'img/uploaded/1566620014076_test.png', 1],
+            [b'1', b'img/uploaded/1566620014077_test.png', None],
+            [None, None, None],
+            [b'-1', b'img/uploaded/1566620014079_test.png', 3],
+        ]
+        mockResult: List = self.worker.claimJobs(['1', '2', '3', '4'])
+        mockGetRedisClient().register_script.assert_called_once_with(CLAIM_JOBS_SCRIPT)
+        mockScript.assert_called_once()
+        self.assertEqual(['1', '2', '3', '4'], mockScript.call_args[1]['keys'])
+        self.assertEqual(
+            [JOB_STATUS_REDIS_KEY, FILE_PATH_REDIS_KEY, JobStatusEnum.PROCESSING.value, ATTEMPTS_REDIS_KEY,
+             CLAIM_TOKEN_REDIS_KEY, CLAIMED_STATUS_REDIS_KEY], mockScript.call_args[1]['args'][:6]
+        )
+        # job 2 is processed by another worker and job 3 does not exist
+        self.assertEqual([
+            ('1', JobStatusEnum.READY_FOR_PROCESSING, 'img/uploaded/1566620014076_test.png', 1),
+            ('4', JobStatusEnum.ERROR_DURING_PROCESSING, 'img/uploaded/1566620014079_test.png', 3),
+        ], mockResult)
+        # script is registered only once
+        self.worker.claimJobs(['1'])
+        mockGetRedisClient().register_script.assert_called_once()
+        self.worker.claimJobsScript = None
+
+    @patch('connections.time.sleep')
     @patch.object(Worker, 'getRedisClient')
-    def test_getJobInfoFromRedisSuccessful(self, mockGetRedisClient: MagicMock):
-        returnValueHmget: List = [b'0', b'img/uploaded/1566620014076_test.png', b'']
-        returnValueFunc: Tuple = (JobStatusEnum(0), 'img/uploaded/1566620014076_test.png')
-        mockGetRedisClient.return_value.hmget.return_value = returnValueHmget
-        mockResult: Tuple = self.worker.getJobInfoFromRedis(self.jobId)
-        mockGetRedisClient.assert_called_once()
-        mockGetRedisClient().hmget.assert_called_once_with(
-            self.jobId, [JOB_STATUS_REDIS_KEY, FILE_PATH_REDIS_KEY, THUMBNAIL_PATH_REDIS_KEY])
-        self.assertEqual(returnValueFunc, mockResult)
+    def test_claimJobsRetryAfterConnectionError(self, mockGetRedisClient: MagicMock, mockSleep: MagicMock):
+        self.worker.claimJobsScript = None
+        mockScript: MagicMock = mockGetRedisClient.return_value.register_script.return_value
+        mockScript.side_effect = [RedisConnectionError('lost'), [[b'0', b'img/uploaded/1566620014076_test.png', 1]]]
+        mockResult: List = self.worker.claimJobs(['1'])
+        self.assertEqual([('1', JobStatusEnum.READY_FOR_PROCESSING, 'img/uploaded/1566620014076_test.png', 1)],
+                         mockResult)
+        # the claim is sent again with the same token
+        self.assertEqual(mockScript.call_args_list[0], mockScript.call_args_list[1])
+        mockSleep.assert_called_once()
+        self.worker.claimJobsScript = None
 
     @patch.object(Worker, 'getRedisClient')
-    def test_getJobInfoFromRedisConnProblem(self, mockGetRedisClient: MagicMock):
-        mockGetRedisClient.return_value.hmget.side_effect = self.exception
+    def test_claimJobsConnProblem(self, mockGetRedisClient: MagicMock):
+        self.worker.claimJobsScript = None
+        mockGetRedisClient.return_value.register_script.return_value.side_effect = self.exception
         with self.assertRaises(SystemExit):
-            mockResult: Tuple = self.worker.getJobInfoFromRedis(self.jobId)
+            mockResult: List = self.worker.claimJobs([self.jobId])
             self.assertEqual(None, mockResult)
-        mockGetRedisClient.assert_called_once()
-        mockGetRedisClient().hmget.assert_called_once_with(
-            self.jobId, [JOB_STATUS_REDIS_KEY, FILE_PATH_REDIS_KEY, THUMBNAIL_PATH_REDIS_KEY])
+        self.worker.claimJobsScript = None
 
+    @patch('worker.time.time')
     @patch.object(Worker, 'getRedisClient')
-    def test_updateJobStatusUsingDifferentJobStatusDefaultThumbnailPath(self, mockGetRedisClient: MagicMock):
-        returnValueFunc: JobStatusEnum = JobStatusEnum.PROCESSING
-        mockGetRedisClient.return_value.hset.return_value = ''
-        mockResult: JobStatusEnum = self.worker.updateJobInfo(
-            self.jobId, JobStatusEnum.READY_FOR_PROCESSING, JobStatusEnum.PROCESSING
-        )
-        mockGetRedisClient.assert_called_once()
-        mockGetRedisClient().hset.assert_called_once_with(
-            self.jobId, JOB_STATUS_REDIS_KEY, JobStatusEnum.PROCESSING.value
-        )
-        self.assertEqual(returnValueFunc, mockResult)
+    def test_claimJobsLease(self, mockGetRedisClient: MagicMock, mockTime: MagicMock):
+        mockTime.return_value = 1566620014.5
+        mockScript: MagicMock = mockGetRedisClient.return_value.register_script.return_value
+        mockScript.return_value = [[b'0', b'img/uploaded/1566620014076_test.png', 1]] * 3
+        worker: Worker = Worker(dict(self.config, worker={'claimLease': 120}), self.logger)
+        worker.claimJobs(['1', '2', '3'], {'2'})
+        self.assertEqual([CLAIMED_AT_REDIS_KEY, 120, '010', 1566620014], mockScript.call_args[1]['args'][10:])
+
+    @unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+    def test_claimJobsAfterWorkerDied(self):
+        redisClient = fakeredis.FakeStrictRedis()
+        redisClient.hmset('1', {JOB_STATUS_REDIS_KEY: JobStatusEnum.READY_FOR_PROCESSING.value,
+                                FILE_PATH_REDIS_KEY: self.filePath})
+        config: Dict[Hashable, Any] = dict(self.config, worker={'claimLease': 60})
+        deadWorker: Worker = Worker(config, self.logger)
+        deadWorker.getRedisClient = MagicMock(return_value=redisClient)
+        # the worker is killed while making the thumbnails of its claimed job
+        with patch.object(Worker, 'makeThumbnail', side_effect=SystemExit(-9)), self.assertRaises(SystemExit):
+            deadWorker.executeProcess(MagicMock(), MagicMock(delivery_tag=1, redelivered=False), None, b'1')
+        self.assertEqual(redisClient.hget('1', JOB_STATUS_REDIS_KEY), b'1')
+
+        worker: Worker = Worker(config, self.logger)
+        worker.getRedisClient = MagicMock(return_value=redisClient)
+        # the lease of the dead worker still holds the job
+        self.assertEqual([], worker.claimJobs(['1']))
+        # RabbitMQ redelivers the message of the dead worker
+        with patch.object(Worker, 'makeThumbnail', return_value=self.thumbnailPaths):
+            worker.executeProcess(MagicMock(), MagicMock(delivery_tag=1, redelivered=True), None, b'1')
+        self.assertEqual(redisClient.hget('1', JOB_STATUS_REDIS_KEY), b'2')
+        self.assertEqual(redisClient.hget('1', ATTEMPTS_REDIS_KEY), b'2')
+
+        # a job left PROCESSING without a redelivered message is claimed again once the lease expired
+        redisClient.hset('1', JOB_STATUS_REDIS_KEY, JobStatusEnum.PROCESSING.value)
+        claimedAt: int = int(redisClient.hget('1', CLAIMED_AT_REDIS_KEY))
+        with patch('worker.time.time', return_value=claimedAt + 60):
+            self.assertEqual([('1', JobStatusEnum.READY_FOR_PROCESSING, self.filePath, 3)], worker.claimJobs(['1']))
 
     @patch.object(Worker, 'getRedisClient')
-    def test_updateJobStatusUsingDifferentJobStatusCustomThumbnailPath(self, mockGetRedisClient: MagicMock):
-        returnValueFunc: JobStatusEnum = JobStatusEnum.PROCESSING
-        mockGetRedisClient.return_value.hmset.return_value = ''
-        mockResult: JobStatusEnum = self.worker.updateJobInfo(
-            self.jobId, JobStatusEnum.READY_FOR_PROCESSING, JobStatusEnum.PROCESSING, self.thumbnailPath
-        )
-        mockGetRedisClient.assert_called_once()
+    def test_finishJobsSuccessful(self, mockGetRedisClient: MagicMock):
+        mockPipeline: MagicMock = mockGetRedisClient.return_value.pipeline.return_value
+        self.worker.finishJobs([
+            ('1', JobStatusEnum.COMPLETE, {THUMBNAIL_PATH_REDIS_KEY: self.thumbnailPath}),
+            ('2', JobStatusEnum.ERROR_DURING_PROCESSING, {}),
+        ])
+        mockGetRedisClient().pipeline.assert_called_once_with(transaction=False)
         mapping: dict = {
-            JOB_STATUS_REDIS_KEY: JobStatusEnum.PROCESSING.value,
+            JOB_STATUS_REDIS_KEY: JobStatusEnum.COMPLETE.value,
             THUMBNAIL_PATH_REDIS_KEY: self.thumbnailPath
         }
-        mockGetRedisClient().hmset.assert_called_once_with(self.jobId, mapping)
-        mockGetRedisClient().hset.assert_not_called()
-        self.assertEqual(returnValueFunc, mockResult)
+        mockPipeline.hmset.assert_called_once_with('1', mapping)
+        mockPipeline.hset.assert_called_once_with(
+            '2', JOB_STATUS_REDIS_KEY, JobStatusEnum.ERROR_DURING_PROCESSING.value
+        )
+        mockPipeline.execute.assert_called_once()
 
     @patch.object(Worker, 'getRedisClient')
-    def test_updateJobStatusUsingSameJobStatus(self, mockGetRedisClient: MagicMock):
+    def test_finishJobsWithStatusEvents(self, mockGetRedisClient: MagicMock):
+        worker: Worker = Worker(dict(self.config, worker={'statusEvents': {'enabled': True, 'stream': 'events'}}),
+                                self.logger)
+        mockPipeline: MagicMock = mockGetRedisClient.return_value.pipeline.return_value
+        worker.finishJobs([
+            ('1', JobStatusEnum.COMPLETE, {THUMBNAIL_PATH_REDIS_KEY: self.thumbnailPath}),
+            ('2', JobStatusEnum.READY_FOR_PROCESSING, {}),
+        ])
+        # events go in the same pipeline as the status updates
+        self.assertEqual([
+            call('events', {'job': '1', 'status': JobStatusEnum.COMPLETE.value}, maxlen=100000, approximate=True),
+            call('events', {'job': '2', 'status': JobStatusEnum.READY_FOR_PROCESSING.value}, maxlen=100000,
+                 approximate=True),
+        ], mockPipeline.xadd.call_args_list)
+        mockPipeline.execute.assert_called_once()
+
+    @patch.object(Worker, 'getRedisClient')
+    def test_claimJobsWithStatusEvents(self, mockGetRedisClient: MagicMock):
+        worker: Worker = Worker(dict(self.config, worker={'statusEvents': {'enabled': True, 'stream': 'events'}}),
+                                self.logger)
+        mockScript: MagicMock = mockGetRedisClient.return_value.register_script.return_value
+        mockScript.return_value = [[b'0', b'img/uploaded/1566620014076_test.png', 1]]
+        worker.claimJobs(['1'])
+        self.assertEqual(['events', 100000, ''], mockScript.call_args[1]['args'][7:10])
+
+    @patch('worker.LocalStorage.sync')
+    @patch.object(Worker, 'getRedisClient')
+    def test_finishJobsSyncBeforeStatusUpdate(self, mockGetRedisClient: MagicMock, mockSync: MagicMock):
+        mockPipeline: MagicMock = mockGetRedisClient.return_value.pipeline.return_value
+        mockPipeline.execute.side_effect = lambda: mockSync.assert_called_once()
+        self.worker.finishJobs([('1', JobStatusEnum.COMPLETE, {THUMBNAIL_PATH_REDIS_KEY: self.thumbnailPath})])
+        self.assertEqual([self.thumbnailPath], list(mockSync.call_args[0][0]))
+        mockPipeline.execute.assert_called_once()
+
+    @patch.object(Worker, 'getRedisClient')
+    def test_finishJobsWithoutJobs(self, mockGetRedisClient: MagicMock):
+        self.worker.finishJobs([])
+        mockGetRedisClient.assert_not_called()
+
+    @patch.object(Worker, 'getRedisClient')
+    def test_finishJobsRedisConnProblem(self, mockGetRedisClient: MagicMock):
+        mockGetRedisClient.return_value.pipeline.return_value.execute.side_effect = self.exception
         with self.assertRaises(SystemExit):
-            mockResult: JobStatusEnum = self.worker.updateJobInfo(
-                self.jobId, JobStatusEnum.PROCESSING, JobStatusEnum.PROCESSING
-            )
-            self.assertEqual(None, mockResult)
-        mockGetRedisClient().hset.assert_not_called()
-        mockGetRedisClient().hmset.assert_not_called()
+            self.worker.finishJobs([(self.jobId, JobStatusEnum.COMPLETE, {THUMBNAIL_PATH_REDIS_KEY: self.thumbnailPath})])
 
+    @patch('connections.time.sleep')
     @patch.object(Worker, 'getRedisClient')
-    def test_updateJobStatusRedisConnProblem(self, mockGetRedisClient: MagicMock):
-        mockGetRedisClient.return_value.hset.side_effect = self.exception
+    def test_finishJobsRetryAfterConnectionError(self, mockGetRedisClient: MagicMock, mockSleep: MagicMock):
+        worker: Worker = Worker(self.config, self.logger)
+        mockPipeline: MagicMock = mockGetRedisClient.return_value.pipeline.return_value
+        mockPipeline.execute.side_effect = [RedisConnectionError('lost'), [1]]
+        worker.finishJobs([(self.jobId, JobStatusEnum.COMPLETE, {THUMBNAIL_PATH_REDIS_KEY: self.thumbnailPath})])
+        # the pipeline is filled again for the second attempt
+        self.assertEqual(mockPipeline.hmset.call_count, 2)
+        self.assertEqual(mockPipeline.execute.call_count, 2)
+        self.assertEqual(worker.getConnectionStats()['redis_retries_total'], 1)
+
+    @patch('connections.time.sleep')
+    @patch.object(Worker, 'getRedisClient')
+    def test_finishJobsReconnectAttemptsExhausted(self, mockGetRedisClient: MagicMock, mockSleep: MagicMock):
+        worker: Worker = Worker(dict(self.config, worker={'reconnect': {'maxAttempts': 3}}), self.logger)
+        mockPipeline: MagicMock = mockGetRedisClient.return_value.pipeline.return_value
+        mockPipeline.execute.side_effect = RedisConnectionError('down')
         with self.assertRaises(SystemExit):
-            mockResult: JobStatusEnum = self.worker.updateJobInfo(
-                self.jobId, JobStatusEnum.READY_FOR_PROCESSING, JobStatusEnum.PROCESSING
-            )
-            self.assertEqual(None, mockResult)
-        mockGetRedisClient.assert_called_once()
-        mockGetRedisClient().hset.assert_called_once_with(
-            self.jobId, JOB_STATUS_REDIS_KEY, JobStatusEnum.PROCESSING.value
-        )
+            worker.finishJobs([(self.jobId, JobStatusEnum.COMPLETE, {THUMBNAIL_PATH_REDIS_KEY: self.thumbnailPath})])
+        self.assertEqual(mockPipeline.execute.call_count, 3)
+        self.assertEqual(mockSleep.call_count, 2)
 
     def test_findThumbnailSizeResizeBothValuesMoreThanMax(self):
         width: int = 772
         height: int = 563
-        tobeWidth, tobeHeight = self.worker.findThumbnailSize(width, height)
-        self.assertEqual(tobeWidth, 96)
-        self.assertEqual(tobeHeight, 70)
-        self.assertLess(tobeWidth, THUMBNAIL_MAX_PIXEL, 'Width to be less than max pixel')
-        self.assertLess(tobeHeight, THUMBNAIL_MAX_PIXEL, 'Height to be less than max pixel')
+        tobeWidth, tobeHeight, _, _ = self.worker.findThumbnailSize(width, height)
+        self.assertEqual(tobeWidth, 100)
+        self.assertEqual(tobeHeight, 73)
+        self.assertLessEqual(tobeWidth, THUMBNAIL_MAX_PIXEL, 'Width to be at most max pixel')
+        self.assertLessEqual(tobeHeight, THUMBNAIL_MAX_PIXEL, 'Height to be at most max pixel')
         self.assertIsInstance(tobeWidth, int)
         self.assertIsInstance(tobeHeight, int)
 
     def test_findThumbnailSizeResizeOnlyWidthMoreThanMax(self):
         width: int = 150
         height: int = 50
-        tobeWidth, tobeHeight = self.worker.findThumbnailSize(width, height)
-        self.assertEqual(tobeWidth, 75)
-        self.assertEqual(tobeHeight, 25)
-        self.assertLess(tobeWidth, THUMBNAIL_MAX_PIXEL, 'Width to be less than max pixel')
-        self.assertLess(tobeHeight, THUMBNAIL_MAX_PIXEL, 'Height to be less than max pixel')
+        tobeWidth, tobeHeight, _, _ = self.worker.findThumbnailSize(width, height)
+        self.assertEqual(tobeWidth, 100)
+        self.assertEqual(tobeHeight, 33)
         self.assertIsInstance(tobeWidth, int)
         self.assertIsInstance(tobeHeight, int)
 
     def test_findThumbnailSizeResizeOnlyHeightMoreThanMax(self):
         width: int = 80
         height: int = 120
-        tobeWidth, tobeHeight = self.worker.findThumbnailSize(width, height)
-        self.assertEqual(tobeWidth, 40)
-        self.assertEqual(tobeHeight, 60)
-        self.assertLess(tobeWidth, THUMBNAIL_MAX_PIXEL, 'Width to be less than max pixel')
-        self.assertLess(tobeHeight, THUMBNAIL_MAX_PIXEL, 'Height to be less than max pixel')
+        tobeWidth, tobeHeight, _, _ = self.worker.findThumbnailSize(width, height)
+        self.assertEqual(tobeWidth, 67)
+        self.assertEqual(tobeHeight, 100)
         self.assertIsInstance(tobeWidth, int)
         self.assertIsInstance(tobeHeight, int)
 
+    def test_findThumbnailSizeJustOverMax(self):
+        # fits the whole budget in one step instead of halving down to 50x50
+        self.assertEqual(self.worker.findThumbnailSize(201, 201), (100, 100, 100, 100))
+
     def test_findThumbnailSizeResizeBothValuesEqualMax(self):
         width: int = THUMBNAIL_MAX_PIXEL
         height: int = THUMBNAIL_MAX_PIXEL
-        tobeWidth, tobeHeight = self.worker.findThumbnailSize(width, height)
+        tobeWidth, tobeHeight, _, _ = self.worker.findThumbnailSize(width, height)
         self.assertEqual(tobeWidth, THUMBNAIL_MAX_PIXEL)
         self.assertEqual(tobeHeight, THUMBNAIL_MAX_PIXEL)
         self.assertIsInstance(tobeWidth, int)
@@ -194,12 +348,27 @@ class TestWorker(unittest.TestCase):
     def test_findThumbnailSizeNoResize(self):
         width: int = 80
         height: int = 63
-        tobeWidth, tobeHeight = self.worker.findThumbnailSize(width, height)
+        tobeWidth, tobeHeight, _, _ = self.worker.findThumbnailSize(width, height)
         self.assertEqual(tobeWidth, width)
         self.assertEqual(tobeHeight, height)
         self.assertIsInstance(tobeWidth, int)
         self.assertIsInstance(tobeHeight, int)
 
+    def test_findThumbnailSizeCover(self):
+        worker: Worker = Worker(dict(self.config, worker={'fitMode': 'cover'}), self.logger)
+        self.assertEqual(worker.findThumbnailSize(772, 563), (137, 100, 100, 100))
+
+    def test_unknownFitMode(self):
+        with self.assertRaises(ValueError):
+            Worker(dict(self.config, worker={'fitMode': 'stretch'}), self.logger)
+
+    def test_getPreScale(self):
+        self.assertEqual(self.worker.getPreScale(4000, 3000, 'JPEG', self.worker.renditions), 8)
+        self.assertEqual(self.worker.getPreScale(800, 600, 'JPEG', self.worker.renditions), 4)
+        self.assertEqual(self.worker.getPreScale(4000, 3000, 'PNG', self.worker.renditions), 1)
+        worker: Worker = Worker(dict(self.config, worker={'shrinkOnLoad': False}), self.logger)
+        self.assertEqual(worker.getPreScale(4000, 3000, 'JPEG', worker.renditions), 1)
+
     def test_getThumbnailPath(self):
         thumbnailPath: str = self.worker.getThumbnailPath(self.filePath)
         filename: str = os.path.basename(self.filePath)
@@ -209,81 +378,517 @@ class TestWorker(unittest.TestCase):
     @patch('worker.Image')
     def test_makeThumbnailExceptionOpenFile(self, mockImage: MagicMock):
         mockImage.side_effect = self.exception
-        retMakeThumbnail: str = self.worker.makeThumbnail(self.filePath)
-        self.assertEqual(ERROR_PROCESSING_IMAGE, retMakeThumbnail)
-        mockImage.assert_called_once_with(filename=self.filePath)
+        retMakeThumbnail: Dict[str, str] = self.worker.makeThumbnail(self.filePath)
+        self.assertEqual({}, retMakeThumbnail)
+        mockImage.assert_called_once_with()
         mockImage.resize.assert_not_called()
-        mockImage.save.assert_not_called()
+        self.mockWrite.assert_not_called()
+
+    def test_getThumbnailPathOfRendition(self):
+        thumbnailPath: str = self.worker.getThumbnailPath(self.filePath, Rendition(64, 'webp'))
+        self.assertEqual('/img/thumbnail/1566650412191_test_64.webp', thumbnailPath)
+        # primary rendition keeps the input file name
+        thumbnailPath = self.worker.getThumbnailPath(self.filePath, self.worker.renditions[0])
+        self.assertEqual(self.thumbnailPath, thumbnailPath)
+
+    @patch('worker.Image')
+    def test_openImageWithSizeHint(self, mockImage: MagicMock):
+        img: MagicMock = self.worker.openImage(self.filePath)
+        self.assertEqual(mockImage.return_value, img)
+        mockImage.assert_called_once_with()
+        hintSize: int = THUMBNAIL_MAX_PIXEL * DECODE_HINT_FACTOR
+        img.options.__setitem__.assert_called_once_with(JPEG_SIZE_HINT_OPTION, "%sx%s" % (hintSize, hintSize))
+        img.read.assert_called_once_with(filename=self.firstFramePath)
+
+    @patch('worker.Image')
+    def test_openImageWithoutShrinkOnLoad(self, mockImage: MagicMock):
+        worker: Worker = Worker(dict(self.config, worker={'shrinkOnLoad': False}), self.logger)
+        img: MagicMock = worker.openImage(self.filePath)
+        self.assertEqual(mockImage.return_value, img)
+        mockImage.assert_called_once_with(filename=self.firstFramePath)
+
+    @patch('worker.Image')
+    def test_openImageFallbackToFullDecode(self, mockImage: MagicMock):
+        mockHintedImage: MagicMock = MagicMock()
+        mockHintedImage.read.side_effect = self.exception
+        mockFullImage: MagicMock = MagicMock()
+        mockImage.side_effect = [mockHintedImage, mockFullImage]
+        img: MagicMock = self.worker.openImage(self.filePath)
+        self.assertEqual(mockFullImage, img)
+        mockHintedImage.close.assert_called_once()
+        mockImage.assert_called_with(filename=self.firstFramePath)
+
+    @patch('worker.Image')
+    def test_openImageWithHeader(self, mockImage: MagicMock):
+        # exact pre-scale factor picked from the header: 1/8 still keeps twice the 100x75 thumbnail
+        img: MagicMock = self.worker.openImage(self.filePath, header=(4000, 3000, 'JPEG'))
+        img.options.__setitem__.assert_called_once_with(JPEG_SIZE_HINT_OPTION, "500x375")
+        img.read.assert_called_once_with(filename=self.firstFramePath)
+        mockImage.reset_mock()
+        img = self.worker.openImage(self.filePath, header=(4000, 3000, 'PNG'))
+        mockImage.assert_called_once_with(filename=self.firstFramePath)
+
+    @patch('worker.Image')
+    def test_makeAnimatedThumbnails(self, mockImage: MagicMock):
+        config: Dict[Hashable, Any] = dict(self.config, worker={
+            'animation': {'enabled': True, 'maxFrames': 10},
+            'renditions': [{'size': 100, 'format': 'jpeg'}, {'size': 100, 'format': 'gif'}],
+        })
+        worker: Worker = Worker(config, self.logger)
+        animatedImg: MagicMock = MagicMock(width=self.width, height=self.height, sequence=[MagicMock()] * 10)
+        stillImg: MagicMock = MagicMock(width=self.width, height=self.height)
+        mockImage.ping.return_value.__enter__.return_value = animatedImg
+        mockImage.return_value.__enter__.return_value = stillImg
+        mockImage.side_effect = lambda *args, **kwargs: \
+            MagicMock(__enter__=MagicMock(return_value=animatedImg)) if kwargs else mockImage.return_value
+        self.assertEqual({
+            'thumbnailpath:100:jpeg': self.thumbnailPath,
+            'thumbnailpath:100:gif': '/img/thumbnail/1566650412191_test_100.gif',
+            THUMBNAIL_PATH_REDIS_KEY: self.thumbnailPath,
+        }, worker.makeThumbnail(self.filePath))
+        # capped sequence for the animated rendition, first frame only for the still one
+        mockImage.ping.assert_called_once_with(filename=self.filePath + '[0-9]')
+        mockImage.assert_any_call(filename=self.filePath + '[0-9]')
+        animatedImg.resize.assert_called_once_with(self.thumbnailWidth, self.thumbnailHeight)
+        self.mockWrite.assert_any_call('/img/thumbnail/1566650412191_test_100.gif', animatedImg.make_blob.return_value)
+        mockImage.return_value.read.assert_called_once_with(filename=self.firstFramePath)
+        self.mockWrite.assert_called_with(self.thumbnailPath, stillImg.make_blob.return_value)
+        self.assertEqual(self.mockWrite.call_count, 2)
+
+    @patch('worker.Image')
+    def test_makeAnimatedThumbnailsFromSingleFrame(self, mockImage: MagicMock):
+        config: Dict[Hashable, Any] = dict(self.config, worker={
+            'animation': {'enabled': True}, 'renditions': [{'size': 100, 'format': 'gif'}],
+        })
+        worker: Worker = Worker(config, self.logger)
+        img: MagicMock = MagicMock(width=self.width, height=self.height, sequence=[MagicMock()])
+        mockImage.ping.return_value.__enter__.return_value = img
+        mockImage.return_value.__enter__.return_value = img
+        worker.makeThumbnail(self.filePath)
+        # a single frame image is only decoded by the still path
+        mockImage.ping.assert_called_once_with(filename=self.filePath + '[0-29]')
+        mockImage.assert_called_once_with()
+        mockImage.return_value.read.assert_called_once_with(filename=self.firstFramePath)
+        self.mockWrite.assert_called_once_with(self.thumbnailPath, img.make_blob.return_value)
+
+    @patch('worker.Image')
+    def test_makeThumbnailCover(self, mockImage: MagicMock):
+        worker: Worker = Worker(dict(self.config, worker={'fitMode': 'cover'}), self.logger)
+        mockImgContextManager: MagicMock = MagicMock(width=self.width, height=self.height)
+
+        def resize(width: int, height: int):
+            mockImgContextManager.width, mockImgContextManager.height = width, height
+        mockImgContextManager.resize.side_effect = resize
+        mockImage.return_value.__enter__.return_value = mockImgContextManager
+        self.assertEqual(self.thumbnailPaths, worker.makeThumbnail(self.filePath))
+        mockImgContextManager.resize.assert_called_once_with(125, 100)
+        mockImgContextManager.crop.assert_called_once_with(width=100, height=100, gravity="center")
 
     @patch('worker.Image')
     def test_makeThumbnailExceptionResizeFile(self, mockImage: MagicMock):
         mockImgContextManager: MagicMock = MagicMock(width=self.width, height=self.height)
         mockImgContextManager.resize.side_effect = self.exception
         mockImage.return_value.__enter__.return_value = mockImgContextManager
-        retMakeThumbnail: str = self.worker.makeThumbnail(self.filePath)
-        self.assertEqual(ERROR_PROCESSING_IMAGE, retMakeThumbnail)
-        mockImage.assert_called_once_with(filename=self.filePath)
-        mockImgContextManager.resize.assert_called_once_with(self.width, self.height)
-        mockImgContextManager.save.assert_not_called()
+        retMakeThumbnail: Dict[str, str] = self.worker.makeThumbnail(self.filePath)
+        self.assertEqual({}, retMakeThumbnail)
+        mockImage.assert_called_once_with()
+        mockImage.return_value.read.assert_called_once_with(filename=self.firstFramePath)
+        mockImgContextManager.resize.assert_called_once_with(self.thumbnailWidth, self.thumbnailHeight)
+        self.mockWrite.assert_not_called()
 
     @patch('worker.Image')
     def test_makeThumbnailExceptionSaveFile(self, mockImage: MagicMock):
         mockImgContextManager: MagicMock = MagicMock(width=self.width, height=self.height)
-        mockImgContextManager.save.side_effect = self.exception
+        self.mockWrite.side_effect = self.exception
         mockImage.return_value.__enter__.return_value = mockImgContextManager
-        retMakeThumbnail: str = self.worker.makeThumbnail(self.filePath)
-        self.assertEqual(ERROR_PROCESSING_IMAGE, retMakeThumbnail)
-        mockImage.assert_called_once_with(filename=self.filePath)
-        mockImgContextManager.resize.assert_called_once_with(self.width, self.height)
-        mockImgContextManager.save.assert_called_once_with(filename=self.thumbnailPath)
+        retMakeThumbnail: Dict[str, str] = self.worker.makeThumbnail(self.filePath)
+        self.assertEqual({}, retMakeThumbnail)
+        mockImage.assert_called_once_with()
+        mockImage.return_value.read.assert_called_once_with(filename=self.firstFramePath)
+        mockImgContextManager.resize.assert_called_once_with(self.thumbnailWidth, self.thumbnailHeight)
+        self.mockWrite.assert_called_once_with(self.thumbnailPath, mockImgContextManager.make_blob.return_value)
 
     @patch('worker.Image')
     def test_makeThumbnailSuccessful(self, mockImage: MagicMock):
         mockImgContextManager: MagicMock = MagicMock(width=self.width, height=self.height)
         mockImage.return_value.__enter__.return_value = mockImgContextManager
-        retMakeThumbnail: str = self.worker.makeThumbnail(self.filePath)
-        self.assertEqual(self.thumbnailPath, retMakeThumbnail)
-        mockImage.assert_called_once_with(filename=self.filePath)
-        mockImgContextManager.resize.assert_called_once_with(self.width, self.height)
-        mockImgContextManager.save.assert_called_once_with(filename=self.thumbnailPath)
+        retMakeThumbnail: Dict[str, str] = self.worker.makeThumbnail(self.filePath)
+        self.assertEqual(self.thumbnailPaths, retMakeThumbnail)
+        mockImage.assert_called_once_with()
+        mockImage.return_value.read.assert_called_once_with(filename=self.firstFramePath)
+        mockImgContextManager.resize.assert_called_once_with(self.thumbnailWidth, self.thumbnailHeight)
+        self.mockWrite.assert_called_once_with(self.thumbnailPath, mockImgContextManager.make_blob.return_value)
+
+    @patch('worker.Image')
+    def test_makeThumbnailWithPixelBudget(self, mockImage: MagicMock):
+        worker: Worker = Worker(dict(self.config, worker={'pixelBudget': {'enabled': True}}), self.logger)
+        mockImage.ping.return_value.__enter__.return_value = MagicMock(width=4000, height=3000, format='JPEG')
+        mockImage.return_value.__enter__.return_value = MagicMock(width=500, height=375)
+        with patch.object(worker.pixelBudget, 'admit', wraps=worker.pixelBudget.admit) as mockAdmit:
+            self.assertEqual(self.thumbnailPaths, worker.makeThumbnail(self.filePath))
+        mockImage.ping.assert_called_once_with(filename=self.firstFramePath)
+        mockAdmit.assert_called_once_with(500 * 375)
+
+    @patch('worker.toNetpbm')
+    @patch('worker.streamResize')
+    @patch('worker.openRasterStream')
+    @patch('worker.Image')
+    def test_makeThumbnailStreaming(self, mockImage: MagicMock, mockOpenRasterStream: MagicMock,
+                                    mockStreamResize: MagicMock, mockToNetpbm: MagicMock):
+        worker: Worker = Worker(dict(self.config, worker={'streaming': {'enabled': True, 'minPixels': 10 ** 6},
+                                                          'pixelBudget': {'enabled': True}}), self.logger)
+        rasterStream: MagicMock = mockOpenRasterStream.return_value
+        rasterStream.width, rasterStream.height = 40000, 30000
+        rasterStream.__enter__.return_value = rasterStream
+        mockImage.return_value.__enter__.return_value = MagicMock(width=400, height=300)
+        with patch.object(worker.pixelBudget, 'admit', wraps=worker.pixelBudget.admit) as mockAdmit:
+            self.assertEqual(self.thumbnailPaths, worker.makeThumbnail(self.filePath))
+        # downsampled by strips to about twice the thumbnail size, without decoding the full image
+        mockStreamResize.assert_called_once_with(rasterStream, 200)
+        mockImage.assert_called_once_with(blob=mockToNetpbm.return_value)
+        mockImage.ping.assert_not_called()
+        mockAdmit.assert_called_once_with(200 * 150)
+        rasterStream.close.assert_called()
+
+    @patch('worker.openRasterStream')
+    @patch('worker.Image')
+    def test_makeThumbnailStreamingBelowMinPixels(self, mockImage: MagicMock, mockOpenRasterStream: MagicMock):
+        worker: Worker = Worker(dict(self.config, worker={'streaming': {'enabled': True, 'minPixels': 10 ** 6}}),
+                                self.logger)
+        mockOpenRasterStream.return_value.width, mockOpenRasterStream.return_value.height = 800, 600
+        mockImage.return_value.__enter__.return_value = MagicMock(width=self.width, height=self.height)
+        self.assertEqual(self.thumbnailPaths, worker.makeThumbnail(self.filePath))
+        mockOpenRasterStream.return_value.close.assert_called_once_with()
+        mockImage.return_value.read.assert_called_once_with(filename=self.firstFramePath)
+
+    @patch('worker.Image')
+    def test_makeThumbnailOverMaxImagePixels(self, mockImage: MagicMock):
+        worker: Worker = Worker(dict(self.config, worker={'pixelBudget': {'enabled': True, 'maxImagePixels': 100}}),
+                                self.logger)
+        mockImage.ping.return_value.__enter__.return_value = MagicMock(width=200, height=160, format='PNG')
+        self.assertEqual({}, worker.makeThumbnail(self.filePath))
+        mockImage.assert_not_called()
+
+    @patch('worker.Image')
+    def test_makeThumbnailRenditionsFromSingleDecode(self, mockImage: MagicMock):
+        config: Dict[Hashable, Any] = dict(self.config, worker={'renditions': [
+            {'size': 100, 'format': 'jpeg'}, {'size': 400, 'format': 'jpeg'},
+            {'size': 400, 'format': 'WEBP'}, {'size': 50},
+        ]})
+        worker: Worker = Worker(config, self.logger)
+        mockImgContextManager: MagicMock = MagicMock(width=800, height=600)
+
+        def resize(width: int, height: int):
+            mockImgContextManager.width, mockImgContextManager.height = width, height
+        mockImgContextManager.resize.side_effect = resize
+        mockImage.return_value.__enter__.return_value = mockImgContextManager
+        retMakeThumbnail: Dict[str, str] = worker.makeThumbnail(self.filePath)
+        mockImage.assert_called_once_with()
+        # biggest rendition first, each one resized from the previous one
+        self.assertEqual(mockImgContextManager.resize.call_args_list, [call(400, 300), call(100, 75), call(50, 38)])
+        self.assertEqual(self.mockWrite.call_count, 4)
+        self.assertEqual({
+            'thumbnailpath:400:jpeg': '/img/thumbnail/1566650412191_test_400.jpg',
+            'thumbnailpath:400:webp': '/img/thumbnail/1566650412191_test_400.webp',
+            'thumbnailpath:100:jpeg': self.thumbnailPath,
+            'thumbnailpath:50:jpeg': '/img/thumbnail/1566650412191_test_50.jpg',
+            THUMBNAIL_PATH_REDIS_KEY: self.thumbnailPath,
+        }, retMakeThumbnail)
+
+    @patch('worker.Image')
+    def test_makeThumbnailWithRenditionsOfJob(self, mockImage: MagicMock):
+        mockImgContextManager: MagicMock = MagicMock(width=self.width, height=self.height)
+        mockImage.return_value.__enter__.return_value = mockImgContextManager
+        retMakeThumbnail: Dict[str, str] = self.worker.makeThumbnail(
+            self.filePath, [Rendition(50, 'webp'), Rendition(25, 'jpeg')]
+        )
+        self.assertEqual({
+            'thumbnailpath:50:webp': self.thumbnailPath,
+            'thumbnailpath:25:jpeg': '/img/thumbnail/1566650412191_test_25.jpg',
+            THUMBNAIL_PATH_REDIS_KEY: self.thumbnailPath,
+        }, retMakeThumbnail)
+        mockImage.return_value.options.__setitem__.assert_called_once_with(JPEG_SIZE_HINT_OPTION, '100x100')
+
+    @patch('worker.Image')
+    def test_makeThumbnailCacheHit(self, mockImage: MagicMock):
+        worker: Worker = Worker(self.config, self.logger)
+        worker.thumbnailCache = MagicMock(enabled=True)
+        worker.thumbnailCache.computeKey.return_value = 'abcdef'
+        worker.thumbnailCache.fetch.return_value = True
+        retMakeThumbnail: Dict[str, str] = worker.makeThumbnail(self.filePath)
+        self.assertEqual(self.thumbnailPaths, retMakeThumbnail)
+        worker.thumbnailCache.fetch.assert_called_once_with('abcdef', {'thumbnailpath:100:jpeg': self.thumbnailPath})
+        mockImage.assert_not_called()
+        worker.thumbnailCache.store.assert_not_called()
+
+    @patch('worker.Image')
+    def test_makeThumbnailCacheMiss(self, mockImage: MagicMock):
+        worker: Worker = Worker(self.config, self.logger)
+        worker.thumbnailCache = MagicMock(enabled=True)
+        worker.thumbnailCache.computeKey.return_value = 'abcdef'
+        worker.thumbnailCache.fetch.return_value = False
+        mockImage.return_value.__enter__.return_value = MagicMock(width=self.width, height=self.height)
+        retMakeThumbnail: Dict[str, str] = worker.makeThumbnail(self.filePath)
+        self.assertEqual(self.thumbnailPaths, retMakeThumbnail)
+        mockImage.assert_called_once_with()
+        worker.thumbnailCache.store.assert_called_once_with('abcdef', {'thumbnailpath:100:jpeg': self.thumbnailPath})
+
+    def test_getRenderingParameters(self):
+        renditions: List[Rendition] = [Rendition(100, 'jpeg')]
+        parameters: str = Worker(self.config, self.logger).getRenderingParameters(renditions)
+        self.assertEqual(parameters, Worker(self.config, self.logger).getRenderingParameters(renditions))
+        for key, setting in [
+            ('fitMode', 'cover'), ('shrinkOnLoad', False), ('animation', {'enabled': True}),
+            ('streaming', {'enabled': True}), ('encoding', {'pngFastPathSize': 0}),
+            ('encoding', {'profiles': {'jpeg': {'options': {'jpeg:optimize-coding': 'false'}}}}),
+        ]:
+            with self.subTest(key=key):
+                config: Dict[Hashable, Any] = dict(self.config, worker={key: setting})
+                self.assertNotEqual(parameters, Worker(config, self.logger).getRenderingParameters(renditions))
 
     @patch.object(Worker, 'makeThumbnail')
-    @patch.object(Worker, 'updateJobInfo')
-    @patch.object(Worker, 'getJobInfoFromRedis')
+    @patch.object(Worker, 'finishJobs')
+    @patch.object(Worker, 'claimJobs')
     def test_executeProcessSuccessful(self,
-                                      mockGetJobInfoFromRedis: MagicMock,
-                                      mockUpdateJobInfo: MagicMock,
+                                      mockClaimJobs: MagicMock,
+                                      mockFinishJobs: MagicMock,
                                       mockMakeThumbnail: MagicMock,
                                       ):
-        mockGetJobInfoFromRedis.return_value = (JobStatusEnum.READY_FOR_PROCESSING, self.filePath)
-        mockUpdateJobInfo.return_value = JobStatusEnum.PROCESSING
-        mockMakeThumbnail.return_value = self.thumbnailPath
-        self.worker.executeProcess(MagicMock(), MagicMock(), None, b'1')
-        mockGetJobInfoFromRedis.assert_called_once_with(self.jobId)
-        mockMakeThumbnail.assert_called_once_with(self.filePath)
-        self.assertEqual(mockUpdateJobInfo.call_count, 2)
-        mockUpdateJobInfo.assert_called_with(
-            self.jobId, JobStatusEnum.PROCESSING, JobStatusEnum.COMPLETE, self.thumbnailPath
-        )
+        mockClaimJobs.return_value = [(self.jobId, JobStatusEnum.READY_FOR_PROCESSING, self.filePath, 1)]
+        mockMakeThumbnail.return_value = self.thumbnailPaths
+        mockChannel: MagicMock = MagicMock()
+        mockMethodFrame: MagicMock = MagicMock(delivery_tag=1, redelivered=False)
+        self.worker.executeProcess(mockChannel, mockMethodFrame, None, b'1')
+        mockClaimJobs.assert_called_once_with([self.jobId], set())
+        mockMakeThumbnail.assert_called_once_with(self.filePath, None)
+        mockFinishJobs.assert_called_once_with([(self.jobId, JobStatusEnum.COMPLETE, self.thumbnailPaths)])
+        mockChannel.basic_ack.assert_called_once_with(delivery_tag=1, multiple=True)
 
     @patch.object(Worker, 'makeThumbnail')
-    @patch.object(Worker, 'updateJobInfo')
-    @patch.object(Worker, 'getJobInfoFromRedis')
+    @patch.object(Worker, 'finishJobs')
+    @patch.object(Worker, 'claimJobs')
     def test_executeProcessFailure(self,
-                                      mockGetJobInfoFromRedis: MagicMock,
-                                      mockUpdateJobInfo: MagicMock,
-                                      mockMakeThumbnail: MagicMock,
-                                      ):
-        mockGetJobInfoFromRedis.return_value = (JobStatusEnum.READY_FOR_PROCESSING, self.filePath)
-        mockUpdateJobInfo.return_value = JobStatusEnum.PROCESSING
-        mockMakeThumbnail.return_value = ERROR_PROCESSING_IMAGE
-        self.worker.executeProcess(MagicMock(), MagicMock(), None, b'1')
-        mockGetJobInfoFromRedis.assert_called_once_with(self.jobId)
-        mockMakeThumbnail.assert_called_once_with(self.filePath)
-        self.assertEqual(mockUpdateJobInfo.call_count, 2)
-        mockUpdateJobInfo.assert_called_with(
-            self.jobId, JobStatusEnum.PROCESSING, JobStatusEnum.ERROR_DURING_PROCESSING
-        )
+                                   mockClaimJobs: MagicMock,
+                                   mockFinishJobs: MagicMock,
+                                   mockMakeThumbnail: MagicMock,
+                                   ):
+        mockClaimJobs.return_value = [(self.jobId, JobStatusEnum.READY_FOR_PROCESSING, self.filePath, 1)]
+        mockMakeThumbnail.return_value = {}
+        self.worker.executeProcess(MagicMock(), MagicMock(redelivered=False), None, b'1')
+        mockClaimJobs.assert_called_once_with([self.jobId], set())
+        mockMakeThumbnail.assert_called_once_with(self.filePath, None)
+        mockFinishJobs.assert_called_once_with([(self.jobId, JobStatusEnum.ERROR_DURING_PROCESSING, {})])
+
+    @patch('worker.Image')
+    def test_makeThumbnailInvalidRenditions(self, mockImage: MagicMock):
+        for renditions in ([Rendition(100000, 'jpeg')], [Rendition(0, 'jpeg')], [Rendition(64, 'bmp')]):
+            self.assertEqual({}, self.worker.makeThumbnail(self.filePath, renditions))
+        mockImage.assert_not_called()
+
+    def test_constructorInvalidRenditions(self):
+        with self.assertRaises(ValueError):
+            Worker(dict(self.config, worker={'renditions': [{'size': 512}], 'maxRenditionSize': 256}), self.logger)
+
+    @patch('worker.Image')
+    def test_makeThumbnailTransientError(self, mockImage: MagicMock):
+        mockImage.side_effect = ConnectionResetError('Boom!')
+        with self.assertRaises(TransientError):
+            self.worker.makeThumbnail(self.filePath)
+
+    @patch.object(Worker, 'makeThumbnail')
+    @patch.object(Worker, 'finishJobs')
+    @patch.object(Worker, 'claimJobs')
+    def test_executeJobsRetryTransientFailure(self, mockClaimJobs: MagicMock, mockFinishJobs: MagicMock,
+                                              mockMakeThumbnail: MagicMock):
+        worker: Worker = Worker(dict(self.config, worker={'retry': {'enabled': True, 'maxAttempts': 3}}), self.logger)
+        worker.channel = MagicMock()
+        mockClaimJobs.return_value = [('1', JobStatusEnum.READY_FOR_PROCESSING, self.filePath, 2),
+                                      ('2', JobStatusEnum.READY_FOR_PROCESSING, self.filePath, 3)]
+        mockMakeThumbnail.side_effect = TransientError('Boom!')
+        worker.executeJobs([JobRequest('1'), JobRequest('2')])
+        # job 1 gets its previous status back to be retried, job 2 failed its last attempt
+        mockFinishJobs.assert_called_once_with([('1', JobStatusEnum.READY_FOR_PROCESSING, {}),
+                                                ('2', JobStatusEnum.ERROR_DURING_PROCESSING, {})])
+        publishedQueues = [c[0][1] for c in worker.channel.basic_publish.call_args_list]
+        self.assertEqual(publishedQueues, ['test_queue.dead', 'test_queue.retry.2000ms'])
+
+    @patch.object(Worker, 'makeThumbnail')
+    @patch.object(Worker, 'finishJobs')
+    @patch.object(Worker, 'claimJobs')
+    def test_executeJobsTransientFailureWithoutRetry(self, mockClaimJobs: MagicMock, mockFinishJobs: MagicMock,
+                                                     mockMakeThumbnail: MagicMock):
+        self.worker.channel = MagicMock()
+        mockClaimJobs.return_value = [(self.jobId, JobStatusEnum.READY_FOR_PROCESSING, self.filePath, 1)]
+        mockMakeThumbnail.side_effect = TransientError('Boom!')
+        self.worker.executeJobs([JobRequest(self.jobId)])
+        mockFinishJobs.assert_called_once_with([(self.jobId, JobStatusEnum.ERROR_DURING_PROCESSING, {})])
+        self.worker.channel.basic_publish.assert_not_called()
+        self.worker.channel = None
+
+    @patch.object(Worker, 'makeThumbnail')
+    @patch.object(Worker, 'finishJobs')
+    @patch.object(Worker, 'claimJobs')
+    def test_executeJobsPoisonJob(self, mockClaimJobs: MagicMock, mockFinishJobs: MagicMock,
+                                  mockMakeThumbnail: MagicMock):
+        worker: Worker = Worker(dict(self.config, worker={'retry': {'enabled': True, 'maxAttempts': 3}}), self.logger)
+        worker.channel = MagicMock()
+        mockClaimJobs.return_value = [(self.jobId, JobStatusEnum.READY_FOR_PROCESSING, self.filePath, 4)]
+        worker.executeJobs([JobRequest(self.jobId)])
+        mockMakeThumbnail.assert_not_called()
+        mockFinishJobs.assert_called_once_with([(self.jobId, JobStatusEnum.ERROR_DURING_PROCESSING, {})])
+        worker.channel.basic_publish.assert_called_once()
+        self.assertEqual(worker.channel.basic_publish.call_args[0][1], 'test_queue.dead')
+
+    def test_getFinishedJobLogsSingleRecord(self):
+        with self.assertLogs(self.logger, level='INFO') as logs:
+            finishedJob = self.worker.getFinishedJob(self.jobId, self.filePath, self.thumbnailPaths, 0.0123)
+        self.assertEqual(finishedJob, (self.jobId, JobStatusEnum.COMPLETE, self.thumbnailPaths))
+        self.assertEqual(logs.output, ['INFO:worker:job=1 status=COMPLETE file=%s thumbnails=2 duration_ms=12.3'
+                                       % self.filePath])
+
+    @patch.object(Worker, 'makeThumbnail')
+    @patch.object(Worker, 'finishJobs')
+    @patch.object(Worker, 'claimJobs')
+    def test_executeJobsSkipUnclaimedJobs(self,
+                                          mockClaimJobs: MagicMock,
+                                          mockFinishJobs: MagicMock,
+                                          mockMakeThumbnail: MagicMock,
+                                          ):
+        mockClaimJobs.return_value = [('2', JobStatusEnum.READY_FOR_PROCESSING, self.filePath, 1)]
+        mockMakeThumbnail.return_value = self.thumbnailPaths
+        self.worker.executeJobs([JobRequest('1'), JobRequest('2')])
+        mockClaimJobs.assert_called_once_with(['1', '2'], set())
+        mockMakeThumbnail.assert_called_once_with(self.filePath, None)
+        mockFinishJobs.assert_called_once_with([('2', JobStatusEnum.COMPLETE, self.thumbnailPaths)])
+
+    @patch.object(Worker, 'executeJobs')
+    @patch.object(Worker, 'getQueueConnection')
+    def test_executeProcessBufferUntilBatchIsFull(self, mockGetQueueConn: MagicMock, mockExecuteJobs: MagicMock):
+        config: Dict[Hashable, Any] = dict(self.config, worker={'batchSize': 3, 'prefetch': 2})
+        worker: Worker = Worker(config, self.logger)
+        self.assertEqual(worker.prefetchCount, 3)
+        mockChannel: MagicMock = MagicMock()
+        worker.executeProcess(mockChannel, MagicMock(delivery_tag=1, redelivered=False), None, b'1')
+        worker.executeProcess(mockChannel, MagicMock(delivery_tag=2, redelivered=False), None, b'2')
+        mockExecuteJobs.assert_not_called()
+        mockChannel.basic_ack.assert_not_called()
+        # flush timer is only scheduled once per batch
+        mockGetQueueConn.return_value.call_later.assert_called_once()
+        worker.executeProcess(mockChannel, MagicMock(delivery_tag=3, redelivered=False), None, b'3')
+        mockExecuteJobs.assert_called_once_with([JobRequest('1'), JobRequest('2'), JobRequest('3')])
+        mockChannel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+        mockGetQueueConn.return_value.remove_timeout.assert_called_once()
+        self.assertEqual(worker.pendingJobs, [])
+        self.assertIsNone(worker.flushTimer)
+
+    @patch.object(Worker, 'executeJobs')
+    @patch.object(Worker, 'getQueueConnection')
+    def test_flushJobsOnTimeout(self, mockGetQueueConn: MagicMock, mockExecuteJobs: MagicMock):
+        config: Dict[Hashable, Any] = dict(self.config, worker={'batchSize': 3})
+        worker: Worker = Worker(config, self.logger)
+        mockChannel: MagicMock = MagicMock()
+        worker.executeProcess(mockChannel, MagicMock(delivery_tag=7, redelivered=False), None, b'1')
+        # simulate expiration of the batch timeout
+        flushCallback = mockGetQueueConn.return_value.call_later.call_args[0][1]
+        flushCallback()
+        mockExecuteJobs.assert_called_once_with([JobRequest('1')])
+        mockChannel.basic_ack.assert_called_once_with(delivery_tag=7, multiple=True)
+
+    @patch.object(Worker, 'executeJobs')
+    @patch.object(Worker, 'getQueueConnection')
+    def test_executeProcessBatchMessage(self, mockGetQueueConn: MagicMock, mockExecuteJobs: MagicMock):
+        config: Dict[Hashable, Any] = dict(self.config, worker={'batchSize': 2})
+        worker: Worker = Worker(config, self.logger)
+        mockChannel: MagicMock = MagicMock()
+        worker.executeProcess(mockChannel, MagicMock(delivery_tag=4, redelivered=False), None,
+                              b'[1, "2", {"id": 3, "renditions": [{"size": 64, "format": "webp"}]}]')
+        # jobs of the message are executed by batches of batchSize and the message is acknowledged once
+        self.assertEqual(mockExecuteJobs.call_args_list, [
+            call([JobRequest('1'), JobRequest('2')]),
+            call([JobRequest('3', [Rendition(64, 'webp')])]),
+        ])
+        mockChannel.basic_ack.assert_called_once_with(delivery_tag=4, multiple=True)
+
+    @patch.object(Worker, 'executeJobs')
+    def test_executeProcessMalformedMessage(self, mockExecuteJobs: MagicMock):
+        mockChannel: MagicMock = MagicMock()
+        self.worker.executeProcess(mockChannel, MagicMock(delivery_tag=4, redelivered=False), None, b'[1, "two"]')
+        mockExecuteJobs.assert_not_called()
+        mockChannel.basic_reject.assert_called_once_with(delivery_tag=4, requeue=False)
+        self.assertEqual(self.worker.pendingJobs, [])
+
+    @patch.object(Worker, 'makeThumbnail')
+    @patch.object(Worker, 'finishJobs')
+    @patch.object(Worker, 'claimJobs')
+    def test_executeJobsWithRenditionsOfJob(self, mockClaimJobs: MagicMock, mockFinishJobs: MagicMock,
+                                            mockMakeThumbnail: MagicMock):
+        mockClaimJobs.return_value = [(self.jobId, JobStatusEnum.READY_FOR_PROCESSING, self.filePath, 1)]
+        mockMakeThumbnail.return_value = self.thumbnailPaths
+        self.worker.executeJobs([JobRequest(self.jobId, [Rendition(64, 'webp')])])
+        mockMakeThumbnail.assert_called_once_with(self.filePath, [Rendition(64, 'webp')])
+
+    @patch.object(Worker, 'getRedisClient')
+    def test_classifyJobs(self, mockGetRedisClient: MagicMock):
+        worker: Worker = Worker(self.queueClassesConfig, self.logger)
+        mockGetRedisClient.return_value.pipeline.return_value.execute.return_value = [
+            __file__.encode(), b'/img/uploaded/missing.png', None
+        ]
+        classifiedJobs = worker.classifyJobs([JobRequest('1'), JobRequest('2'), JobRequest('3')])
+        self.assertEqual(classifiedJobs, {'small': [JobRequest('1')], 'large': [JobRequest('2'), JobRequest('3')]})
+        mockGetRedisClient.return_value.pipeline.return_value.hget.assert_has_calls([
+            call('1', FILE_PATH_REDIS_KEY), call('2', FILE_PATH_REDIS_KEY), call('3', FILE_PATH_REDIS_KEY)
+        ])
+
+    @patch.object(Worker, 'classifyJobs')
+    def test_routeMessage(self, mockClassifyJobs: MagicMock):
+        worker: Worker = Worker(self.queueClassesConfig, self.logger)
+        mockClassifyJobs.return_value = {'small': [JobRequest('1')], 'large': [JobRequest('2'), JobRequest('3')]}
+        mockChannel: MagicMock = MagicMock()
+        worker.routeMessage(mockChannel, MagicMock(delivery_tag=6, redelivered=False), None, b'[1, 2, 3]')
+        mockClassifyJobs.assert_called_once_with([JobRequest('1'), JobRequest('2'), JobRequest('3')])
+        self.assertEqual([c[0][:3] for c in mockChannel.basic_publish.call_args_list],
+                         [('', 'small', b'1'), ('', 'large', b'[2,3]')])
+        mockChannel.basic_ack.assert_called_once_with(delivery_tag=6)
+
+    @patch.object(Worker, 'executeProcess')
+    def test_consumeQueuesWeighted(self, mockExecuteProcess: MagicMock):
+        worker: Worker = Worker(self.queueClassesConfig, self.logger)
+        worker.channel = MagicMock()
+        worker.queueConn = MagicMock()
+
+        def deliver(time_limit):
+            # deliver a backlog of large jobs and a few small ones at once, then get stopped
+            if worker.queueConn.process_data_events.call_count == 1:
+                for deliveryTag in range(1, 7):
+                    worker.scheduleMessage('large', worker.channel, MagicMock(delivery_tag=deliveryTag), None, b'1')
+                for deliveryTag in range(7, 9):
+                    worker.scheduleMessage('small', worker.channel, MagicMock(delivery_tag=deliveryTag), None, b'1')
+            elif mockExecuteProcess.call_count == 4:
+                worker.stopping = True
+        worker.queueConn.process_data_events.side_effect = deliver
+        worker.consumeQueues()
+        self.assertEqual([c[1]['prefetch_count'] for c in worker.channel.basic_qos.call_args_list], [15, 5, 20])
+        self.assertEqual([c[0][0] for c in worker.channel.basic_consume.call_args_list],
+                         ['small', 'large', 'test_queue'])
+        # small jobs are served first despite the backlog of large ones
+        self.assertEqual([c[0][1].delivery_tag for c in mockExecuteProcess.call_args_list], [7, 8, 1, 2])
+        # messages which were not started go back to their queue
+        self.assertEqual([c[1]['delivery_tag'] for c in worker.channel.basic_nack.call_args_list], [3, 4, 5, 6])
+
+    @patch.object(Worker, 'executeJobs')
+    def test_flushJobsAcknowledgeEachMessageOfQueueClasses(self, mockExecuteJobs: MagicMock):
+        worker: Worker = Worker(self.queueClassesConfig, self.logger)
+        worker.pendingJobs = [(5, JobRequest('1')), (2, JobRequest('2')), (5, JobRequest('3'))]
+        mockChannel: MagicMock = MagicMock()
+        worker.flushJobs(mockChannel)
+        self.assertEqual(mockChannel.basic_ack.call_args_list, [call(delivery_tag=2), call(delivery_tag=5)])
+
+    @patch.object(Worker, 'executeJobs')
+    def test_flushJobsWithoutPendingJobs(self, mockExecuteJobs: MagicMock):
+        mockChannel: MagicMock = MagicMock()
+        self.worker.flushJobs(mockChannel)
+        mockExecuteJobs.assert_not_called()
+        mockChannel.basic_ack.assert_not_called()
 
     @patch.object(Worker, 'executeProcess')
     @patch.object(Worker, 'getQueueConnection')
@@ -299,10 +904,75 @@ class TestWorker(unittest.TestCase):
             self.worker.processJob()
         queueName: str = self.config["queue"]["queueName"]
         mockChannel.queue_declare.assert_called_once_with(queueName, durable=True)
+        mockChannel.basic_qos.assert_called_once_with(prefetch_count=self.worker.prefetchCount)
         mockChannel.basic_consume.assert_called_once_with(queueName, executeProcess)
         mockChannel.start_consuming.assert_called_once()
         mockConn.close.assert_called_once()
 
+    @patch('worker.time.sleep')
+    @patch.object(Worker, 'getQueueConnection')
+    def test_processJobReconnectAfterConnectionLost(self, mockGetQueueConn: MagicMock, mockSleep: MagicMock):
+        worker: Worker = Worker(self.config, self.logger)
+        worker.pendingJobs = [(1, JobRequest(self.jobId))]
+        lostChannel: MagicMock = MagicMock()
+        lostChannel.start_consuming.side_effect = StreamLostError('lost')
+        newChannel: MagicMock = MagicMock()
+        newChannel.start_consuming.side_effect = worker.stop
+        mockGetQueueConn.return_value.channel.side_effect = [lostChannel, newChannel]
+        with self.assertRaises(SystemExit) as context:
+            worker.processJob()
+        self.assertEqual(context.exception.code, 0)
+        newChannel.start_consuming.assert_called_once()
+        mockSleep.assert_called_once()
+        # jobs buffered from the lost connection are redelivered by RabbitMQ
+        self.assertEqual(worker.pendingJobs, [])
+        self.assertEqual(worker.reconnects['amqp'], 1)
+
+    @patch('worker.Image')
+    def test_warmUpCoders(self, mockImage: MagicMock):
+        self.worker.warmUpCoders()
+        img: MagicMock = mockImage.return_value.__enter__.return_value
+        # gif, jpeg and png coders, jpeg renditions are among them
+        self.assertEqual(mockImage.call_count, 6)
+        self.assertEqual(img.format, 'png')
+        mockImage.assert_called_with(blob=img.make_blob.return_value)
+
+    @patch('worker.Image')
+    def test_warmUpCodersFailure(self, mockImage: MagicMock):
+        mockImage.side_effect = self.exception
+        self.worker.warmUpCoders()
+        self.assertEqual(mockImage.call_count, 3)
+
+    @patch('worker.time.monotonic')
+    def test_reportStartup(self, mockMonotonic: MagicMock):
+        mockMonotonic.return_value = 12.0
+        worker: Worker = Worker(self.config, self.logger)
+        worker.spawnedAt = 10.5
+        worker.reportStartup()
+        self.assertEqual(worker.metrics.startupSeconds, 1.5)
+
+    def test_stop(self):
+        worker: Worker = Worker(self.config, self.logger)
+        worker.queueConn = MagicMock()
+        worker.channel = MagicMock()
+        worker.stop()
+        self.assertTrue(worker.stopping)
+        worker.queueConn.add_callback_threadsafe.assert_called_once_with(worker.channel.stop_consuming)
+
+    @patch.object(Worker, 'flushJobs')
+    @patch.object(Worker, 'getQueueConnection')
+    def test_processJobDrainAfterStop(self, mockGetQueueConn: MagicMock, mockFlushJobs: MagicMock):
+        worker: Worker = Worker(self.config, self.logger)
+        worker.queueConn = MagicMock()
+        mockChannel: MagicMock = MagicMock()
+        mockGetQueueConn.return_value.channel.return_value = mockChannel
+        mockChannel.start_consuming.side_effect = worker.stop
+        with self.assertRaises(SystemExit) as context:
+            worker.processJob()
+        self.assertEqual(context.exception.code, 0)
+        mockFlushJobs.assert_called_once_with(mockChannel)
+        worker.queueConn.close.assert_called_once()
+
     @patch.object(Worker, 'getQueueConnection')
     def test_processJobFailureOnGettingChannel(self, mockGetQueueConn: MagicMock):
         mockConn: MagicMock = MagicMock()
@@ -0,0 +1,177 @@
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from functools import partial
+from logging import Logger
+from pika import BasicProperties, BlockingConnection
+from pika.exceptions import AMQPConnectionError
+from typing import Union, List, Tuple, Dict, Set, Callable
+from wand.resource import limits
+from constants import DEFAULT_MAX_IN_FLIGHT, DEFAULT_RESIZE_THREADS, DEFAULT_IMAGEMAGICK_THREADS, ACK_STAGE, \
+    ERROR_MALFORMED_MESSAGE
+from job_message import JobRequest, parseJobMessage
+from scheduling import splitPrefetchCount
+from worker import Worker
+
+
+class ThreadedWorker(Worker):
+    """
+    Worker engine in which one consumer thread feeds a bounded pool of threads making thumbnails in a single process
+    Wand calls release the GIL while ImageMagick decodes, resizes and encodes, so threads scale over the cores while
+    sharing one interpreter, one ImageMagick state and one set of connections. Pool threads never use the channel:
+    acknowledgements and publications are handed back to the consumer thread
+    """
+
+    def __init__(self, config: dict, logger: Logger):
+        super().__init__(config, logger)
+        workerConfig: dict = config.get("worker", {})
+        self.threads: int = max(workerConfig.get("threads", DEFAULT_RESIZE_THREADS), 1)
+        # prefetch window bounds the messages in flight, it must keep every thread busy
+        self.maxInFlight: int = max(workerConfig.get("maxInFlight", DEFAULT_MAX_IN_FLIGHT), self.threads)
+        self.imageMagickThreads: int = workerConfig.get("imageMagickThreads", DEFAULT_IMAGEMAGICK_THREADS)
+        self.executor: Union[ThreadPoolExecutor, None] = None
+        self.futures: Set[Future] = set()
+        # messages received and not yet acknowledged, only used by the consumer thread
+        self.inFlight: int = 0
+        self.failed: bool = False
+
+    def onMessage(self, channel, method_frame, header_frame: BasicProperties, body: bytes):
+        """
+        Callback when receiving a message: hand its jobs to the thread pool
+        :param channel: channel from which the message comes
+        :param method_frame: method frame of the message
+        :param header_frame: header frame of the message
+        :param body: body of the message: a job id or a JSON array of jobs
+        """
+        try:
+            jobs: List[JobRequest] = parseJobMessage(body, self.encoding, method_frame.redelivered)
+        except ValueError as exc:
+            self.logger.error("%s %s", ERROR_MALFORMED_MESSAGE, exc)
+            channel.basic_reject(delivery_tag=method_frame.delivery_tag, requeue=False)
+            return
+        self.logger.debug("receiving jobs: %s", jobs)
+        if not jobs:
+            channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+            return
+        self.inFlight += 1
+        future: Future = self.executor.submit(
+            self.runMessage, self.queueConn, channel, method_frame.delivery_tag, jobs
+        )
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+
+    def runMessage(self, queueConn: BlockingConnection, channel, deliveryTag: int, jobs: List[JobRequest]):
+        """
+        Run the jobs of a message on a pool thread, then hand the message back to the consumer thread
+        :param queueConn: connection of the consumer thread
+        :param channel: channel from which the message comes
+        :param deliveryTag: delivery tag of the message
+        :param jobs: jobs requested by the message
+        """
+        try:
+            failedJobs: List[Tuple[JobRequest, int, str, str]] = self.runJobs(jobs)
+        except BaseException as exc:
+            # including the exit of a job whose status cannot be updated
+            self.handBack(queueConn, partial(self.abort, exc))
+            return
+        self.handBack(queueConn, partial(self.completeMessage, channel, deliveryTag, failedJobs))
+
+    def handBack(self, queueConn: BlockingConnection, callback: Callable[[], None]):
+        """
+        Run a callback on the consumer thread
+        :param queueConn: connection of the consumer thread
+        :param callback: callback using the channel
+        """
+        try:
+            queueConn.add_callback_threadsafe(callback)
+        except Exception as exc:
+            # the connection was lost meanwhile: RabbitMQ redelivers the message
+            self.logger.warning("cannot hand message back to the consumer: %s", exc)
+
+    def completeMessage(self, channel, deliveryTag: int, failedJobs: List[Tuple[JobRequest, int, str, str]]):
+        """
+        Publish the failed jobs of a message and acknowledge it, on the consumer thread
+        :param channel: channel from which the message comes
+        :param deliveryTag: delivery tag of the message
+        :param failedJobs: failed jobs to publish, see getFailedJob
+        """
+        self.publishFailedJobs(channel, failedJobs)
+        # messages complete out of order, so each message is acknowledged on its own
+        with self.metrics.time(ACK_STAGE):
+            channel.basic_ack(delivery_tag=deliveryTag)
+        self.inFlight -= 1
+
+    def abort(self, exc: BaseException):
+        """
+        Stop consuming after a job failed unexpectedly, on the consumer thread: the process exits once the other
+        messages in flight are acknowledged, the failed message is redelivered
+        :param exc: error of the job
+        """
+        self.logger.critical("job failed unexpectedly: %r", exc)
+        self.inFlight -= 1
+        self.failed = True
+        self.stopping = True
+        if self.channel is not None:
+            self.channel.stop_consuming()
+
+    def getConsumedQueues(self) -> List[Tuple[str, int, Callable]]:
+        """
+        Get queues to consume with their share of the in-flight messages, so that one queue cannot take every thread
+        Messages of queueName are routed on the consumer thread
+        :return: name, prefetch count and message callback of each queue
+        """
+        prefetchCounts: Dict[str, int] = splitPrefetchCount(self.queueClasses, self.maxInFlight)
+        consumedQueues: List[Tuple[str, int, Callable]] = [
+            (queueClass.name, prefetchCounts[queueClass.name], self.onMessage) for queueClass in self.queueClasses
+        ]
+        if self.routing:
+            consumedQueues.append((self.config["queue"]["queueName"], self.maxInFlight, self.routeMessage))
+        return consumedQueues
+
+    def waitInFlight(self):
+        """
+        Process the callbacks handed back by pool threads until every message in flight is acknowledged
+        """
+        while self.inFlight > 0:
+            # returns once a handed back callback ran
+            self.queueConn.process_data_events(time_limit=None)
+
+    def processJob(self):
+        """
+        Process jobs from the queue server on a pool of threads, connecting again when the connection is lost
+        """
+        self.logger.info("processJob (threaded) by pid: %s", os.getpid())
+        signal.signal(signal.SIGTERM, self.stop)
+        # process-wide limit: every ImageMagick operation of a job runs on at most imageMagickThreads threads
+        limits["thread"] = self.imageMagickThreads
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="resize")
+        try:
+            while not self.stopping:
+                try:
+                    self.channel = self.getQueueConnection().channel()
+                    for queueName, prefetchCount, onMessage in self.getConsumedQueues():
+                        self.channel.queue_declare(queueName, durable=True)
+                        # prefetch count applies to the consumers created afterwards
+                        self.channel.basic_qos(prefetch_count=prefetchCount)
+                        self.channel.basic_consume(queueName, onMessage)
+                    self.logger.info("start_consuming with %s threads", self.threads)
+                    self.reportStartup()
+                    self.channel.start_consuming()
+                    break
+                except AMQPConnectionError as exc:
+                    if self.stopping:
+                        raise
+                    # jobs in flight still finish, their messages are redelivered
+                    wait(list(self.futures))
+                    self.inFlight = 0
+                    self.dropQueueConnection(exc)
+            # consuming was stopped: wait for the messages in flight to be acknowledged
+            if self.channel is not None:
+                self.waitInFlight()
+        except Exception as exc:
+            self.logger.critical(exc)
+        finally:
+            self.executor.shutdown(wait=False)
+            if self.queueConn is not None and self.queueConn.is_open:
+                self.queueConn.close()
+            exit(0 if self.stopping and not self.failed else 1)
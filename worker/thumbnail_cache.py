@@ -0,0 +1,139 @@
+import os
+import shutil
+import threading
+import time
+from hashlib import blake2b
+from logging import Logger
+from redis import Redis
+from typing import Callable, Dict, Union
+from constants import CACHE_LRU_REDIS_KEY, CACHE_SIZES_REDIS_KEY, CACHE_TOTAL_BYTES_REDIS_KEY, \
+    DEFAULT_CACHE_MAX_BYTES, CACHE_DIR_NAME, HASH_CHUNK_SIZE
+
+
+class ThumbnailCache:
+    """
+    Content-addressed cache of thumbnails shared by every worker
+    Entries are directories keyed by a hash of the uploaded bytes and of the rendition parameters.
+    Thumbnails are hard linked (copied if linking is not possible) between the cache and the thumbnail directory.
+    Recency and size of entries are tracked in Redis so that the least recently used entries are evicted
+    once the cache grows over its maximum size
+    """
+
+    def __init__(self, cacheConfig: dict, thumbnailDir: str, logger: Logger, getRedisClient: Callable[[], Redis]):
+        self.enabled: bool = cacheConfig.get("enabled", False)
+        self.cacheDir: str = cacheConfig.get("path", os.path.join(thumbnailDir, CACHE_DIR_NAME))
+        self.maxBytes: int = cacheConfig.get("maxBytes", DEFAULT_CACHE_MAX_BYTES)
+        self.logger = logger
+        self.getRedisClient = getRedisClient
+
+    def computeKey(self, filePath: str, parameters: str) -> Union[str, None]:
+        """
+        Compute cache key of an uploaded file
+        :param filePath: input image file path
+        :param parameters: fingerprint of the parameters used to produce the thumbnails
+        :return: cache key, None if the file cannot be read
+        """
+        digest = blake2b(parameters.encode("utf-8"), digest_size=16)
+        try:
+            with open(filePath, "rb") as stream:
+                for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+        except OSError as exc:
+            self.logger.warning("cannot compute cache key of %s: %s", filePath, exc)
+            return None
+        return digest.hexdigest()
+
+    def getEntryDir(self, key: str) -> str:
+        """
+        Get directory of a cache entry, spread over subdirectories to keep directories small
+        :param key: cache key
+        :return: entry directory path
+        """
+        return os.path.join(self.cacheDir, key[:2], key)
+
+    def fetch(self, key: str, thumbnailPaths: Dict[str, str]) -> bool:
+        """
+        Link cached thumbnails into their thumbnail paths
+        :param key: cache key
+        :param thumbnailPaths: thumbnail paths by name of the cached file
+        :return: True on cache hit, False otherwise
+        """
+        entryDir: str = self.getEntryDir(key)
+        try:
+            cachedPaths: Dict[str, str] = {name: os.path.join(entryDir, name) for name in thumbnailPaths}
+            if not all(os.path.isfile(cachedPath) for cachedPath in cachedPaths.values()):
+                return False
+            for name, thumbnailPath in thumbnailPaths.items():
+                self.linkFile(cachedPaths[name], thumbnailPath)
+            self.getRedisClient().zadd(CACHE_LRU_REDIS_KEY, {key: time.time()})
+        except Exception as exc:
+            self.logger.warning("cannot fetch cache entry %s: %s", key, exc)
+            return False
+        self.logger.debug("cache hit for entry %s", key)
+        return True
+
+    def store(self, key: str, thumbnailPaths: Dict[str, str]):
+        """
+        Store freshly made thumbnails into the cache and evict least recently used entries if needed
+        :param key: cache key
+        :param thumbnailPaths: thumbnail paths by name of the cached file
+        """
+        entryDir: str = self.getEntryDir(key)
+        tmpDir: str = "%s.%s.%s.tmp" % (entryDir, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(tmpDir, exist_ok=True)
+            entrySize: int = 0
+            for name, thumbnailPath in thumbnailPaths.items():
+                self.linkFile(thumbnailPath, os.path.join(tmpDir, name))
+                entrySize += os.path.getsize(thumbnailPath)
+            try:
+                os.rename(tmpDir, entryDir)
+            except OSError:
+                # another worker stored the same entry in the meantime
+                shutil.rmtree(tmpDir, ignore_errors=True)
+                return
+            pipeline = self.getRedisClient().pipeline(transaction=False)
+            pipeline.zadd(CACHE_LRU_REDIS_KEY, {key: time.time()})
+            pipeline.hset(CACHE_SIZES_REDIS_KEY, key, entrySize)
+            pipeline.incrby(CACHE_TOTAL_BYTES_REDIS_KEY, entrySize)
+            totalBytes: int = pipeline.execute()[-1]
+            self.logger.debug("stored cache entry %s of %s bytes", key, entrySize)
+            if totalBytes > self.maxBytes:
+                self.evict(totalBytes)
+        except Exception as exc:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+            self.logger.warning("cannot store cache entry %s: %s", key, exc)
+
+    def evict(self, totalBytes: int):
+        """
+        Evict least recently used entries until the cache fits in its maximum size
+        :param totalBytes: current size of the cache in bytes
+        """
+        redisClient: Redis = self.getRedisClient()
+        while totalBytes > self.maxBytes:
+            oldestEntries: list = redisClient.zpopmin(CACHE_LRU_REDIS_KEY)
+            if not oldestEntries:
+                break
+            key: str = oldestEntries[0][0].decode("utf-8")
+            entrySize: int = int(redisClient.hget(CACHE_SIZES_REDIS_KEY, key) or 0)
+            shutil.rmtree(self.getEntryDir(key), ignore_errors=True)
+            pipeline = redisClient.pipeline(transaction=False)
+            pipeline.hdel(CACHE_SIZES_REDIS_KEY, key)
+            pipeline.decrby(CACHE_TOTAL_BYTES_REDIS_KEY, entrySize)
+            totalBytes = pipeline.execute()[-1]
+            self.logger.info("evicted cache entry %s of %s bytes", key, entrySize)
+
+    @staticmethod
+    def linkFile(sourcePath: str, targetPath: str):
+        """
+        Hard link source file into target path, replacing target atomically. Copy if linking is not possible
+        :param sourcePath: existing file path
+        :param targetPath: path of the link to create
+        """
+        tmpPath: str = "%s.%s.%s.tmp" % (targetPath, os.getpid(), threading.get_ident())
+        os.makedirs(os.path.dirname(targetPath), exist_ok=True)
+        try:
+            os.link(sourcePath, tmpPath)
+        except OSError:
+            shutil.copyfile(sourcePath, tmpPath)
+        os.replace(tmpPath, targetPath)
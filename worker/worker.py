@@ -1,205 +1,894 @@
 import os
+import signal
+import time
+import uuid
+from functools import partial
 from pika import BlockingConnection, ConnectionParameters, BasicProperties
+from pika.exceptions import AMQPConnectionError
 from logging import Logger
-from redis import Redis
-from typing import Union, List, Tuple
-from constants import FILE_PATH_REDIS_KEY, JOB_STATUS_REDIS_KEY, EMPTY_STR, \
-    THUMBNAIL_PATH_REDIS_KEY, ERROR_SAME_JOB_STATUS, THUMBNAIL_MAX_PIXEL, ERROR_PROCESSING_IMAGE
+from redis import Redis, BlockingConnectionPool
+from redis.client import Script
+from typing import Union, List, Tuple, Dict, Callable, Collection, TypeVar
+from constants import FILE_PATH_REDIS_KEY, JOB_STATUS_REDIS_KEY, \
+    THUMBNAIL_PATH_REDIS_KEY, ERROR_JOB_NOT_CLAIMED, THUMBNAIL_MAX_PIXEL, ERROR_PROCESSING_IMAGE, \
+    DEFAULT_PREFETCH_COUNT, DEFAULT_BATCH_SIZE, DEFAULT_BATCH_TIMEOUT, CLAIM_JOBS_SCRIPT, DECODE_HINT_FACTOR, \
+    JPEG_SIZE_HINT_OPTION, THUMBNAIL_FILE_EXTENSIONS, REDIS_FETCH_STAGE, STATUS_UPDATE_STAGE, DECODE_STAGE, \
+    RESIZE_STAGE, ENCODE_SAVE_STAGE, ACK_STAGE, JOB_LOG_FORMAT, ERROR_MALFORMED_MESSAGE, DEFAULT_STREAM_MIN_PIXELS, \
+    FIT_MODE_BOX, JPEG_FORMATS, ANIMATED_THUMBNAIL_FORMATS, DEFAULT_ANIMATION_MAX_FRAMES, WARM_START_FORMATS, \
+    ATTEMPTS_REDIS_KEY, ERROR_POISON_JOB, CLAIM_TOKEN_REDIS_KEY, CLAIMED_STATUS_REDIS_KEY, CLAIMED_AT_REDIS_KEY, \
+    DEFAULT_CLAIM_LEASE, DEFAULT_MAX_RENDITION_SIZE, ERROR_INVALID_RENDITION
 from job_status_enum import JobStatusEnum
+from geometry import Geometry, FIT_MODES, fitGeometry, preScaleFactor
+from rendition import Rendition, parseRenditions, checkRenditions
+from job_message import JobRequest, parseJobMessage, formatJobMessage
+from scheduling import QueueClass, WeightedScheduler, parseQueueClasses, classifyFileSize, splitPrefetchCount
+from retry import RetryPolicy, TransientError, isTransient
+from status_events import StatusEvents
+from connections import REDIS_CONNECTION_ERRORS, Backoff, createRedisPool, getPoolStats
+from thumbnail_cache import ThumbnailCache
+from storage import Storage, LocalStorage, createStorage
+from metrics import WorkerMetrics
+from pixel_budget import PixelBudget
+from encoding import Encoder, EncodingProfile
+from resize_backend import ResizeBackend, createResizeBackend
+from streaming import RasterStream, openRasterStream, streamResize, toNetpbm
 from wand.image import Image
 
+T = TypeVar("T")
+
 
 class Worker:
     def __init__(self, config: dict, logger: Logger):
         self.config = config
         self.logger = logger
         self.redisClient: Union[Redis, None] = None
+        self.redisPool: Union[BlockingConnectionPool, None] = None
         self.queueConn: Union[BlockingConnection, None] = None
+        self.channel = None
+        self.stopping: bool = False
+        self.claimJobsScript: Union[Script, None] = None
         self.encoding = "utf-8"
-        self.thumbnailImgFormat = "jpeg"
+        workerConfig: dict = config.get("worker", {})
+        self.metrics: WorkerMetrics = WorkerMetrics(workerConfig.get("metrics", {}), logger)
+        self.encoder: Encoder = Encoder(workerConfig.get("encoding", {}), logger)
+        self.maxRenditionSize: int = workerConfig.get("maxRenditionSize", DEFAULT_MAX_RENDITION_SIZE)
+        configuredRenditions: List[Rendition] = parseRenditions(workerConfig)
+        checkRenditions(configuredRenditions, self.maxRenditionSize)
+        self.renditions: List[Rendition] = [
+            self.encoder.resolveRendition(rendition) for rendition in configuredRenditions
+        ]
+        self.shrinkOnLoad: bool = workerConfig.get("shrinkOnLoad", True)
+        animationConfig: dict = workerConfig.get("animation", {})
+        self.animation: bool = animationConfig.get("enabled", False)
+        self.maxAnimationFrames: int = max(animationConfig.get("maxFrames", DEFAULT_ANIMATION_MAX_FRAMES), 2)
+        self.fitMode: str = workerConfig.get("fitMode", FIT_MODE_BOX)
+        if self.fitMode not in FIT_MODES:
+            raise ValueError("unknown fit mode: %s" % self.fitMode)
+        self.pixelBudget: PixelBudget = PixelBudget(workerConfig.get("pixelBudget", {}), logger)
+        self.resizeBackend: ResizeBackend = createResizeBackend(workerConfig.get("resize", {}))
+        streamingConfig: dict = workerConfig.get("streaming", {})
+        self.streaming: bool = streamingConfig.get("enabled", False)
+        self.streamMinPixels: int = streamingConfig.get("minPixels", DEFAULT_STREAM_MIN_PIXELS)
+        self.storage: Storage = createStorage(config["fileStorage"], logger)
+        self.thumbnailCache: ThumbnailCache = ThumbnailCache(
+            workerConfig.get("cache", {}), config["fileStorage"]["thumbnailPath"], logger, self.getRedisClient
+        )
+        # cache entries are hard links of thumbnail files
+        if self.thumbnailCache.enabled and not isinstance(self.storage, LocalStorage):
+            raise ValueError("thumbnail cache requires local file storage")
+        self.batchSize: int = workerConfig.get("batchSize", DEFAULT_BATCH_SIZE)
+        # prefetch window must at least hold a full batch, otherwise the batch never fills up
+        self.prefetchCount: int = max(workerConfig.get("prefetch", DEFAULT_PREFETCH_COUNT), self.batchSize)
+        self.batchTimeout: float = workerConfig.get("batchTimeout", DEFAULT_BATCH_TIMEOUT)
+        # must exceed the time to process a batch, otherwise jobs still being processed are claimed again
+        self.claimLease: int = workerConfig.get("claimLease", DEFAULT_CLAIM_LEASE)
+        self.pendingJobs: List[Tuple[int, JobRequest]] = []
+        self.flushTimer = None
+        self.queueClasses: List[QueueClass] = parseQueueClasses(config["queue"])
+        # jobs published into queueName are routed to the queue of their size class unless it is one of them
+        self.routing: bool = config["queue"]["queueName"] not in [queueClass.name for queueClass in self.queueClasses]
+        self.scheduler: WeightedScheduler = WeightedScheduler(self.queueClasses)
+        self.retryPolicy: RetryPolicy = RetryPolicy(
+            workerConfig.get("retry", {}), config["queue"]["queueName"], self.encoding, logger
+        )
+        self.backoff: Backoff = Backoff(workerConfig.get("reconnect", {}))
+        self.reconnects: Dict[str, int] = {"redis": 0, "amqp": 0}
+        self.metrics.connectionStats = self.getConnectionStats
+        self.statusEvents: StatusEvents = StatusEvents(workerConfig.get("statusEvents", {}))
+        # replaced by the spawn time of the consumer process when run by the supervisor
+        self.spawnedAt: float = time.monotonic()
+
+    def warmUpCoders(self):
+        """
+        Load the ImageMagick coders of the rendition formats and of common input formats by encoding and decoding a
+        1x1 image in each format, so that the first jobs do not pay for it
+        """
+        imageFormats: List[str] = sorted(set(WARM_START_FORMATS) | {rendition.format for rendition in self.renditions})
+        for imageFormat in imageFormats:
+            try:
+                with Image(width=1, height=1) as img:
+                    img.format = imageFormat
+                    with Image(blob=img.make_blob()):
+                        pass
+            except Exception as exc:
+                self.logger.warning("cannot warm up %s coder: %s", imageFormat, exc)
+
+    def reportStartup(self):
+        """
+        Report the startup time of the consumer, from its spawn to consuming messages, once: consuming again after a
+        reconnection is not a startup
+        """
+        if self.metrics.startupSeconds is not None:
+            return
+        startupSeconds: float = time.monotonic() - self.spawnedAt
+        self.metrics.startupSeconds = startupSeconds
+        self.logger.info("consumer of pid %s ready in %.0f ms", os.getpid(), startupSeconds * 1000)
 
     def getRedisClient(self) -> Redis:
         """
-        Get redis client if exists else create a new client
+        Get redis client if exists else create a new client on a new connection pool
         :return: current or new Redis client instance
         """
         if self.redisClient is not None:
-            self.logger.info("getting existing redis client")
+            self.logger.debug("getting existing redis client")
             return self.redisClient
         try:
             self.logger.info("creating new redis client")
-            self.redisClient: Redis = Redis(host=self.config["kvs"]["host"], port=self.config["kvs"]["port"])
+            self.redisPool = createRedisPool(self.config["kvs"])
+            self.redisClient: Redis = Redis(connection_pool=self.redisPool)
         except Exception as exc:
             self.logger.critical(exc)
             exit(1)
         return self.redisClient
 
+    def callRedis(self, operation: Callable[[], T], description: str) -> T:
+        """
+        Send Redis commands, sending them again on another connection of the pool after a jittered delay when they
+        fail with a connection or timeout error
+        :param operation: function sending the commands, called once per attempt
+        :param description: description of the commands for logs
+        :return: result of the operation
+        :raise: error of the last attempt once every attempt failed, other errors right away
+        """
+        return self.backoff.call(operation, REDIS_CONNECTION_ERRORS, description, self.logger,
+                                 partial(self.countReconnect, "redis"))
+
+    def countReconnect(self, server: str):
+        """
+        Count one new attempt to reach a server
+        :param server: redis or amqp
+        """
+        self.reconnects[server] += 1
+
+    def getConnectionStats(self) -> Dict[str, int]:
+        """
+        Get statistics of the connections of the process, served with the metrics
+        :return: occupancy of the Redis pool and reconnection counts by metric name
+        """
+        stats: Dict[str, int] = getPoolStats(self.redisPool) if self.redisPool is not None else {}
+        stats["redis_retries_total"] = self.reconnects["redis"]
+        stats["amqp_reconnects_total"] = self.reconnects["amqp"]
+        return stats
+
     def getQueueConnection(self) -> BlockingConnection:
         """
         Get queue connection if exists else create a new connection
+        A refused connection is tried again with jittered backoff before giving up
         :return: current or new RabbitMQ connection
         """
         if self.queueConn is not None:
-            self.logger.info("getting existing RabbitMQ connection ")
+            self.logger.debug("getting existing RabbitMQ connection")
             return self.queueConn
         parameters = ConnectionParameters(host=self.config["queue"]["host"],
                                           port=self.config["queue"]["port"])
         try:
-            self.logger.info("creating new RabbitMQ connection ")
-            self.queueConn: BlockingConnection = BlockingConnection(parameters)
+            self.logger.info("creating new RabbitMQ connection")
+            self.queueConn: BlockingConnection = self.backoff.call(
+                partial(BlockingConnection, parameters), (AMQPConnectionError,), "connecting to RabbitMQ", self.logger,
+                partial(self.countReconnect, "amqp")
+            )
         except Exception as exc:
             self.logger.critical(exc)
             exit(1)
         return self.queueConn
 
-    def getJobInfoFromRedis(self, jobId: str) -> Tuple[JobStatusEnum, str]:
+    def claimJobs(self, jobIds: List[str], redeliveredJobIds: Collection[str] = ()) \
+            -> List[Tuple[str, JobStatusEnum, str, int]]:
         """
-        Get job information from Redis
-        :param jobId: id of the job
-        :return: job info of the job containing jobstatus and filepath
+        Read job info and move jobs to PROCESSING in Redis within a single atomic round trip
+        A job is claimed only if it exists and is not already being processed by another worker, every claim counts
+        as one attempt of the job. The claim is sent again after a connection error, its token lets it claim again the
+        jobs it already claimed if only the reply was lost
+        A claim is a lease of claimLease seconds: a job left PROCESSING by a worker which died is claimed again once the
+        lease expired, or right away when its message was redelivered, and the new claim counts as another attempt
+        :param jobIds: ids of the jobs
+        :param redeliveredJobIds: ids of the jobs whose message was redelivered
+        :return: list of claimed jobs containing job id, previous job status, filepath and number of attempts
         """
+        claimedJobs: List[Tuple[str, JobStatusEnum, str, int]] = []
+        if not jobIds:
+            return claimedJobs
         try:
-            self.logger.info("getting data from redis")
-            currentJobStatus, filePath, thumbnailPath = self.getRedisClient().hmget(
-                jobId, [JOB_STATUS_REDIS_KEY, FILE_PATH_REDIS_KEY, THUMBNAIL_PATH_REDIS_KEY]
-            )
-            currentJobStatus: JobStatusEnum = JobStatusEnum(int(currentJobStatus.decode(self.encoding)))
-            filePath: str = filePath.decode(self.encoding)
-            thumbnailPath: str = thumbnailPath.decode(self.encoding)
-
-            self.logger.info("data from redis: [%s,%s, %s]" % (currentJobStatus, filePath, thumbnailPath))
+            self.logger.debug("claiming jobs %s in redis", jobIds)
+            if self.claimJobsScript is None:
+                self.claimJobsScript = self.getRedisClient().register_script(CLAIM_JOBS_SCRIPT)
+            claimArgs: List = [
+                JOB_STATUS_REDIS_KEY, FILE_PATH_REDIS_KEY, JobStatusEnum.PROCESSING.value, ATTEMPTS_REDIS_KEY,
+                CLAIM_TOKEN_REDIS_KEY, CLAIMED_STATUS_REDIS_KEY, uuid.uuid4().hex
+            ] + self.statusEvents.getScriptArgs() + [
+                CLAIMED_AT_REDIS_KEY, self.claimLease,
+                "".join("1" if jobId in redeliveredJobIds else "0" for jobId in jobIds), int(time.time())
+            ]
+            with self.metrics.time(REDIS_FETCH_STAGE):
+                jobInfos: List = self.callRedis(
+                    partial(self.claimJobsScript, keys=jobIds, args=claimArgs), "claiming jobs"
+                )
+            for jobId, (currentJobStatus, filePath, attempts) in zip(jobIds, jobInfos):
+                if attempts is None or filePath is None:
+                    self.logger.warning("job %s: %s", jobId, ERROR_JOB_NOT_CLAIMED)
+                    continue
+                currentJobStatus: JobStatusEnum = JobStatusEnum(int(currentJobStatus.decode(self.encoding)))
+                if currentJobStatus == JobStatusEnum.PROCESSING:
+                    # claimed again from a claim which did not keep the status before it
+                    currentJobStatus = JobStatusEnum.READY_FOR_PROCESSING
+                claimedJobs.append((jobId, currentJobStatus, filePath.decode(self.encoding), int(attempts)))
+            self.logger.debug("claimed jobs from redis: %s", claimedJobs)
         except Exception as exc:
             self.logger.critical(exc)
             exit(1)
-        return currentJobStatus, filePath
+        return claimedJobs
 
-    def updateJobInfo(self, jobId: str, currentJobStatus: JobStatusEnum,
-                      nextJobStatus: JobStatusEnum, thumbnailPath: str = "") -> JobStatusEnum:
+    def finishJobs(self, finishedJobs: List[Tuple[str, JobStatusEnum, Dict[str, str]]]):
         """
-        Update job status into Redis
-        :param jobId: current job id
-        :param currentJobStatus: current job status
-        :param nextJobStatus: next job status
-        :param thumbnailPath: path of the thumbnail image file
-        :return: nextJobStatus if successful
+        Update job status and thumbnail paths of finished jobs into Redis using a single pipeline, with the events of
+        their status transitions
+        Thumbnails of the batch are flushed to disk first, so that a job is never COMPLETE before its files are durable
+        :param finishedJobs: list of finished jobs containing job id, next job status and thumbnail paths
+        by redis field
         """
-        if currentJobStatus == nextJobStatus:
-            self.logger.critical(ERROR_SAME_JOB_STATUS)
-            exit(1)
-        try:
-            self.logger.info("updating job info into redis")
-            if thumbnailPath == EMPTY_STR:
-                self.getRedisClient().hset(jobId, JOB_STATUS_REDIS_KEY, nextJobStatus.value)
-                self.logger.info("successfully updated job status from: %s to: %s" % (currentJobStatus, nextJobStatus))
-            else:
-                mapping: dict = {
-                    JOB_STATUS_REDIS_KEY: nextJobStatus.value,
-                    THUMBNAIL_PATH_REDIS_KEY: thumbnailPath
-                }
-                self.getRedisClient().hmset(jobId, mapping)
-                self.logger.info("successfully updated job status from: %s to: %s and thumbnail path: %s"
-                                 % (currentJobStatus, nextJobStatus, thumbnailPath))
+        if not finishedJobs:
+            return
+        self.storage.sync(path for _, _, thumbnailPaths in finishedJobs for path in thumbnailPaths.values())
+
+        def updateJobs() -> List:
+            # a pipeline is emptied once executed, even when it fails
+            pipeline = self.getRedisClient().pipeline(transaction=False)
+            for jobId, nextJobStatus, thumbnailPaths in finishedJobs:
+                if not thumbnailPaths:
+                    pipeline.hset(jobId, JOB_STATUS_REDIS_KEY, nextJobStatus.value)
+                else:
+                    mapping: dict = dict(thumbnailPaths)
+                    mapping[JOB_STATUS_REDIS_KEY] = nextJobStatus.value
+                    pipeline.hmset(jobId, mapping)
+                self.statusEvents.add(pipeline, jobId, nextJobStatus)
+            return pipeline.execute()
 
+        try:
+            self.logger.debug("updating info of %s jobs into redis", len(finishedJobs))
+            with self.metrics.time(STATUS_UPDATE_STAGE):
+                self.callRedis(updateJobs, "updating jobs")
+            self.logger.debug("successfully updated job info: %s", finishedJobs)
         except Exception as exc:
             self.logger.critical(exc)
             exit(1)
-        return nextJobStatus
 
-    def findThumbnailSize(self, width: int, height: int) -> Tuple[int, int]:
+    def findThumbnailSize(self, width: int, height: int, maxPixel: int = THUMBNAIL_MAX_PIXEL) -> Geometry:
         """
-        Function to find optimal thumbnail size (default: max width=100px and max height=100px)
+        Function to find exact thumbnail geometry in the configured fit mode (default: max width=100px and max
+        height=100px), keeping the aspect ratio
         :param width: width in pixel
         :param height: height in pixel
-        :return: tuple containing optimal value for width and height
+        :param maxPixel: max width and max height in pixel
+        :return: size to resize to and size of the centered crop
         """
-        self.logger.info("finding thumbnail size for width: %s and height: %s" % (width, height))
-        tobeWidth: int = width
-        tobeHeight: int = height
-        while tobeWidth > THUMBNAIL_MAX_PIXEL or tobeHeight > THUMBNAIL_MAX_PIXEL:
-            tobeWidth /= 2
-            tobeHeight /= 2
-        return int(tobeWidth), int(tobeHeight)
+        self.logger.debug("finding thumbnail size for width: %s and height: %s", width, height)
+        return fitGeometry(width, height, maxPixel, self.fitMode)
 
-    def getThumbnailPath(self, filePath: str) -> str:
+    def getRenderingParameters(self, renditions: List[Rendition]) -> str:
+        """
+        Get the fingerprint of every setting changing the thumbnails made from an image, so that cached thumbnails are
+        not reused once one of them changed
+        :param renditions: resolved renditions of the job
+        :return: canonical representation of the renditions and of the rendering configuration
         """
-        Get thumbnail path from input file path
+        profiles: List[Tuple[str, EncodingProfile]] = sorted(
+            (imageFormat, profile._replace(options=sorted(profile.options.items())))
+            for imageFormat, profile in self.encoder.profiles.items()
+        )
+        return repr((
+            renditions, profiles, self.encoder.pngFastPathSize, self.fitMode, self.resizeBackend, self.shrinkOnLoad,
+            self.animation, self.maxAnimationFrames, self.streaming, self.streamMinPixels
+        ))
+
+    def getThumbnailPath(self, filePath: str, rendition: Union[Rendition, None] = None,
+                         renditions: Union[List[Rendition], None] = None) -> str:
+        """
+        Get thumbnail path from input file path, in the (possibly sharded) thumbnail directory of the input file
+        The primary rendition keeps the input file name, other renditions get their size in the file name
         :param filePath: input file path
+        :param rendition: rendition of the thumbnail, primary rendition if None
+        :param renditions: renditions of the job, configured renditions if None
         :return: thumbnail path
         """
-        thumbnailDir: str = self.config["fileStorage"]["thumbnailPath"]
-        thumbnailPath: str = thumbnailDir + os.path.basename(filePath)
-        return thumbnailPath
+        filename: str = os.path.basename(filePath)
+        thumbnailDir: str = self.storage.getThumbnailDir(filename)
+        if rendition is None or rendition == (renditions or self.renditions)[0]:
+            return thumbnailDir + filename
+        stem: str = os.path.splitext(filename)[0]
+        extension: str = THUMBNAIL_FILE_EXTENSIONS.get(rendition.format, "." + rendition.format)
+        return "%s%s_%s%s" % (thumbnailDir, stem, rendition.size, extension)
+
+    def getDecodeHintSize(self, renditions: List[Rendition]) -> Union[int, None]:
+        """
+        Get size hint given to the decoder to shrink the image on load
+        :param renditions: renditions to make from the image
+        :return: hint size in pixel, None if shrink-on-load is disabled
+        """
+        if not self.shrinkOnLoad:
+            return None
+        return max(rendition.size for rendition in renditions) * DECODE_HINT_FACTOR
+
+    def getPreScale(self, width: int, height: int, imageFormat: str, renditions: List[Rendition]) -> int:
+        """
+        Pick the decoder pre-scale factor ahead of decoding, from the image header and the biggest rendition
+        :param width: width in pixel read from the image header
+        :param height: height in pixel read from the image header
+        :param imageFormat: format read from the image header
+        :param renditions: renditions to make from the image
+        :return: denominator of the pre-scale factor, 1 if the image is fully decoded
+        """
+        if not self.shrinkOnLoad or (imageFormat or "").upper() not in JPEG_FORMATS:
+            return 1
+        geometry: Geometry = self.findThumbnailSize(width, height, max(rendition.size for rendition in renditions))
+        return preScaleFactor(width, height, geometry)
 
-    def makeThumbnail(self, filePath: str) -> str:
+    def selectFrames(self, filePath: str, frames: int = 1) -> str:
         """
-        Make thumbnail from image in filepath using ImageMagick Library binding for Python (Wand)
+        Get the ImageMagick file name reading only the first frames of a multi-frame image (animation, multi-page TIFF)
         :param filePath: input image file path
-        :return: path of the resized image
+        :param frames: number of frames to read
+        :return: file name with a frame selector such as image.gif[0]
         """
+        return "%s[0]" % filePath if frames == 1 else "%s[0-%s]" % (filePath, frames - 1)
+
+    def pingImage(self, filePath: str) -> Tuple[int, int, str]:
+        """
+        Read dimensions and format of input image file from its header without decoding pixels
+        :param filePath: input image file path
+        :return: tuple containing width, height and format of the image
+        """
+        with Image.ping(filename=self.selectFrames(filePath)) as img:
+            return img.width, img.height, img.format
+
+    def openImage(self, filePath: str, renditions: Union[List[Rendition], None] = None,
+                  header: Union[Tuple[int, int, str], None] = None) -> Image:
+        """
+        Open the first frame of input image file, letting the decoder shrink the image on load when the format supports
+        it (JPEG DCT scaling through the jpeg:size hint). Fall back to a full decode if the hinted read fails
+        :param filePath: input image file path
+        :param renditions: renditions to make from the image, configured renditions if None
+        :param header: width, height and format read from the image header, used to ask the decoder for the exact
+        pre-scale factor. Without it, the hint only keeps both sides DECODE_HINT_FACTOR times the biggest rendition
+        :return: decoded image
+        """
+        renditions = renditions or self.renditions
+        if header is not None:
+            width, height = header[0], header[1]
+            preScale: int = self.getPreScale(width, height, header[2], renditions)
+            if preScale == 1:
+                return Image(filename=self.selectFrames(filePath))
+            hint: str = "%sx%s" % (-(-width // preScale), -(-height // preScale))
+        else:
+            hintSize: Union[int, None] = self.getDecodeHintSize(renditions)
+            if hintSize is None:
+                return Image(filename=self.selectFrames(filePath))
+            hint = "%sx%s" % (hintSize, hintSize)
+        img: Image = Image()
+        try:
+            img.options[JPEG_SIZE_HINT_OPTION] = hint
+            img.read(filename=self.selectFrames(filePath))
+            return img
+        except Exception as exc:
+            img.close()
+            self.logger.warning("reduced decode of %s failed, falling back to full decode: %s", filePath, exc)
+        return Image(filename=self.selectFrames(filePath))
+
+    def openStream(self, filePath: str) -> Union[RasterStream, None]:
+        """
+        Open input image file for streaming decode when streaming is enabled, the image has at least streamMinPixels
+        pixels and its format and layout can be read by strips (PGM/PPM, PNG, uncompressed TIFF)
+        :param filePath: input image file path
+        :return: raster stream, None if the image is decoded by ImageMagick
+        """
+        if not self.streaming:
+            return None
+        rasterStream: Union[RasterStream, None] = openRasterStream(filePath)
+        if rasterStream is not None and rasterStream.width * rasterStream.height < self.streamMinPixels:
+            rasterStream.close()
+            return None
+        return rasterStream
+
+    def getStreamFactor(self, rasterStream: RasterStream, renditions: List[Rendition]) -> int:
+        """
+        Get the downsampling factor of a streamed image, keeping it DECODE_HINT_FACTOR times bigger than the thumbnail
+        :param rasterStream: opened raster stream
+        :param renditions: renditions to make from the image
+        :return: integer downsampling factor
+        """
+        hintSize: int = max(rendition.size for rendition in renditions) * DECODE_HINT_FACTOR
+        return max(max(rasterStream.width, rasterStream.height) // hintSize, 1)
+
+    def decodeStream(self, rasterStream: RasterStream, renditions: List[Rendition]) -> Image:
+        """
+        Downsample a streamed image strip by strip, only the downsampled raster is handed to ImageMagick
+        :param rasterStream: opened raster stream, closed once read
+        :param renditions: renditions to make from the image
+        :return: downsampled image
+        """
+        with rasterStream:
+            pixels = streamResize(rasterStream, self.getStreamFactor(rasterStream, renditions))
+        return Image(blob=toNetpbm(pixels))
+
+    def makeThumbnail(self, filePath: str, renditions: Union[List[Rendition], None] = None) -> Dict[str, str]:
+        """
+        Make every thumbnail rendition from image in filepath using ImageMagick Library binding for Python (Wand)
+        Only the first frame of the image is decoded once and renditions are resized step by step from the biggest to
+        the smallest. When animation is enabled, animated renditions of multi-frame images are made from a capped number
+        of frames.
+        Input images are fetched from the storage backend and thumbnails are written to it.
+        Thumbnails of an already processed identical image are taken from the cache without decoding.
+        Very large images are decoded by strips into a downsampled raster when streaming is enabled.
+        When the pixel budget is enabled, dimensions are read from the image header first to admit the decode
+        :param filePath: input image file path
+        :param renditions: renditions requested for the job, configured renditions if None
+        :return: paths of the resized images by redis field, empty if processing failed
+        :raise TransientError: if processing failed for a reason which may go away, so that the job can be retried
+        """
+        if renditions:
+            # renditions of a message are held to the limits of the configured ones
+            try:
+                checkRenditions(renditions, self.maxRenditionSize)
+            except ValueError as exc:
+                self.logger.error("%s %s", ERROR_INVALID_RENDITION, exc)
+                return {}
+        renditions = [self.encoder.resolveRendition(rendition) for rendition in renditions or self.renditions]
+        renditionPaths: Dict[str, str] = {
+            rendition.redisKey: self.getThumbnailPath(filePath, rendition, renditions) for rendition in renditions
+        }
+        thumbnailPaths: Dict[str, str] = dict(renditionPaths)
+        thumbnailPaths[THUMBNAIL_PATH_REDIS_KEY] = self.getThumbnailPath(filePath)
+
+        cacheKey: Union[str, None] = None
         try:
-            self.logger.info("opening input image file in %s using Image Magick" % filePath)
-            with Image(filename=filePath) as img:
-                originalWidth: int = img.width
-                originalHeight: int = img.height
-                self.logger.info("image has originalWidth: %s px and originalHeight: %s px"
-                                 % (originalWidth, originalHeight))
-                tobeWidth, tobeHeight = self.findThumbnailSize(originalWidth, originalHeight)
-                img.resize(tobeWidth, tobeHeight)
-                img.format = self.thumbnailImgFormat
-                thumbnailPath: str = self.getThumbnailPath(filePath)
-                self.logger.info("saving thumbnail file into %s" % thumbnailPath)
-                img.save(filename=thumbnailPath)
+            with self.storage.fetch(filePath) as localPath:
+                if self.thumbnailCache.enabled:
+                    cacheKey = self.thumbnailCache.computeKey(localPath, self.getRenderingParameters(renditions))
+                    if cacheKey is not None and self.thumbnailCache.fetch(cacheKey, renditionPaths):
+                        return thumbnailPaths
+                stillRenditions: List[Rendition] = renditions
+                if self.animation:
+                    stillRenditions = self.makeAnimatedThumbnails(localPath, renditions, renditionPaths)
+                if stillRenditions:
+                    self.makeStillThumbnails(localPath, stillRenditions, renditionPaths)
         except Exception as exc:
-            self.logger.error(exc)
-            return ERROR_PROCESSING_IMAGE
-        return thumbnailPath
+            self.logger.error("%s %s", ERROR_PROCESSING_IMAGE, exc)
+            if isTransient(exc):
+                raise TransientError(str(exc)) from exc
+            return {}
+        if cacheKey is not None:
+            self.thumbnailCache.store(cacheKey, renditionPaths)
+        return thumbnailPaths
+
+    def makeStillThumbnails(self, filePath: str, renditions: List[Rendition], renditionPaths: Dict[str, str]):
+        """
+        Make thumbnail renditions from the first frame of image in filePath
+        :param filePath: input image file path
+        :param renditions: renditions to make
+        :param renditionPaths: paths of the thumbnails by redis field
+        """
+        rasterStream: Union[RasterStream, None] = None
+        try:
+            rasterStream = self.openStream(filePath)
+            decodedPixels: int = 0
+            header: Union[Tuple[int, int, str], None] = None
+            if self.pixelBudget.enabled and rasterStream is not None:
+                factor: int = self.getStreamFactor(rasterStream, renditions)
+                decodedPixels = self.pixelBudget.estimatePixels(rasterStream.width, rasterStream.height, factor)
+            elif self.pixelBudget.enabled:
+                header = self.pingImage(filePath)
+                decodedPixels = self.pixelBudget.estimatePixels(
+                    header[0], header[1], self.getPreScale(*header, renditions)
+                )
+            with self.pixelBudget.admit(decodedPixels):
+                self.logger.debug("opening input image file in %s using Image Magick", filePath)
+                with self.metrics.time(DECODE_STAGE):
+                    if rasterStream is not None:
+                        decodedImg: Image = self.decodeStream(rasterStream, renditions)
+                    else:
+                        decodedImg = self.openImage(filePath, renditions, header)
+                with decodedImg as img:
+                    originalWidth: int = img.width
+                    originalHeight: int = img.height
+                    self.logger.debug("image has originalWidth: %s px and originalHeight: %s px",
+                                      originalWidth, originalHeight)
+                    self.metrics.addMegapixels(originalWidth, originalHeight)
+                    for rendition in sorted(renditions, key=lambda r: r.size, reverse=True):
+                        # every rendition is resized from the previous (bigger) one, possibly already cropped
+                        geometry: Geometry = self.findThumbnailSize(img.width, img.height, rendition.size)
+                        # renditions sharing the size of the previous one are only re-encoded
+                        if (geometry.width, geometry.height) != (img.width, img.height):
+                            with self.metrics.time(RESIZE_STAGE):
+                                self.resizeBackend.resize(img, geometry.width, geometry.height)
+                        if (geometry.cropWidth, geometry.cropHeight) != (img.width, img.height):
+                            img.crop(width=geometry.cropWidth, height=geometry.cropHeight, gravity="center")
+                        thumbnailPath: str = renditionPaths[rendition.redisKey]
+                        self.logger.debug("saving thumbnail file into %s", thumbnailPath)
+                        with self.metrics.time(ENCODE_SAVE_STAGE):
+                            self.encoder.apply(img, self.encoder.chooseFormat(rendition, img, thumbnailPath))
+                            self.storage.write(thumbnailPath, img.make_blob())
+        finally:
+            if rasterStream is not None:
+                rasterStream.close()
+
+    def makeAnimatedThumbnails(self, filePath: str, renditions: List[Rendition],
+                               renditionPaths: Dict[str, str]) -> List[Rendition]:
+        """
+        Make animated thumbnail renditions (formats of ANIMATED_THUMBNAIL_FORMATS) from at most maxAnimationFrames
+        frames of image in filePath, resized as a sequence with ImageMagick
+        :param filePath: input image file path
+        :param renditions: renditions requested for the job
+        :param renditionPaths: paths of the thumbnails by redis field
+        :return: renditions left to make from the first frame: still formats, or every rendition if the input has a
+        single frame
+        """
+        animatedRenditions: List[Rendition] = [
+            rendition for rendition in renditions if rendition.format in ANIMATED_THUMBNAIL_FORMATS
+        ]
+        if not animatedRenditions:
+            return renditions
+        # frames are counted from their headers, so that single-frame images are only decoded by the still path
+        with Image.ping(filename=self.selectFrames(filePath, self.maxAnimationFrames)) as header:
+            frames: int = len(header.sequence)
+            decodedPixels: int = header.width * header.height * frames if self.pixelBudget.enabled else 0
+        if frames < 2:
+            return renditions
+        with self.pixelBudget.admit(decodedPixels):
+            with self.metrics.time(DECODE_STAGE):
+                decodedImg: Image = Image(filename=self.selectFrames(filePath, self.maxAnimationFrames))
+            with decodedImg as img:
+                self.logger.debug("making animated thumbnails from %s frames", len(img.sequence))
+                for rendition in sorted(animatedRenditions, key=lambda r: r.size, reverse=True):
+                    geometry: Geometry = self.findThumbnailSize(img.width, img.height, rendition.size)
+                    if (geometry.width, geometry.height) != (img.width, img.height):
+                        with self.metrics.time(RESIZE_STAGE):
+                            img.resize(geometry.width, geometry.height)
+                    if (geometry.cropWidth, geometry.cropHeight) != (img.width, img.height):
+                        img.crop(width=geometry.cropWidth, height=geometry.cropHeight, gravity="center")
+                    with self.metrics.time(ENCODE_SAVE_STAGE):
+                        self.encoder.apply(img, rendition.format)
+                        self.storage.write(renditionPaths[rendition.redisKey], img.make_blob())
+        return [rendition for rendition in renditions if rendition not in animatedRenditions]
+
+    def getFinishedJob(self, jobId: str, filePath: str, thumbnailPaths: Dict[str, str],
+                       seconds: float) -> Tuple[str, JobStatusEnum, Dict[str, str]]:
+        """
+        Get final state of a job from the result of makeThumbnail and log it as a single structured record
+        :param jobId: id of the job
+        :param filePath: input image file path
+        :param thumbnailPaths: paths of the resized images by redis field, empty if processing failed
+        :param seconds: time spent making the thumbnails
+        :return: finished job containing job id, next job status and thumbnail paths
+        """
+        self.metrics.countJob(bool(thumbnailPaths))
+        # Job status in redis becomes JobStatusEnum.COMPLETE and thumbnail paths are filled in accordingly
+        # or JobStatusEnum.ERROR_DURING_PROCESSING if processing failed
+        nextJobStatus: JobStatusEnum = \
+            JobStatusEnum.COMPLETE if thumbnailPaths else JobStatusEnum.ERROR_DURING_PROCESSING
+        self.logger.info(JOB_LOG_FORMAT, jobId, nextJobStatus.name, filePath, len(thumbnailPaths), seconds * 1000)
+        return jobId, nextJobStatus, thumbnailPaths
+
+    def getFailedJob(self, job: JobRequest, currentJobStatus: JobStatusEnum, filePath: str, attempts: int, reason: str,
+                     seconds: float, failedJobs: List[Tuple[JobRequest, int, str, str]]) \
+            -> Tuple[str, JobStatusEnum, Dict[str, str]]:
+        """
+        Get final state of a job which failed with a transient error or which is a poison message
+        With retries, the job gets its previous status back to be claimed again and is added to failedJobs, to be
+        published into a delay queue, or into the dead-letter queue once it has failed maxAttempts times
+        :param job: failed job
+        :param currentJobStatus: status of the job before it was claimed
+        :param filePath: input image file path
+        :param attempts: number of attempts of the job, including this one
+        :param reason: reason of the failure
+        :param seconds: time spent on the job
+        :param failedJobs: failed jobs to publish containing job, attempts, reason and queue
+        :return: finished job containing job id, next job status and thumbnail paths
+        """
+        if not self.retryPolicy.enabled:
+            return self.getFinishedJob(job.jobId, filePath, {}, seconds)
+        queueName: str = self.queueClasses[0].name
+        if len(self.queueClasses) > 1:
+            queueName = classifyFileSize(self.queueClasses, self.storage.getSize(filePath)).name
+        failedJobs.append((job, attempts, reason, queueName))
+        if not self.retryPolicy.canRetry(attempts):
+            return self.getFinishedJob(job.jobId, filePath, {}, seconds)
+        self.logger.info(JOB_LOG_FORMAT, job.jobId, "RETRY", filePath, 0, seconds * 1000)
+        return job.jobId, currentJobStatus, {}
+
+    def publishFailedJobs(self, channel, failedJobs: List[Tuple[JobRequest, int, str, str]]):
+        """
+        Publish failed jobs into the delay queues of their queue, one message per queue and attempt, or into the
+        dead-letter queue. Called after their status is updated and before their messages are acknowledged
+        :param channel: channel used to publish
+        :param failedJobs: failed jobs containing job, attempts, reason and queue
+        """
+        retriedJobs: Dict[Tuple[str, int], List[JobRequest]] = {}
+        for job, attempts, reason, queueName in failedJobs:
+            if self.retryPolicy.canRetry(attempts):
+                retriedJobs.setdefault((queueName, attempts), []).append(job)
+            else:
+                self.retryPolicy.publishDeadLetter(channel, job, attempts, reason)
+        for (queueName, attempts), jobs in retriedJobs.items():
+            self.retryPolicy.publishRetry(channel, queueName, jobs, attempts)
+
+    def executeJobs(self, jobs: List[JobRequest]):
+        """
+        Execute a batch of jobs and publish the failed ones
+        :param jobs: requested jobs
+        """
+        self.publishFailedJobs(self.channel, self.runJobs(jobs))
+
+    def runJobs(self, jobs: List[JobRequest]) -> List[Tuple[JobRequest, int, str, str]]:
+        """
+        Claim, process and finish a batch of jobs: this is the main logic of the worker
+        It never touches the channel, so that it can run outside of the consumer thread
+        :param jobs: requested jobs
+        :return: failed jobs to publish, see getFailedJob
+        """
+        # Get data from redis and update job status to JobStatusEnum.PROCESSING
+        claimedJobs: List[Tuple[str, JobStatusEnum, str, int]] = self.claimJobs(
+            [job.jobId for job in jobs], {job.jobId for job in jobs if job.redelivered}
+        )
+        jobRenditions: Dict[str, Union[List[Rendition], None]] = {job.jobId: job.renditions for job in jobs}
+
+        finishedJobs: List[Tuple[str, JobStatusEnum, Dict[str, str]]] = []
+        failedJobs: List[Tuple[JobRequest, int, str, str]] = []
+        for jobId, currentJobStatus, filePath, attempts in claimedJobs:
+            job: JobRequest = JobRequest(jobId, jobRenditions[jobId])
+            if self.retryPolicy.isPoison(attempts):
+                self.logger.error("job %s: %s", jobId, ERROR_POISON_JOB)
+                finishedJobs.append(self.getFailedJob(
+                    job, currentJobStatus, filePath, attempts, ERROR_POISON_JOB, 0.0, failedJobs
+                ))
+                continue
+            # Use ImageMagick to make thumbnails
+            start: float = time.perf_counter()
+            try:
+                thumbnailPaths: Dict[str, str] = self.makeThumbnail(filePath, job.renditions)
+            except TransientError as exc:
+                finishedJobs.append(self.getFailedJob(
+                    job, currentJobStatus, filePath, attempts, str(exc), time.perf_counter() - start, failedJobs
+                ))
+                continue
+            finishedJobs.append(self.getFinishedJob(jobId, filePath, thumbnailPaths, time.perf_counter() - start))
+
+        self.finishJobs(finishedJobs)
+        return failedJobs
+
+    def flushJobs(self, channel):
+        """
+        Process all buffered jobs by batches of batchSize and acknowledge their messages with a single ack
+        :param channel: channel from which the messages come
+        """
+        if self.flushTimer is not None:
+            self.getQueueConnection().remove_timeout(self.flushTimer)
+            self.flushTimer = None
+        if not self.pendingJobs:
+            return
+        batch: List[Tuple[int, JobRequest]] = self.pendingJobs
+        self.pendingJobs = []
+        self.logger.debug("processing batch of %s jobs", len(batch))
+        # a batch message may hold many more jobs than batchSize
+        for index in range(0, len(batch), self.batchSize):
+            self.executeJobs([job for deliveryTag, job in batch[index:index + self.batchSize]])
+
+        with self.metrics.time(ACK_STAGE):
+            if len(self.queueClasses) == 1:
+                # acknowledge every message of the batch at once when treatment is finished
+                channel.basic_ack(delivery_tag=batch[-1][0], multiple=True)
+            else:
+                # messages of other queues may still wait in the scheduler with lower delivery tags
+                for deliveryTag in sorted({deliveryTag for deliveryTag, job in batch}):
+                    channel.basic_ack(delivery_tag=deliveryTag)
 
     def executeProcess(self, channel, method_frame, header_frame: BasicProperties, body: bytes):
         """
         Callback when receiving a message
-        This is the main logic of the worker
+        Jobs of the message are buffered until a full batch is available or the batch timeout expires
         :param channel: channel from which the message comes
         :param method_frame: method frame of the message
         :param header_frame: header frame of the message
-        :param body: body of the message
+        :param body: body of the message: a job id or a JSON array of jobs
         """
-        jobId: str = body.decode(self.encoding)
-        self.logger.info("receiving job: %s" % jobId)
+        try:
+            jobs: List[JobRequest] = parseJobMessage(body, self.encoding, method_frame.redelivered)
+        except ValueError as exc:
+            self.logger.error("%s %s", ERROR_MALFORMED_MESSAGE, exc)
+            channel.basic_reject(delivery_tag=method_frame.delivery_tag, requeue=False)
+            return
+        self.logger.debug("receiving jobs: %s", jobs)
+        if not jobs:
+            channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+            return
+        self.pendingJobs.extend((method_frame.delivery_tag, job) for job in jobs)
 
-        # Get data from redis
-        currentJobStatus, filePath = self.getJobInfoFromRedis(jobId)
+        if len(self.pendingJobs) >= self.batchSize:
+            self.flushJobs(channel)
+        elif self.flushTimer is None:
+            # make sure a partial batch does not wait forever when the queue runs dry
+            self.flushTimer = self.getQueueConnection().call_later(self.batchTimeout, partial(self.flushJobs, channel))
 
-        # Update job status in redis to JobStatusEnum.PROCESSING
-        currentJobStatus = self.updateJobInfo(jobId, currentJobStatus, JobStatusEnum.PROCESSING)
+    def getFilePaths(self, jobIds: List[str]) -> List[Union[str, None]]:
+        """
+        Read input file path of jobs from Redis using a single pipeline
+        :param jobIds: ids of the jobs
+        :return: file path of each job, None if the job does not exist
+        """
+        def readFilePaths() -> List:
+            pipeline = self.getRedisClient().pipeline(transaction=False)
+            for jobId in jobIds:
+                pipeline.hget(jobId, FILE_PATH_REDIS_KEY)
+            return pipeline.execute()
 
-        # Use ImageMagick to make thumbnail
-        retThumbnailPath: str = self.makeThumbnail(filePath)
+        try:
+            with self.metrics.time(REDIS_FETCH_STAGE):
+                filePaths: List = self.callRedis(readFilePaths, "reading file paths")
+        except Exception as exc:
+            self.logger.critical(exc)
+            exit(1)
+        return [filePath.decode(self.encoding) if filePath is not None else None for filePath in filePaths]
 
-        if retThumbnailPath == ERROR_PROCESSING_IMAGE:
-            # Update Job status in redis to JobStatusEnum.ERROR_DURING_PROCESSING
-            self.updateJobInfo(jobId, currentJobStatus, JobStatusEnum.ERROR_DURING_PROCESSING)
-        else:
-            # Update Job status in redis to JobStatusEnum.COMPLETE and fill in thumbnail path accordingly
-            self.updateJobInfo(jobId, currentJobStatus, JobStatusEnum.COMPLETE, retThumbnailPath)
+    def classifyJobs(self, jobs: List[JobRequest]) -> Dict[str, List[JobRequest]]:
+        """
+        Find the queue of each job from the size of its input file
+        :param jobs: requested jobs
+        :return: jobs by queue name
+        """
+        classifiedJobs: Dict[str, List[JobRequest]] = {}
+        for job, filePath in zip(jobs, self.getFilePaths([job.jobId for job in jobs])):
+            fileSize: Union[int, None] = self.storage.getSize(filePath) if filePath is not None else None
+            queueClass: QueueClass = classifyFileSize(self.queueClasses, fileSize)
+            classifiedJobs.setdefault(queueClass.name, []).append(job)
+        return classifiedJobs
 
-        # acknowledge message if treatment is finished
-        self.logger.info("job %s is finished" % jobId)
+    def publishJobs(self, channel, classifiedJobs: Dict[str, List[JobRequest]]):
+        """
+        Publish jobs into their queue, one persistent message per queue
+        :param channel: channel used to publish
+        :param classifiedJobs: jobs by queue name
+        """
+        for queueName, jobs in classifiedJobs.items():
+            self.logger.debug("routing jobs %s to queue %s", jobs, queueName)
+            channel.basic_publish("", queueName, formatJobMessage(jobs, self.encoding),
+                                  BasicProperties(delivery_mode=2))
+
+    def routeMessage(self, channel, method_frame, header_frame: BasicProperties, body: bytes):
+        """
+        Callback when receiving a message of queueName while it is not a consumed queue: dispatch its jobs to the
+        queue of their size class
+        :param channel: channel from which the message comes
+        :param method_frame: method frame of the message
+        :param header_frame: header frame of the message
+        :param body: body of the message: a job id or a JSON array of jobs
+        """
+        try:
+            jobs: List[JobRequest] = parseJobMessage(body, self.encoding)
+        except ValueError as exc:
+            self.logger.error("%s %s", ERROR_MALFORMED_MESSAGE, exc)
+            channel.basic_reject(delivery_tag=method_frame.delivery_tag, requeue=False)
+            return
+        self.publishJobs(channel, self.classifyJobs(jobs))
         channel.basic_ack(delivery_tag=method_frame.delivery_tag)
 
+    def scheduleMessage(self, queueName: str, channel, method_frame, header_frame: BasicProperties, body: bytes):
+        """
+        Callback when receiving a message of a consumed queue: buffer it until the scheduler serves its queue
+        :param queueName: name of the queue of the message
+        :param channel: channel from which the message comes
+        :param method_frame: method frame of the message
+        :param header_frame: header frame of the message
+        :param body: body of the message
+        """
+        self.scheduler.push(queueName, (method_frame, header_frame, body))
+
+    def consumeQueues(self):
+        """
+        Consume every queue class with a prefetch window shared according to their weight, serve buffered messages
+        with weighted round robin and route the messages of queueName, until the consumer is stopped
+        Messages which have not been started go back to their queue
+        """
+        prefetchCounts: Dict[str, int] = splitPrefetchCount(self.queueClasses, self.prefetchCount)
+        for queueClass in self.queueClasses:
+            self.channel.queue_declare(queueClass.name, durable=True)
+            # prefetch count applies to the consumers created afterwards
+            self.channel.basic_qos(prefetch_count=prefetchCounts[queueClass.name])
+            self.channel.basic_consume(queueClass.name, partial(self.scheduleMessage, queueClass.name))
+        if self.routing:
+            queueName: str = self.config["queue"]["queueName"]
+            self.channel.queue_declare(queueName, durable=True)
+            self.channel.basic_qos(prefetch_count=self.prefetchCount)
+            self.channel.basic_consume(queueName, self.routeMessage)
+        self.logger.info("start_consuming queues: %s", self.queueClasses)
+        self.reportStartup()
+        while not self.stopping:
+            # wait for a message, a timer or a stop request only when nothing is buffered
+            self.queueConn.process_data_events(time_limit=0 if len(self.scheduler) else None)
+            # a stop request received meanwhile leaves buffered messages to the queue
+            scheduled = self.scheduler.pop() if not self.stopping else None
+            if scheduled is not None:
+                queueName, (method_frame, header_frame, body) = scheduled
+                self.executeProcess(self.channel, method_frame, header_frame, body)
+        for method_frame, header_frame, body in self.scheduler.drain():
+            self.channel.basic_nack(delivery_tag=method_frame.delivery_tag, requeue=True)
+
+    def stop(self, signum=None, frame=None):
+        """
+        Stop consuming so that the process drains gracefully: used as SIGTERM handler
+        Buffered jobs are still processed and acknowledged before the process exits
+        :param signum: number of the received signal
+        :param frame: current stack frame
+        """
+        self.logger.info("stopping consumer of pid: %s", os.getpid())
+        self.stopping = True
+        if self.queueConn is not None and self.channel is not None:
+            self.queueConn.add_callback_threadsafe(self.channel.stop_consuming)
+
+    def dropQueueConnection(self, reason: Exception):
+        """
+        Forget a lost RabbitMQ connection and wait a jittered delay before connecting again
+        Buffered jobs are dropped: RabbitMQ redelivers every unacknowledged message of the lost connection
+        :param reason: error which revealed the lost connection
+        """
+        delay: float = self.backoff.getDelay(1)
+        self.logger.warning("RabbitMQ connection lost: %s, reconnecting in %.2f s", reason, delay)
+        self.countReconnect("amqp")
+        self.pendingJobs = []
+        self.flushTimer = None
+        self.scheduler.drain()
+        self.queueConn = None
+        self.channel = None
+        time.sleep(delay)
+
     def processJob(self):
         """
-        Process job from the queue server
+        Process job from the queue server, connecting again when the connection is lost
         """
-        self.logger.info("processJob by pid: %s" % os.getpid())
+        self.logger.info("processJob by pid: %s", os.getpid())
+        signal.signal(signal.SIGTERM, self.stop)
         try:
-            channel = self.getQueueConnection().channel()
-            queueName: str = self.config["queue"]["queueName"]
-            channel.queue_declare(queueName, durable=True)
-            channel.basic_consume(queueName, self.executeProcess)
-            self.logger.info("start_consuming")
-            channel.start_consuming()
+            while not self.stopping:
+                try:
+                    self.channel = self.getQueueConnection().channel()
+                    if len(self.queueClasses) > 1 or self.routing:
+                        self.consumeQueues()
+                    else:
+                        queueName: str = self.config["queue"]["queueName"]
+                        self.channel.queue_declare(queueName, durable=True)
+                        self.channel.basic_qos(prefetch_count=self.prefetchCount)
+                        self.channel.basic_consume(queueName, self.executeProcess)
+                        self.logger.info("start_consuming")
+                        self.reportStartup()
+                        self.channel.start_consuming()
+                    break
+                except AMQPConnectionError as exc:
+                    if self.stopping:
+                        raise
+                    self.dropQueueConnection(exc)
+            # consuming was stopped: process and acknowledge what is still buffered
+            if self.channel is not None:
+                self.flushJobs(self.channel)
         except Exception as exc:
             self.logger.critical(exc)
         finally:
-            self.queueConn.close()
-            exit(1)
+            if self.queueConn is not None and self.queueConn.is_open:
+                self.queueConn.close()
+            exit(0 if self.stopping else 1)